@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the FreeRADIUS parsers.
+
+Run from the top level directory of the repository:
+
+    python benchmark.py suite --sizes 1000 10000 --output results.json
+    python benchmark.py grammar --sizes 1000 10000
+    python benchmark.py format --sizes 1000 10000 100000
+    python benchmark.py users-memory --sizes 1000 10000
+    python benchmark.py startup --repeat 20
+    python benchmark.py snapshot --sizes 1000 10000
+
+suite parses synthetic clients.conf and users files of each size and
+records the time and the peak memory of get(), get_dict(), format() and
+save(). With --output the results are written as JSON, so that runs with
+different versions of pyparsing or of the grammars can be compared.
+
+grammar compares the parse time of the reference grammars with the fast
+grammars. --packrat enables packrat parsing for the fast grammars.
+
+The time per entry of format has to stay constant for growing sizes,
+otherwise the formatter no longer scales linearly. users-memory compares
+the memory held by the parse results of a users file with the memory held
+by its UserEntry records.
+
+startup measures the time of "import freeradiusparser" with
+"python -X importtime" in fresh interpreters, whether the import already
+imported pyparsing, and the time of the first get(), which builds the
+grammars.
+
+snapshot compares parsing get_dict() of clients.conf and get_entries() of
+users with loading them from a current snapshot.
+
+match measures compiling a users file into a UserMatcher and matching a
+batch of requests. The time per request has to stay constant for growing
+sizes.
+
+mapped compares looking up 100 clients with get_dict() of the native
+backend and with a MappedClientConf.
+
+diff compares diff() of two versions of a clients.conf and of a users
+file, which differ in 1% of their entries, with comparing their
+get_dict().
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import pyparsing
+
+import freeradiusparser
+from freeradiusparser import (ClientConfParser, UserConfParser, ParseCache,
+                              UserMatcher, MappedClientConf, diff)
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+FIRST_GET_SCRIPT = """
+import time
+from freeradiusparser import ClientConfParser, UserConfParser
+start = time.time()
+ClientConfParser(content="client x { secret = s }").get()
+UserConfParser(content="bob Cleartext-Password := x").get()
+print(time.time() - start)
+"""
+
+
+def generate_clients(n):
+    """
+    :return: a dict_config with n clients as returned by get_dict()
+    """
+    clients = OrderedDict()
+    for i in range(n):
+        clients[u"client-{0:d}".format(i)] = OrderedDict([
+            (u"ipaddr", u"10.{0:d}.{1:d}.{2:d}".format(i >> 16 & 255,
+                                                      i >> 8 & 255, i & 255)),
+            (u"secret", u"secret-{0:d}".format(i)),
+            (u"shortname", u"nas-{0:d}".format(i)),
+            (u"limit", OrderedDict([(u"max_connections", u"16"),
+                                    (u"lifetime", u"0")])),
+        ])
+    return clients
+
+
+def generate_users(n):
+    """
+    :return: a config with n users as returned by UserConfParser.get()
+    """
+    return [[u"user{0:d}".format(i), u"Cleartext-Password", u":=",
+             u'"secret{0:d}"'.format(i),
+             [[u"Reply-Message", u"=", u'"Hello"'],
+              [u"Framed-IP-Address", u"=", u"10.0.0.{0:d}".format(i % 255)]]]
+            for i in range(n)]
+
+
+def generate_clients_conf(n):
+    """
+    :return: the text of a clients.conf with n clients. It mixes flat
+        attributes, limit sections, named sections and comments.
+    """
+    lines = [u"# synthetic clients.conf with {0:d} clients".format(n)]
+    for i in range(n):
+        address = u"10.{0:d}.{1:d}.{2:d}".format(i >> 16 & 255, i >> 8 & 255,
+                                                 i & 255)
+        lines.append(u"")
+        if i % 10 == 0:
+            lines.append(u"# client number {0:d}".format(i))
+        lines.append(u"client nas-{0:d} {{".format(i))
+        lines.append(u"\tipaddr = {0!s}".format(address))
+        lines.append(u"\tsecret = secret-{0:d}  # shared secret".format(i))
+        lines.append(u"\tshortname = nas-{0:d}".format(i))
+        lines.append(u"\tnas_type = other")
+        if i % 3 == 0:
+            lines.append(u"\tlimit {")
+            lines.append(u"\t\tmax_connections = 16")
+            lines.append(u"\t\tlifetime = 0")
+            lines.append(u"\t\tidle_timeout = 30")
+            lines.append(u"\t}")
+        elif i % 3 == 1:
+            lines.append(u"\tlimit tcp {")
+            lines.append(u"\t\tmax_connections = 4")
+            lines.append(u"\t}")
+        lines.append(u"}")
+    return u"\n".join(lines) + u"\n"
+
+
+def generate_users_file(n):
+    """
+    :return: the text of a users file with n entries. Every tenth entry is
+        a DEFAULT entry, the others are users with several reply items.
+    """
+    lines = [u"# synthetic users file with {0:d} entries".format(n)]
+    for i in range(n):
+        lines.append(u"")
+        if i % 10 == 0:
+            lines.append(u'DEFAULT\tHint == "SLIP{0:d}"'.format(i))
+            lines.append(u"\tFramed-Protocol = SLIP,")
+            lines.append(u"\tFramed-Compression = Van-Jacobson-TCP-IP")
+            continue
+        lines.append(u'user{0:d}\tCleartext-Password := "secret{0:d}"'
+                     .format(i))
+        lines.append(u"\tService-Type = Framed-User,")
+        lines.append(u"\tFramed-Protocol = PPP,")
+        lines.append(u"\tFramed-IP-Address = 172.16.{0:d}.{1:d},".format(
+            i >> 8 & 255, i & 255))
+        lines.append(u"\tFramed-IP-Netmask = 255.255.255.0,")
+        lines.append(u"\tFramed-MTU = 1500,")
+        lines.append(u"\tFramed-Compression = Van-Jacobson-TCP-IP")
+    return u"\n".join(lines) + u"\n"
+
+
+def _timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def _measure(func, *args):
+    """
+    :return: (result, seconds, peak bytes) of calling func. The time is
+        measured without tracing the memory.
+    """
+    gc.collect()
+    seconds = _timed(func, *args)
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_suite(sizes, backend, fast, output=None):
+    tmpdir = tempfile.mkdtemp()
+    results = {
+        "python": platform.python_version(),
+        "pyparsing": pyparsing.__version__,
+        "fast": fast,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": []}
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>10s} {4:>10s} {5:>12s}".format(
+        "parser", "entries", "bytes", "phase", "seconds", "peak memory"))
+    try:
+        for parser_class, generate in [
+                (ClientConfParser, generate_clients_conf),
+                (UserConfParser, generate_users_file)]:
+            for n in sizes:
+                infile = os.path.join(tmpdir, "input")
+                outfile = os.path.join(tmpdir, "output")
+                with open(infile, "w") as f:
+                    f.write(generate(n))
+                size = os.path.getsize(infile)
+                kwargs = {"infile": infile, "fast": fast}
+                if parser_class is ClientConfParser:
+                    kwargs["backend"] = backend
+                uncached = parser_class(cache=None, **kwargs)
+                cached = parser_class(cache=ParseCache(), **kwargs)
+                cached.get()
+                phases = []
+                _result, seconds, peak = _measure(uncached.get)
+                phases.append(("get", seconds, peak))
+                # the parse result is cached, only the dictionary is built
+                config, seconds, peak = _measure(cached.get_dict)
+                phases.append(("get_dict", seconds, peak))
+                if parser_class is UserConfParser:
+                    config = cached.get_entries()
+                _result, seconds, peak = _measure(cached.format, config)
+                phases.append(("format", seconds, peak))
+                _result, seconds, peak = _measure(cached.save, config,
+                                                  outfile)
+                phases.append(("save", seconds, peak))
+                for phase, seconds, peak in phases:
+                    print("{0:>8s} {1:8d} {2:10d} {3:>10s} {4:10.3f} "
+                          "{5:10.1f}MB".format(
+                              parser_class.__name__[:-len("ConfParser")],
+                              n, size, phase, seconds, peak / 1e6))
+                    results["results"].append({
+                        "parser": parser_class.__name__,
+                        "backend": kwargs.get("backend"),
+                        "entries": n,
+                        "bytes": size,
+                        "phase": phase,
+                        "seconds": seconds,
+                        "peak_memory": peak})
+    finally:
+        shutil.rmtree(tmpdir)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def bench_grammar(sizes):
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>10s} {4:>8s}".format(
+        "parser", "entries", "reference", "fast", "speedup"))
+    for parser_class, generate in [
+            (ClientConfParser, generate_clients_conf),
+            (UserConfParser, generate_users_file)]:
+        for n in sizes:
+            content = generate(n)
+            reference = _timed(parser_class(content=content).get)
+            fast = _timed(parser_class(content=content, fast=True).get)
+            print("{0:>8s} {1:8d} {2:10.3f} {3:10.3f} {4:7.1f}x".format(
+                parser_class.__name__[:-len("ConfParser")], n, reference,
+                fast, reference / fast))
+
+
+def bench_format(sizes):
+    clients = ClientConfParser(infile=os.devnull)
+    users = UserConfParser(infile=os.devnull)
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>12s}".format(
+        "parser", "entries", "seconds", "us per entry"))
+    for parser, generate in [(clients, generate_clients),
+                             (users, generate_users)]:
+        for n in sizes:
+            config = generate(n)
+            seconds = _timed(parser.format, config)
+            print("{0:>8s} {1:8d} {2:10.3f} {3:12.2f}".format(
+                type(parser).__name__[:-len("ConfParser")], n, seconds,
+                seconds / n * 1e6))
+
+
+def _retained(func):
+    """
+    :return: the number of bytes still allocated by the result of func
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return retained
+
+
+def bench_users_memory(sizes):
+    print("{0:>8s} {1:>14s} {2:>14s}".format(
+        "entries", "ParseResults", "UserEntry"))
+    for n in sizes:
+        content = UserConfParser(infile=os.devnull).format(generate_users(n))
+        parser = UserConfParser(content=content)
+        parse_results = _retained(parser.get)
+        entries = _retained(parser.get_entries)
+        print("{0:8d} {1:12.0f} B {2:12.0f} B  per entry".format(
+            n, parse_results / float(n), entries / float(n)))
+
+
+def bench_snapshot(sizes):
+    tmpdir = tempfile.mkdtemp()
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>10s} {4:>8s}".format(
+        "parser", "entries", "parse", "snapshot", "speedup"))
+    try:
+        for parser_class, generate, method in [
+                (ClientConfParser, generate_clients_conf, "get_dict"),
+                (UserConfParser, generate_users_file, "get_entries")]:
+            for n in sizes:
+                infile = os.path.join(tmpdir, "input")
+                with open(infile, "w") as f:
+                    f.write(generate(n))
+                parser = parser_class(infile=infile, cache=None)
+                parse = _timed(getattr(parser, method))
+                parser.snapshot = True
+                # writes the snapshot
+                getattr(parser, method)()
+                load = _timed(getattr(parser, method))
+                print("{0:>8s} {1:8d} {2:10.3f} {3:10.3f} {4:7.1f}x".format(
+                    parser_class.__name__[:-len("ConfParser")], n, parse,
+                    load, parse / load))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_match(sizes, requests=10000):
+    tmpdir = tempfile.mkdtemp()
+    print("{0:>8s} {1:>10s} {2:>14s}".format("entries", "compile",
+                                             "per request"))
+    try:
+        for n in sizes:
+            infile = os.path.join(tmpdir, "users")
+            with open(infile, "w") as f:
+                f.write(generate_users_file(n))
+            # the parse result is taken from the cache by the matcher
+            parser = UserConfParser(infile=infile, fast=True,
+                                    cache=ParseCache())
+            parser.get()
+            start = time.time()
+            matcher = UserMatcher(parser, auto_refresh=False)
+            compile_time = time.time() - start
+            batch = [{u"User-Name": u"user{0:d}".format(i * 7 % n),
+                      u"Hint": u"SLIP{0:d}".format(i * 10 % n)}
+                     for i in range(requests)]
+            match = _timed(matcher.match_all, batch)
+            print("{0:8d} {1:10.3f} {2:12.1f}us".format(
+                n, compile_time, match / requests * 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _lookup_mapped(infile, client_keys):
+    with MappedClientConf(infile) as clients:
+        return [clients[client_key] for client_key in client_keys]
+
+
+def _lookup_parsed(infile, client_keys):
+    clients = ClientConfParser(infile=infile, backend="native",
+                               cache=None).get_dict()
+    return [clients[client_key] for client_key in client_keys]
+
+
+def bench_mapped(sizes, lookups=100):
+    tmpdir = tempfile.mkdtemp()
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>12s}".format(
+        "entries", "reader", "seconds", "peak memory"))
+    try:
+        for n in sizes:
+            infile = os.path.join(tmpdir, "clients.conf")
+            with open(infile, "w") as f:
+                f.write(generate_clients_conf(n))
+            client_keys = [u"nas-{0:d}".format(i * n // lookups)
+                           for i in range(lookups)]
+            for name, lookup in [("parsed", _lookup_parsed),
+                                 ("mapped", _lookup_mapped)]:
+                _result, seconds, peak = _measure(lookup, infile,
+                                                  client_keys)
+                print("{0:8d} {1:>8s} {2:10.3f} {3:10.1f}MB".format(
+                    n, name, seconds, peak / 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _compare_dicts(old, new):
+    return old.get_dict() != new.get_dict()
+
+
+def bench_diff(sizes):
+    print("{0:>8s} {1:>8s} {2:>10s} {3:>10s} {4:>8s}".format(
+        "parser", "entries", "get_dict", "diff", "records"))
+    for parser_class, generate, value, changed in [
+            (ClientConfParser, generate_clients_conf, u"secret = secret-",
+             u"secret = changed-"),
+            (UserConfParser, generate_users_file, u"Framed-MTU = 1500",
+             u"Framed-MTU = 576")]:
+        for n in sizes:
+            old_content = generate(n)
+            # change every 100th value
+            parts = old_content.split(value)
+            new_content = u"".join(
+                part + (changed if i % 100 == 99 else value)
+                for i, part in enumerate(parts[:-1])) + parts[-1]
+            kwargs = {"cache": None}
+            if parser_class is ClientConfParser:
+                kwargs["backend"] = "native"
+            old = parser_class(content=old_content, **kwargs)
+            new = parser_class(content=new_content, **kwargs)
+            compare = _timed(_compare_dicts, old, new)
+            start = time.time()
+            records = diff(old, new)
+            print("{0:>8s} {1:8d} {2:10.3f} {3:10.3f} {4:8d}".format(
+                parser_class.__name__[:-len("ConfParser")], n, compare,
+                time.time() - start, len(records)))
+
+
+def _python(*args):
+    """
+    Run a fresh interpreter in the directory of freeradiusparser.
+
+    :return: (stdout, stderr)
+    """
+    process = subprocess.Popen(
+        [sys.executable] + list(args), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True,
+        cwd=os.path.dirname(os.path.abspath(freeradiusparser.__file__)))
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError(stderr)
+    return stdout, stderr
+
+
+def _import_times(stderr):
+    """
+    :return: the cumulative import time in seconds per module from the
+        output of python -X importtime
+    """
+    times = {}
+    for line in stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if line.startswith("import time:") and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1e6
+    return times
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def bench_startup(repeat):
+    imports = []
+    pyparsing_imports = []
+    first_gets = []
+    for _i in range(repeat):
+        _stdout, stderr = _python("-X", "importtime", "-c",
+                                  "import freeradiusparser")
+        times = _import_times(stderr)
+        imports.append(times["freeradiusparser"])
+        pyparsing_imports.append(times.get("pyparsing", 0))
+        stdout, _stderr = _python("-c", FIRST_GET_SCRIPT)
+        first_gets.append(float(stdout))
+    print("{0:>24s} {1:10.1f}ms".format("import freeradiusparser",
+                                        _median(imports) * 1e3))
+    print("{0:>24s} {1:10.1f}ms".format("of which pyparsing",
+                                        _median(pyparsing_imports) * 1e3))
+    print("{0:>24s} {1:10.1f}ms".format("first get()",
+                                        _median(first_gets) * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("benchmark",
+                        choices=["suite", "grammar", "format",
+                                 "users-memory", "startup",
+                                 "snapshot", "match", "mapped",
+                                 "diff"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--backend", choices=ClientConfParser.backends,
+                        default="pyparsing",
+                        help="The backend of ClientConfParser")
+    parser.add_argument("--fast", action="store_true",
+                        help="Use the fast grammars in suite")
+    parser.add_argument("--packrat", type=int, metavar="CACHE_SIZE",
+                        help="Enable packrat parsing for the fast grammars")
+    parser.add_argument("--output", help="Write the results of suite as JSON")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="The number of interpreters started by startup")
+    args = parser.parse_args()
+    freeradiusparser.PACKRAT_CACHE_SIZE = args.packrat
+    if args.benchmark == "suite":
+        bench_suite(args.sizes, args.backend, args.fast, args.output)
+    elif args.benchmark == "grammar":
+        bench_grammar(args.sizes)
+    elif args.benchmark == "format":
+        bench_format(args.sizes)
+    elif args.benchmark == "users-memory":
+        bench_users_memory(args.sizes)
+    elif args.benchmark == "startup":
+        bench_startup(args.repeat)
+    elif args.benchmark == "snapshot":
+        bench_snapshot(args.sizes)
+    elif args.benchmark == "match":
+        bench_match(args.sizes)
+    elif args.benchmark == "mapped":
+        bench_mapped(args.sizes)
+    elif args.benchmark == "diff":
+        bench_diff(args.sizes)
+
+
+if __name__ == "__main__":
+    main()
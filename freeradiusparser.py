@@ -1,13 +1,565 @@
 # -*- coding: utf-8 -*-
 import codecs
+import contextlib
+import copy
+import errno
+import hashlib
+import io
+import ipaddress
+import logging
+import marshal
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
 import six
 
-from pyparsing import (Literal, White, Word, alphanums, CharsNotIn, printables,
-                       Forward, Group, OneOrMore, ZeroOrMore,
-                       Suppress, pythonStyleComment, Regex)
+log = logging.getLogger(__name__)
+
+# $INCLUDE and the optional $-INCLUDE on a line of their own
+_INCLUDE = re.compile(r'^[ \t]*\$(-?)INCLUDE[ \t]+([^\s#]+)[^\n]*\n?', re.M)
+
+# Tokens of clients.conf as understood by ClientConfParser.client_file.
+# Whitespace and comments are skipped in front of every token, just like
+# pyparsing does with its default whitespace and ignore(pythonStyleComment).
+_SKIP = re.compile(r'(?:[ \t\r\n]+|#[^\n]*)*')
+_KEY = re.compile(r'[A-Za-z0-9_]+')
+_CLIENT_KEY = re.compile(r'[A-Za-z0-9\-_/.:]+')
+# printable ASCII without '#', '{' and '}'
+_VALUE = re.compile(r'[\x21\x22\x24-\x7a\x7c\x7e]+')
+_BRACE_OR_COMMENT = re.compile(r'#[^\n]*|[{}]')
+_COMMENT = re.compile(r'#[^\n]*')
+# where the resilient parser goes on after a broken client block
+_CLIENT_LINE = re.compile(r'^[ \t]*client\b', re.M)
+# the same tokens for scanning the bytes of a file
+_SKIP_BYTES = re.compile(_SKIP.pattern.encode("ascii"))
+_BRACE_OR_COMMENT_BYTES = re.compile(_BRACE_OR_COMMENT.pattern.encode("ascii"))
+# the start of a client block up to its client key
+_CLIENT_START = re.compile(r'client' + _SKIP.pattern
+                           + r'(' + _CLIENT_KEY.pattern + r')')
+_CLIENT_START_BYTES = re.compile(_CLIENT_START.pattern.encode("ascii"))
+
+# The size of the bounded packrat cache once enable_packrat() was called.
+# Packrat parsing is off by default, as the fast grammars hardly backtrack
+# and with pyparsing 3 the cache costs more time than it saves. It is a
+# process-wide switch of pyparsing, which applies to every pyparsing grammar
+# of the process, also to those of other libraries, and stays on.
+PACKRAT_CACHE_SIZE = None
+
+
+def enable_packrat(cache_size=128):
+    """
+    Enable packrat parsing with a bounded cache of cache_size entries for
+    all pyparsing grammars of the process. Later calls change nothing.
+    """
+    global PACKRAT_CACHE_SIZE
+    if PACKRAT_CACHE_SIZE is None:
+        from pyparsing import ParserElement
+        ParserElement.enablePackrat(cache_size)
+        PACKRAT_CACHE_SIZE = cache_size
+
+
+def _prepare_fast(content):
+    """
+    Remove the comments from content for the fast grammars. As "#" can not
+    be part of any token, this is the same as ignoring comments while
+    parsing.
+    """
+    return _COMMENT.sub(u"", content)
+
+
+class _Grammar(object):
+    """
+    An element of the pyparsing grammar of a parser class.
+
+    The grammar is built on first access by the function build, which
+    returns all elements of the grammar by name. Importing this module
+    therefore neither imports pyparsing nor builds any grammar.
+    """
+    _built = {}
+    _lock = threading.Lock()
+
+    def __init__(self, build, name):
+        self.build = build
+        self.name = name
+
+    def __get__(self, obj, cls):
+        grammar = self._built.get(self.build)
+        if grammar is None:
+            with self._lock:
+                grammar = self._built.get(self.build)
+                if grammar is None:
+                    grammar = self._built[self.build] = self.build()
+        return grammar[self.name]
+
+
+def _parse_exception(content, loc, msg):
+    from pyparsing import ParseException
+    return ParseException(content, loc, msg)
+
+
+def _split_blocks(content, pos=0):
+    """
+    Yield (start, end) of the top-level blocks of a clients.conf. A block
+    starts at its first token and ends behind its closing brace. Trailing
+    text which does not form a complete block is not yielded.
+    """
+    depth = 0
+    start = _SKIP.match(content, pos).end()
+    for m in _BRACE_OR_COMMENT.finditer(content, start):
+        if m.group() == "{":
+            depth += 1
+        elif m.group() == "}":
+            depth -= 1
+            if depth <= 0:
+                yield start, m.end()
+                depth = 0
+                start = _SKIP.match(content, m.end()).end()
+
+
+def _block_spans(content):
+    """
+    Like _split_blocks, but the trailing text which does not form a
+    complete block is yielded last.
+    """
+    pos = 0
+    for start, end in _split_blocks(content):
+        yield start, end
+        pos = end
+    pos = _SKIP.match(content, pos).end()
+    if pos < len(content):
+        yield pos, len(content)
+
+
+def _file_signature(filename):
+    """
+    :return: a tuple which changes whenever the file changes
+    """
+    st = os.stat(filename)
+    return (st.st_ino, getattr(st, "st_mtime_ns", st.st_mtime), st.st_size)
+
+
+class ParseCache(object):
+    """
+    A bounded LRU cache of parsed config files.
+
+    An entry is only used as long as the inode, mtime and size of the file
+    are unchanged. With use_hash=True the file contents are hashed as well,
+    which catches changes within the mtime resolution but costs a read.
+    """
+
+    def __init__(self, maxsize=32, use_hash=False):
+        self.maxsize = maxsize
+        self.use_hash = use_hash
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def signature(self, filename):
+        """
+        :return: a tuple which changes whenever the file changes
+        """
+        signature = _file_signature(filename)
+        if self.use_hash:
+            with open(filename, "rb") as f:
+                signature += (hashlib.sha1(f.read()).hexdigest(),)
+        return signature
+
+    def get(self, key, signature):
+        """
+        :return: the cached value for key or None if there is no entry or
+            the entry was stored with a different signature
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != signature:
+                return None
+            # reinsert to mark the entry as most recently used
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, signature, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (signature, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, filename=None):
+        """
+        Drop the entries of the given file or all entries.
+        """
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+                return
+            filename = os.path.abspath(filename)
+            for key in [k for k in self._entries if k[0] == filename]:
+                del self._entries[key]
+
+
+# a cache which parsers can share, pass it as cache
+default_cache = ParseCache()
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+class ParseStats(object):
+    """
+    Records where the time of a parser goes. The counters are summed up over
+    all calls, times are in seconds:
+
+    bytes_read, read_time: reading files
+    parse_time, blocks: parsing, the number of client blocks or users
+        entries
+    dict_time: building the result of get_dict() or get_entries()
+    format_time: formatting the config into the temporary file of save()
+    write_time, bytes_written: syncing and renaming the temporary file
+
+    callback(name, value) is called for every recorded value.
+    """
+    counters = ("bytes_read", "read_time", "parse_time", "blocks",
+                "dict_time", "format_time", "write_time", "bytes_written")
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        for name in self.counters:
+            setattr(self, name, 0)
+
+    def add(self, name, value):
+        setattr(self, name, getattr(self, name) + value)
+        if self.callback is not None:
+            self.callback(name, value)
+
+    def timer(self, name):
+        """
+        :return: a context manager adding its duration to the counter name
+        """
+        return _Timer(self, name)
+
+    def as_dict(self):
+        return OrderedDict((name, getattr(self, name))
+                           for name in self.counters)
+
+
+class _Timer(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add(self.name, _clock() - self.start)
+
+
+class _NoTimer(object):
+    """
+    The timer of a parser without stats
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class IncludeError(Exception):
+    """
+    An $INCLUDE cycle, too deeply nested includes or an $INCLUDE which can
+    not be resolved
+    """
+    pass
+
+
+class ConflictError(Exception):
+    """
+    The file changed since the version the caller read
+    """
+    pass
+
+
+# A part of a config which can not be parsed, line and column start at 1
+ParseError = namedtuple("ParseError", ["line", "column", "message"])
+
+
+def _parse_error(content, loc, message):
+    """
+    :return: the ParseError at the position loc of content
+    """
+    return ParseError(content.count(u"\n", 0, loc) + 1,
+                      loc - content.rfind(u"\n", 0, loc), message)
+
+
+def _entry_texts(lines):
+    """
+    Yield the text of each entry of a users file from its lines. An entry
+    starts with a line which does not start with whitespace or a comment.
+    """
+    entry = []
+    for line in lines:
+        if entry and line[:1] not in u" \t\r\n#":
+            yield u"".join(entry)
+            entry = []
+        entry.append(line)
+    if entry:
+        yield u"".join(entry)
+
+
+def _file_version(filename):
+    """
+    :return: the SHA-1 of the contents of the file or None if it does not
+        exist
+    """
+    try:
+        f = open(filename, "rb")
+    except (IOError, OSError):
+        if os.path.exists(filename):
+            raise
+        return None
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+
+# the errors of creating a file in a directory which is not writable
+_NOT_WRITABLE = (errno.EACCES, errno.EPERM)
+
+
+class _FileLock(object):
+    """
+    An exclusive advisory lock of a file, held with flock on a lock file
+    next to it, as the file itself is replaced on every save. flock also
+    excludes the threads of a process. Without fcntl nothing is locked.
+
+    If the lock file can not be created in the directory, the file itself
+    is locked. _AtomicFile then writes it in place.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        directory, name = os.path.split(os.path.abspath(filename))
+        self.lockfile = os.path.join(directory, "." + name + ".lock")
+        self._fd = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:  # pragma: no cover
+            return self
+        try:
+            self._fd = os.open(self.lockfile, os.O_RDONLY | os.O_CREAT,
+                               0o644)
+        except OSError as e:
+            if e.errno not in _NOT_WRITABLE or \
+                    not os.path.exists(self.filename):
+                raise
+            self._fd = os.open(self.filename, os.O_RDONLY)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(self._fd)
+            self._fd = None
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._fd is not None:
+            # releases the lock
+            os.close(self._fd)
+            self._fd = None
+
+
+class _AtomicFile(object):
+    """
+    A temporary file next to filename, which replaces filename once it is
+    closed without an error. Readers either see the old or the complete new
+    file, also after a crash. The permissions, the owner and the group of
+    an existing file are kept, the owner as far as allowed. A new file gets
+    the permissions of the umask.
+
+    If the directory is not writable, the contents are collected in memory
+    and filename is overwritten in place when it is closed.
+
+    Text is written as UTF-8, version is the SHA-1 of the written contents.
+    The time of syncing and renaming is recorded in the ParseStats stats.
+    """
+
+    def __init__(self, filename, stats=None):
+        self.filename = filename
+        self.stats = stats
+        self.size = 0
+        directory, name = os.path.split(os.path.abspath(filename))
+        self.directory = directory
+        try:
+            # a dotfile is skipped by $INCLUDE of the directory
+            fd, self.tmpfile = tempfile.mkstemp(dir=directory,
+                                                prefix="." + name + ".")
+            self._f = os.fdopen(fd, "wb")
+        except (IOError, OSError) as e:
+            if e.errno not in _NOT_WRITABLE or \
+                    not os.access(filename, os.W_OK):
+                raise
+            self.tmpfile = None
+            self._f = io.BytesIO()
+        self._sha1 = hashlib.sha1()
+
+    @property
+    def version(self):
+        return self._sha1.hexdigest()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode("utf-8")
+        self._sha1.update(data)
+        self.size += len(data)
+        self._f.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        start = _clock()
+        if self.tmpfile is None:
+            if exc_type is None:
+                self._write_in_place()
+                self._written(start)
+            return
+        try:
+            if exc_type is None:
+                self._f.flush()
+                os.fsync(self._f.fileno())
+            self._f.close()
+            if exc_type is None:
+                if os.path.exists(self.filename):
+                    self._copy_owner(os.stat(self.filename))
+                else:
+                    # mkstemp creates the file with 0600, a new file gets
+                    # the permissions open() would give it
+                    os.chmod(self.tmpfile, 0o666 & ~_umask())
+                os.rename(self.tmpfile, self.filename)
+                _fsync_directory(self.directory)
+                self._written(start)
+        finally:
+            if os.path.exists(self.tmpfile):
+                os.unlink(self.tmpfile)
+
+    def _copy_owner(self, st):
+        os.chmod(self.tmpfile, st.st_mode)
+        try:
+            os.chown(self.tmpfile, st.st_uid, st.st_gid)
+        except AttributeError:  # pragma: no cover
+            # not on Windows
+            pass
+        except OSError:
+            # only root may give a file away, keep at least the group
+            try:
+                os.chown(self.tmpfile, -1, st.st_gid)
+            except OSError:
+                pass
+
+    def _write_in_place(self):
+        f = open(self.filename, "wb")
+        try:
+            f.write(self._f.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def _written(self, start):
+        if self.stats is not None:
+            self.stats.add("write_time", _clock() - start)
+            self.stats.add("bytes_written", self.size)
+
+
+def _umask():
+    """
+    :return: the umask of the process, which can only be read by setting it
+    """
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def _fsync_directory(directory):
+    """
+    Make a rename in directory durable, where the platform allows it
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:  # pragma: no cover
+        return
+    try:
+        os.fsync(fd)
+    except OSError:  # pragma: no cover
+        pass
+    finally:
+        os.close(fd)
 
 
 class BaseParser(object):
+    file = None
+    cache = None
+    resolve_includes = False
+    max_include_depth = 16
+    includes = None
+    # the SHA-1 of the file as read by the last get()
+    version = None
+    resilient = False
+    # the ParseErrors of the last get() with resilient
+    errors = ()
+    snapshot = False
+    # changes whenever the data kept in snapshots changes
+    snapshot_version = 1
+    _content = None
+    # a ParseStats to instrument the parser
+    stats = None
+    # (event loop, config) -> the future of the get_dict() in progress
+    _pending = {}
+
+    def __getstate__(self):
+        """
+        A pickled parser, e.g. for a process pool, has no cache and no
+        stats, and the contents of a file are read again.
+        """
+        state = self.__dict__.copy()
+        state["cache"] = None
+        state["stats"] = None
+        if self.file:
+            state.pop("_content", None)
+        return state
+
+    @property
+    def content(self):
+        """
+        The contents of the config. A file is read on first access.
+        """
+        if self._content is None and self.file:
+            self._read()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
 
     def get(self):
         """
@@ -32,17 +584,682 @@ class BaseParser(object):
         :return: The formatted data as it would be written to a file
         '''
         return
-    
-    def save(self, dict_config=None, outfile=None):
-        if dict_config:
-            output = self.format(dict_config)
-            f = codecs.open(outfile, 'w', 'utf-8')
-            for line in output.splitlines():
-                f.write(line + "\n")
-            f.close()
 
+    def aget_dict(self, executor=None):
+        """
+        get_dict() for asyncio, to be awaited in a coroutine. The file is
+        read and parsed by executor, the default executor of the event loop
+        if None. A concurrent.futures.ProcessPoolExecutor moves the parsing
+        out of the process.
+
+        Concurrent calls for the same config share a single parse, each
+        caller gets a copy of the result of its own.
+
+        :return: an asyncio future of the result of get_dict()
+        """
+        import asyncio
+        loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)()
+        source = os.path.abspath(self.file) if self.file else self.signature()
+        # only callers with the same options may share the result
+        key = ((loop, source, self.resolve_includes, self.snapshot)
+               + self._cache_key(source)[1:])
+        shared = BaseParser._pending.get(key)
+        first = shared is None
+        if first:
+            shared = loop.run_in_executor(executor, _get_dict, self)
+            BaseParser._pending[key] = shared
+            shared.add_done_callback(
+                lambda f: BaseParser._pending.pop(key, None))
+        result = loop.create_future()
+
+        def done(f):
+            if result.cancelled():
+                return
+            if f.cancelled():
+                result.cancel()
+            elif f.exception() is not None:
+                result.set_exception(f.exception())
+            elif first:
+                result.set_result(f.result())
+            else:
+                result.set_result(copy.deepcopy(f.result()))
+        shared.add_done_callback(done)
+        return result
+
+    def asave(self, dict_config=None, outfile=None, executor=None, **kwargs):
+        """
+        save() for asyncio, to be awaited in a coroutine. The config is
+        formatted and written by executor, the default executor of the event
+        loop if None.
+
+        :return: an asyncio future which is done when the file is written
+        """
+        import asyncio
+        loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)()
+        return loop.run_in_executor(executor, _save, self, dict_config,
+                                    outfile, kwargs)
+
+    def signature(self):
+        """
+        :return: a value which changes whenever the config changes
+        """
+        if not self.file:
+            return hashlib.sha1(self.content.encode("utf-8")).hexdigest()
+        if self.cache is not None:
+            return self.cache.signature(self.file)
+        return _file_signature(self.file)
+
+    def invalidate(self):
+        """
+        Drop the cached parse result of the file, so that the next get()
+        reads and parses it again.
+        """
+        if self.cache is not None and self.file:
+            self.cache.invalidate(self.file)
+
+    def _parse(self, content):
+        """
+        :return: the grouped config parsed from content
+        """
+        return
+
+    def validate(self):
+        """
+        Parse the whole config and raise a ParseException at the first text
+        which is not part of it, while get() stops silently at the first
+        block which can not be parsed. $INCLUDE directives are skipped.
+        """
+        self._validate(self._without_includes())
+
+    def find_errors(self):
+        """
+        :return: the list of ParseErrors of all text which is not part of
+            the config, found in a single pass like with resilient.
+            $INCLUDE directives are skipped.
+        """
+        return self._parse_resilient(self._without_includes())[1]
+
+    def _without_includes(self):
+        """
+        :return: the content with blanks instead of $INCLUDE directives,
+            which keeps the lines and columns of the rest
+        """
+        return _INCLUDE.sub(lambda m: re.sub(r"[^\n]", u" ", m.group()),
+                            self.content)
+
+    def _validate(self, content):
+        pass
+
+    def _parse_resilient(self, content):
+        """
+        :return: (grouped config, list of ParseErrors) of content. Text
+            which can not be parsed is skipped up to the next block.
+        """
+        return [], []
+
+    def _parse_timed(self, content):
+        if self.stats is None:
+            return self._parse(content)
+        with self.stats.timer("parse_time"):
+            config = self._parse(content)
+        self.stats.add("blocks", len(config))
+        return config
+
+    def _timer(self, name):
+        """
+        :return: a context manager recording its duration in the stats
+        """
+        if self.stats is None:
+            return _NO_TIMER
+        return self.stats.timer(name)
+
+    def _cache_key(self, filename):
+        return os.path.abspath(filename), type(self).__name__
+
+    def _read(self):
+        """
+        Reread the contents from the disk
+        """
+        data = self._read_bytes(self.file)
+        self.version = hashlib.sha1(data).hexdigest()
+        self.content = data.decode("utf-8")
+
+    def _read_bytes(self, filename):
+        with self._timer("read_time"):
+            f = open(filename, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        if self.stats is not None:
+            self.stats.add("bytes_read", len(data))
+        return data
+
+    def _get_included(self):
+        """
+        Return the grouped config of the file with all $INCLUDE directives
+        resolved. With a cache the parts of each file are cached on their
+        own, so only the files which changed are parsed again.
+
+        The include graph is kept in includes, which maps each file to the
+        files and directories it includes.
+        """
+        self.includes = OrderedDict()
+        config = []
+        self._resolve(os.path.abspath(self.file), [], config)
+        # the errors of the included parts are not collected
+        self.errors = []
+        return config
+
+    def _resolve(self, filename, stack, config):
+        if filename in stack:
+            raise IncludeError("Include cycle: {0!s}".format(
+                " -> ".join(stack + [filename])))
+        if len(stack) > self.max_include_depth:
+            raise IncludeError("Includes nested deeper than {0:d} in "
+                               "{1!s}".format(self.max_include_depth,
+                                              filename))
+        parts = self._include_parts(filename)
+        self.includes[filename] = [p[1] for p in parts if p[0] != "config"]
+        stack.append(filename)
+        for kind, part in parts:
+            if kind == "config":
+                config.extend(part)
+            elif os.path.isdir(part):
+                for included in _expand_paths([part]):
+                    self._resolve(included, stack, config)
+            elif kind == "include" or os.path.exists(part):
+                self._resolve(part, stack, config)
+        stack.pop()
+
+    def _include_parts(self, filename):
+        """
+        :return: the parts of filename in their order, either
+            ("config", grouped config) of the text between the includes or
+            ("include", path) and ("optional", path) for $INCLUDE and
+            $-INCLUDE. Relative paths are relative to the directory of
+            filename.
+        """
+        if self.cache is not None:
+            key = self._cache_key(filename) + ("$INCLUDE",)
+            signature = self.cache.signature(filename)
+            parts = self.cache.get(key, signature)
+            if parts is not None:
+                return parts
+        content = self._read_bytes(filename).decode("utf-8")
+        parts = []
+        pos = 0
+        for m in self._iter_includes(content, filename):
+            parts.extend(self._config_part(content[pos:m.start()]))
+            path = os.path.join(os.path.dirname(filename), m.group(2))
+            parts.append(("optional" if m.group(1) else "include", path))
+            pos = m.end()
+        parts.extend(self._config_part(content[pos:]))
+        if self.cache is not None:
+            self.cache.set(key, signature, parts)
+        return parts
+
+    def _iter_includes(self, content, filename):
+        """
+        :return: the matches of _INCLUDE of the $INCLUDE directives in
+            content which are resolved
+        """
+        return _INCLUDE.finditer(content)
+
+    def _config_part(self, content):
+        if _SKIP.match(content).end() == len(content):
+            # only comments
+            return []
+        return [("config", self._parse_timed(content))]
+
+    def _get_cached(self):
+        """
+        Return the grouped config of the file. The file is only read and
+        parsed again if it changed since it was put into the cache.
+
+        The returned config is shared with other callers and must not be
+        modified.
+        """
+        if self.resolve_includes:
+            return self._get_included()
+        if self.cache is None:
+            self._read()
+            return self._parse_timed(self.content)
+        key = self._cache_key(self.file)
+        # stat before reading, so that a concurrent change is noticed on
+        # the next call at the latest
+        signature = self.cache.signature(self.file)
+        entry = self.cache.get(key, signature)
+        if entry is None:
+            self._read()
+            entry = (self._parse_timed(self.content), self.version,
+                     self.errors)
+            self.cache.set(key, signature, entry)
+        config, self.version, self.errors = entry
+        return config
+
+    def snapshot_file(self):
+        """
+        :return: the path of the snapshot of the file. It is a dotfile next
+            to the file, so that it is skipped by $INCLUDE of the directory.
+        """
+        directory, name = os.path.split(os.path.abspath(self.file))
+        return os.path.join(directory, "." + name + ".snapshot")
+
+    def _get_snapshot(self, build):
+        """
+        Return build(grouped config) of the file. The result is kept in the
+        snapshot of the file and in the cache, so the file is only parsed
+        again if its contents changed.
+
+        build has to return data which can be marshalled. Every call returns
+        a new copy of it.
+        """
+        if self.cache is None:
+            entry = self._snapshot(build)
+        else:
+            key = self._cache_key(self.file) + ("snapshot",)
+            signature = self.cache.signature(self.file)
+            entry = self.cache.get(key, signature)
+            if entry is None:
+                entry = self._snapshot(build)
+                self.cache.set(key, signature, entry)
+        self.version, data = entry
+        with self._timer("dict_time"):
+            return marshal.loads(data)
+
+    def _snapshot(self, build):
+        """
+        :return: the version of the file and the marshalled
+            build(grouped config) of it, read from the snapshot if it was
+            taken from the same contents and written to the snapshot
+            otherwise. The header of the snapshot ends with the SHA-1 of
+            the marshalled data, so a damaged snapshot is taken again.
+        """
+        source = self._read_bytes(self.file)
+        version = hashlib.sha1(source).hexdigest()
+        # marshal is only compatible within a Python version
+        header = u"freeradiusparser snapshot {0:d} {1!s} {2:d}.{3:d} " \
+                 u"{4!s} ".format(self.snapshot_version, type(self).__name__,
+                                  sys.version_info[0], sys.version_info[1],
+                                  version)
+        header = header.encode("ascii")
+        snapshot_file = self.snapshot_file()
+        try:
+            f = open(snapshot_file, "rb")
+            try:
+                snapshot = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            snapshot = b""
+        if snapshot.startswith(header):
+            digest, _, data = snapshot[len(header):].partition(b"\n")
+            if digest == hashlib.sha1(data).hexdigest().encode("ascii"):
+                return version, data
+        data = marshal.dumps(build(self._parse_timed(source.decode("utf-8"))))
+        digest = hashlib.sha1(data).hexdigest().encode("ascii")
+        try:
+            self._write_atomic(snapshot_file, header + digest + b"\n" + data)
+        except (IOError, OSError):
+            # the directory of the file is not writable, parse every time
+            pass
+        return version, data
+
+    def format_to(self, dict_config, fp):
+        """
+        Write the formatted data to the file-like object fp piece by piece
+        """
+        for fragment in self._iter_format(dict_config):
+            fp.write(fragment)
+
+    def _iter_format(self, dict_config):
+        """
+        Yield the formatted data in fragments
+        """
+        return iter(())
+
+    def save(self, dict_config=None, outfile=None, expected_version=None,
+             **kwargs):
+        """
+        Write dict_config to outfile, the file of the parser by default.
+
+        The file is locked while it is written and replaced atomically, so
+        that concurrent writers do not interleave and readers never see a
+        partial file.
+
+        :param expected_version: The version of outfile the changes are
+            based on, usually the version of the last get(). If outfile
+            changed since, ConflictError is raised and nothing is written.
+        """
+        if not dict_config:
+            return
+        outfile = outfile or self.file
+        with _FileLock(outfile):
+            self._check_version(outfile, expected_version)
+            self._write_config(dict_config, outfile, **kwargs)
+
+    @contextlib.contextmanager
+    def transaction(self, **kwargs):
+        """
+        Edit the config of the file and save all changes with a single
+        write. The file is locked for the whole transaction:
+
+            with parser.transaction() as config:
+                config["new"] = {"ipaddr": "10.0.0.1", "secret": "s"}
+                del config["old"]
+
+        Nothing is written if the block raises an exception or leaves the
+        config unchanged.
+
+        :param kwargs: Passed on to save(), like patch=True
+        """
+        with _FileLock(self.file):
+            if os.path.exists(self.file):
+                config = self.get_dict()
+                original = copy.deepcopy(config)
+                version = self.version
+            else:
+                config, original, version = OrderedDict(), None, None
+            yield config
+            if config != original:
+                self._check_version(self.file, version)
+                self._write_config(config, self.file, **kwargs)
+
+    @staticmethod
+    def _check_version(outfile, expected_version):
+        if expected_version is None:
+            return
+        version = _file_version(outfile)
+        if version != expected_version:
+            raise ConflictError("{0!s} changed since version {1!s}, it is "
+                                "now version {2!s}".format(
+                                    outfile, expected_version, version))
+
+    def _write_config(self, dict_config, outfile):
+        """
+        Replace outfile by the formatted dict_config, without locking it
+        """
+        with _AtomicFile(outfile, self.stats) as f:
+            with self._timer("format_time"):
+                self.format_to(dict_config, f)
+        self._written(outfile, f.version)
+
+    def _written(self, outfile, version):
+        if self.file and os.path.abspath(outfile) == os.path.abspath(
+                self.file):
+            self.version = version
+
+    @staticmethod
+    def _write_atomic(outfile, output, stats=None):
+        """
+        Replace outfile by output atomically, text is written as UTF-8.
+
+        :return: the version of the new outfile
+        """
+        with _AtomicFile(outfile, stats) as f:
+            f.write(output)
+        return f.version
+
+
+class _NoMatch(Exception):
+    def __init__(self, loc, msg):
+        Exception.__init__(self, msg)
+        self.loc = loc
+        self.msg = msg
+
+
+class _ClientConfReader(object):
+    """
+    Hand-written recursive descent parser for clients.conf.
+
+    It accepts the same input as ClientConfParser.client_file and returns
+    the same nested structure, but as plain lists instead of ParseResults.
+    Like the pyparsing grammar it stops silently at the first client block
+    which can not be parsed and only fails if there is no client block at
+    all.
+    """
+
+    def __init__(self, content):
+        self.content = content
+
+    def parse(self, strict=False):
+        """
+        :param strict: Fail at the first client block which can not be
+            parsed instead of stopping there
+        """
+        blocks = []
+        pos = 0
+        while True:
+            try:
+                block, pos = self.client_block(pos)
+            except _NoMatch as e:
+                if not blocks or (strict
+                                  and self.skip(pos) < len(self.content)):
+                    raise _parse_exception(self.content, e.loc, e.msg)
+                return blocks
+            blocks.append(block)
+
+    def skip(self, pos):
+        return _SKIP.match(self.content, pos).end()
+
+    def token(self, regex, pos, name):
+        pos = self.skip(pos)
+        m = regex.match(self.content, pos)
+        if not m:
+            raise _NoMatch(pos, "Expected {0!s}".format(name))
+        return m.group(), m.end()
+
+    def literal(self, literal, pos):
+        pos = self.skip(pos)
+        if not self.content.startswith(literal, pos):
+            raise _NoMatch(pos, "Expected '{0!s}'".format(literal))
+        return pos + len(literal)
+
+    def client_block(self, pos):
+        pos = self.literal("client", pos)
+        client_key, pos = self.token(_CLIENT_KEY, pos, "client key")
+        pos = self.literal("{", pos)
+        attributes = []
+        while True:
+            try:
+                attribute, pos = self.attribute(pos)
+            except _NoMatch:
+                break
+            attributes.append(attribute)
+        pos = self.literal("}", pos)
+        return [client_key, attributes], pos
+
+    def attribute(self, pos):
+        key, pos = self.token(_KEY, pos, "key")
+        start = self.skip(pos)
+        if self.content.startswith("=", start):
+            value, pos = self.token(_VALUE, start + 1, "value")
+            return [key, value], pos
+        if self.content.startswith("{", start):
+            section, pos = self.section(start)
+            return [key, section], pos
+        name, pos = self.token(_KEY, start, "'=' or '{'")
+        section, pos = self.section(pos)
+        return [key, [[name, section]]], pos
+
+    def section(self, pos):
+        pos = self.literal("{", pos)
+        assignments = []
+        while True:
+            try:
+                key, end = self.token(_KEY, pos, "key")
+                end = self.literal("=", end)
+                value, end = self.token(_VALUE, end, "value")
+            except _NoMatch:
+                break
+            assignments.append([key, value])
+            pos = end
+        pos = self.literal("}", pos)
+        return assignments, pos
+
+
+class ClientConfNode(object):
+    """
+    A node of the ClientConfTree of a clients.conf: a client block, a
+    section or an assignment. Only the positions in the text are stored.
+
+    start and end are the span of the node. The text from lead to start
+    is the trivia in front of the node: whitespace, blank lines and
+    comments. value_start and value_end are the span of the value of an
+    assignment or of the text between the braces of a client or section.
+    children is None for assignments.
+    """
+    __slots__ = ("key", "name", "value", "children", "lead", "start", "end",
+                 "value_start", "value_end")
+
+    def __init__(self, key, name, value, children, lead, start, end,
+                 value_start, value_end):
+        self.key = key
+        self.name = name
+        self.value = value
+        self.children = children
+        self.lead = lead
+        self.start = start
+        self.end = end
+        self.value_start = value_start
+        self.value_end = value_end
+
+    def attributes(self):
+        """
+        :return: the attributes of a client or section like in get_dict()
+        """
+        attributes = {}
+        for child in self.children:
+            if child.children is None:
+                attributes[child.key] = child.value
+            elif child.name is None:
+                attributes[child.key] = child.attributes()
+            else:
+                attributes[child.key] = {child.name: child.attributes()}
+        return attributes
+
+
+class _ClientConfTreeReader(_ClientConfReader):
+    """
+    The native reader returning ClientConfNodes with their positions
+    """
+
+    def client_node(self, pos):
+        start = self.skip(pos)
+        end = self.literal("client", start)
+        client_key, end = self.token(_CLIENT_KEY, end, "client key")
+        body = self.literal("{", end)
+        children = []
+        end = body
+        while True:
+            try:
+                child = self.attribute_node(end)
+            except _NoMatch:
+                break
+            children.append(child)
+            end = child.end
+        close = self.skip(end)
+        end = self.literal("}", end)
+        return ClientConfNode(client_key, None, None, children, pos, start,
+                              end, body, close)
+
+    def attribute_node(self, pos):
+        start = self.skip(pos)
+        key, end = self.token(_KEY, start, "key")
+        end = self.skip(end)
+        if self.content.startswith("=", end):
+            value_start = self.skip(end + 1)
+            value, end = self.token(_VALUE, value_start, "value")
+            return ClientConfNode(key, None, value, None, pos, start, end,
+                                  value_start, end)
+        if self.content.startswith("{", end):
+            return self.section_node(key, None, pos, start, end)
+        name, end = self.token(_KEY, end, "'=' or '{'")
+        return self.section_node(key, name, pos, start, end)
+
+    def section_node(self, key, name, lead, start, pos):
+        body = self.literal("{", pos)
+        children = []
+        end = body
+        while True:
+            try:
+                child_start = self.skip(end)
+                child_key, child_end = self.token(_KEY, child_start, "key")
+                value_start = self.skip(self.literal("=", child_end))
+                value, child_end = self.token(_VALUE, value_start, "value")
+            except _NoMatch:
+                break
+            children.append(ClientConfNode(child_key, None, value, None, end,
+                                           child_start, child_end,
+                                           value_start, child_end))
+            end = child_end
+        close = self.skip(end)
+        end = self.literal("}", end)
+        return ClientConfNode(key, name, None, children, lead, start, end,
+                              body, close)
+
+
+class ClientConfTree(object):
+    """
+    The lossless parse result of a clients.conf. The text is kept, the
+    client blocks, sections and assignments are ClientConfNodes pointing
+    into it, so that comments, blank lines and indentation survive
+    changes.
+    """
+
+    def __init__(self, content):
+        """
+        :param content: The text of a clients.conf. Like get() parsing
+            stops at the first client block which can not be parsed.
+        """
+        self.content = content
+        self.clients = []
+        reader = _ClientConfTreeReader(content)
+        pos = 0
+        while True:
+            try:
+                node = reader.client_node(pos)
+            except _NoMatch as e:
+                if not self.clients and reader.skip(pos) < len(content):
+                    raise _parse_exception(content, e.loc, e.msg)
+                break
+            self.clients.append(node)
+            pos = node.end
+
+    def get_dict(self):
+        """
+        :return: the clients like ClientConfParser.get_dict()
+        """
+        return dict((node.key, node.attributes()) for node in self.clients)
+
+    def text(self, dict_config=None):
+        """
+        :param dict_config: The changed result of get_dict()
+        :return: the text with the changes of dict_config. Only the
+            values, lines and blocks which changed are touched, all other
+            text is kept as it is.
+        """
+        if dict_config is None:
+            return self.content
+        config = self.get_dict()
+        changes = OrderedDict((k, None) for k in config
+                              if k not in dict_config)
+        changes.update((k, v) for k, v in dict_config.items()
+                       if config.get(k) != v)
+        return ClientConfParser._apply_changes(
+            self.content, [(node.key, node.start, node.end)
+                           for node in self.clients], changes)
+
+
+def _client_conf_grammar():
+    """
+    :return: the elements of the grammars of ClientConfParser by name
+    """
+    from pyparsing import (Literal, White, Word, alphanums, printables,
+                           Forward, Group, OneOrMore, ZeroOrMore,
+                           Suppress, pythonStyleComment, Regex)
 
-class ClientConfParser(BaseParser):
     key = Word(alphanums + "_")
     client_key = Word(alphanums + "-_/.:")
     LBRACE, RBRACE, EQUALS, HASH = map(Suppress, '{}=#')
@@ -62,114 +1279,1093 @@ class ClientConfParser(BaseParser):
                           + RBRACE)
     client_file = OneOrMore(client_block).ignore(pythonStyleComment)
 
+    # The same grammar with combined regular expressions for the content
+    # without comments, see _prepare_fast
+    fast_assignment = Group(Regex(
+        r'(?P<key>[A-Za-z0-9_]+)[ \t\r\n]*=[ \t\r\n]*'
+        r'(?P<value>[\x21\x22\x24-\x7a\x7c\x7e]+)'
+    ).setParseAction(lambda t: [t["key"], t["value"]]))
+    fast_intern_section = (Suppress("{")
+                           + ZeroOrMore(fast_assignment)
+                           + Suppress("}"))
+    fast_sections = Group(Word(alphanums + "_")
+                          + Group(fast_intern_section
+                                  | Group(Word(alphanums + "_")
+                                          + Group(fast_intern_section))))
+    fast_client_block = Group(Suppress("client")
+                              + Word(alphanums + "-_/.:")
+                              + Suppress("{")
+                              + Group(ZeroOrMore(fast_assignment
+                                                 | fast_sections))
+                              + Suppress("}"))
+    fast_client_file = OneOrMore(fast_client_block)
+
+    return {
+        "key": key,
+        "client_key": client_key,
+        "LBRACE": LBRACE,
+        "RBRACE": RBRACE,
+        "EQUALS": EQUALS,
+        "HASH": HASH,
+        "space": space,
+        "value": value,
+        "assignment": assignment,
+        "intern_section": intern_section,
+        "named_section": named_section,
+        "sections": sections,
+        "client_block": client_block,
+        "client_file": client_file,
+        "fast_assignment": fast_assignment,
+        "fast_intern_section": fast_intern_section,
+        "fast_sections": fast_sections,
+        "fast_client_block": fast_client_block,
+        "fast_client_file": fast_client_file,
+    }
+
+
+class ClientConfParser(BaseParser):
+    key = _Grammar(_client_conf_grammar, "key")
+    client_key = _Grammar(_client_conf_grammar, "client_key")
+    LBRACE = _Grammar(_client_conf_grammar, "LBRACE")
+    RBRACE = _Grammar(_client_conf_grammar, "RBRACE")
+    EQUALS = _Grammar(_client_conf_grammar, "EQUALS")
+    HASH = _Grammar(_client_conf_grammar, "HASH")
+    space = _Grammar(_client_conf_grammar, "space")
+    value = _Grammar(_client_conf_grammar, "value")
+    assignment = _Grammar(_client_conf_grammar, "assignment")
+    intern_section = _Grammar(_client_conf_grammar, "intern_section")
+    named_section = _Grammar(_client_conf_grammar, "named_section")
+    sections = _Grammar(_client_conf_grammar, "sections")
+    client_block = _Grammar(_client_conf_grammar, "client_block")
+    client_file = _Grammar(_client_conf_grammar, "client_file")
+    # The same grammar with combined regular expressions for the content
+    # without comments, see _prepare_fast
+    fast_assignment = _Grammar(_client_conf_grammar, "fast_assignment")
+    fast_intern_section = _Grammar(_client_conf_grammar, "fast_intern_section")
+    fast_sections = _Grammar(_client_conf_grammar, "fast_sections")
+    fast_client_block = _Grammar(_client_conf_grammar, "fast_client_block")
+    fast_client_file = _Grammar(_client_conf_grammar, "fast_client_file")
+
     file_header = """# File parsed and saved by privacyidea.\n\n"""
     
+    backends = ("pyparsing", "native")
+
     def __init__(self,
                  infile="/etc/freeradius/clients.conf",
-                 content=None):
+                 content=None,
+                 backend="pyparsing",
+                 cache=None,
+                 incremental=False,
+                 resolve_includes=False,
+                 fast=False,
+                 snapshot=False,
+                 stats=None,
+                 resilient=False):
+        """
+        :param infile: The clients.conf to read. It is read on first access
+            to content, e.g. by get(), so a missing or unreadable infile
+            raises an IOError there and not here.
+        :param content: The contents of a clients.conf, used instead of infile
+        :param backend: "pyparsing" to use the grammar of this class or
+            "native" to use the faster hand-written parser. Both return the
+            same config, but get() of the native backend returns it as
+            nested lists instead of a ParseResults, like get() with
+            incremental, resolve_includes or resilient. Use get_dict() for
+            the same result with every option.
+        :param cache: A ParseCache for the parsed infile, like
+            default_cache. get() then returns the cached config, which is
+            shared with the other parsers of the cache and must not be
+            modified. By default every get() reads and parses infile.
+        :param incremental: Parse the config block by block and only parse
+            the client blocks again which changed since the last get(). The
+            positions of the blocks are kept in block_offsets.
+        :param resolve_includes: Read the files of top-level $INCLUDE
+            directives as part of infile. An $INCLUDE inside a client block
+            raises an IncludeError. With a cache only the files which
+            changed are parsed again, without one every get() reads and
+            parses all of them.
+        :param fast: Use the fast grammar with the pyparsing backend. It
+            returns the same config.
+        :param snapshot: Keep the result of get_dict() in a snapshot next to
+            infile, which is loaded instead of parsing infile again as long
+            as the contents of infile are unchanged. It is not used with
+            resolve_includes.
+        :param stats: A ParseStats recording where the time goes
+        :param resilient: Skip the client blocks which can not be parsed
+            instead of stopping at the first one. The ParseErrors of the
+            last get() are kept in errors. The blocks are parsed by the
+            native backend.
+        """
+        if backend not in self.backends:
+            raise ValueError("Unknown backend: {0!s}".format(backend))
+        self.backend = backend
+        self.cache = cache
+        self.resolve_includes = resolve_includes
+        self.fast = fast
+        self.snapshot = snapshot
+        self.stats = stats
+        self.resilient = resilient
+        self.errors = []
+        self.incremental = incremental
+        self.block_offsets = []
+        self._parsed_blocks = {}
+        # the state of the bulk changes, see add_clients
+        self._model = None
         self.file = None
         if content:
             self.content = content
         else:
             self.file = infile
-            self._read()
 
-    def _read(self):
-        """
-        Reread the contents from the disk
-        """
-        f = codecs.open(self.file, "r", "utf-8")
-        self.content = f.read()
-        f.close()
-        
     def get(self):
         """
         return the grouped config
         """
         if self.file:
-            self._read()
-        config = self.client_file.parseString(self.content)
+            return self._get_cached()
+        return self._parse_timed(self.content)
+
+    def _parse(self, content):
+        if self.resilient:
+            config, self.errors = self._parse_resilient(content)
+            return config
+        if self.incremental:
+            return self._parse_incremental(content)
+        if self.backend == "native":
+            return _ClientConfReader(content).parse()
+        if self.fast:
+            return self.fast_client_file.parseString(_prepare_fast(content))
+        return self.client_file.parseString(content)
+
+    def _cache_key(self, filename):
+        return (os.path.abspath(filename), type(self).__name__, self.backend,
+                self.incremental, self.fast, self.resilient)
+
+    def _parse_block(self, content):
+        """
+        :return: the grouped config of the single client block in content
+        """
+        if self.backend == "native":
+            try:
+                return _ClientConfReader(content).client_block(0)[0]
+            except _NoMatch as e:
+                raise _parse_exception(content, e.loc, e.msg)
+        if self.fast:
+            return self.fast_client_block.parseString(
+                _prepare_fast(content))[0]
+        return self.client_block.parseString(content)[0]
+
+    def _iter_includes(self, content, filename):
+        """
+        Only top-level $INCLUDE directives are resolved, one inside a client
+        block raises an IncludeError.
+        """
+        depth = 0
+        pos = 0
+        for m in _INCLUDE.finditer(content):
+            for token in _BRACE_OR_COMMENT.finditer(content, pos, m.start()):
+                if token.group() == "{":
+                    depth += 1
+                elif token.group() == "}":
+                    depth = max(depth - 1, 0)
+            if depth:
+                raise IncludeError("$INCLUDE inside a block in {0!s} line "
+                                   "{1:d} is not supported".format(
+                                       filename,
+                                       content.count(u"\n", 0,
+                                                     m.start()) + 1))
+            pos = m.end()
+            yield m
+
+    def _validate(self, content):
+        # the hand-written parser accepts the same input as the grammar
+        _ClientConfReader(content).parse(strict=True)
+
+    def _parse_resilient(self, content):
+        """
+        A client block which can not be parsed is skipped up to the next
+        line starting with "client". Every block is parsed once.
+        """
+        reader = _ClientConfReader(content)
+        config = []
+        errors = []
+        pos = reader.skip(0)
+        while pos < len(content):
+            try:
+                block, pos = reader.client_block(pos)
+                config.append(block)
+            except _NoMatch as e:
+                errors.append(_parse_error(content, e.loc, e.msg))
+                m = _CLIENT_LINE.search(content, pos + 1)
+                if m is None:
+                    break
+                pos = m.start()
+            pos = reader.skip(pos)
+        return config, errors
+
+    def _iter_blocks(self, chunk_size):
+        """
+        Yield the text of the top-level blocks, reading the file in chunks.
+        Text after the last complete block is yielded last.
+        """
+        if not self.file:
+            content = self.content
+            for start, end in _block_spans(content):
+                yield content[start:end]
+            return
+        rest = u""
+        f = codecs.open(self.file, "r", "utf-8")
+        try:
+            chunk = f.read(chunk_size)
+            while chunk:
+                rest += chunk
+                pos = 0
+                for start, end in _split_blocks(rest):
+                    yield rest[start:end]
+                    pos = end
+                rest = rest[pos:]
+                chunk = f.read(chunk_size)
+        finally:
+            f.close()
+        rest = rest[_SKIP.match(rest).end():]
+        if rest:
+            yield rest
+
+    def _iter_parsed_blocks(self, blocks, parsed=None):
+        """
+        Yield (text, grouped config) for the given block texts. Blocks found
+        in the dictionary parsed are not parsed again.
+
+        Like get() this stops at the first client block which can not be
+        parsed and raises a ParseException if there is no client block at
+        all.
+        """
+        from pyparsing import ParseException
+        first = True
+        for block in blocks:
+            client = parsed.get(block) if parsed is not None else None
+            if client is None:
+                try:
+                    client = self._parse_block(block)
+                except ParseException:
+                    if first:
+                        raise
+                    return
+            first = False
+            yield block, client
+        if first:
+            raise ParseException(u"", 0, "Expected 'client'")
+
+    def _parse_incremental(self, content):
+        """
+        Parse content block by block and reuse the results of all blocks
+        which are unchanged since the last call. A moved block is unchanged
+        as well.
+        """
+        spans = list(_block_spans(content))
+        parsed = {}
+        config = []
+        offsets = []
+        blocks = self._iter_parsed_blocks(
+            (content[start:end] for start, end in spans), self._parsed_blocks)
+        for (block, client), (start, end) in zip(blocks, spans):
+            parsed[block] = client
+            config.append(client)
+            offsets.append((client[0], start, end))
+        self._parsed_blocks = parsed
+        self.block_offsets = offsets
         return config
-    
+
+    def iter_clients(self, chunk_size=65536):
+        """
+        Yield (client_key, attributes) for each client, one block at a time.
+
+        The file is read in chunks of chunk_size, so only the current block
+        is held in memory. Like get() iterating stops at the first client
+        block which can not be parsed and raises a ParseException if there
+        is no client block at all.
+        """
+        for _block, client in self._iter_parsed_blocks(
+                self._iter_blocks(chunk_size)):
+            yield client[0], ClientConfParser._client_config(client)
+
     def get_dict(self):
         '''
         return the client config as a dictionary.
         '''
-        ret = {}
+        if self.snapshot and self.file and not self.resolve_includes:
+            return self._get_snapshot(ClientConfParser._config_dict)
         config = self.get()
+        with self._timer("dict_time"):
+            return ClientConfParser._config_dict(config)
+
+    def get_tree(self):
+        """
+        :return: the ClientConfTree of the file, which keeps comments and
+            formatting. $INCLUDE directives are not resolved.
+        """
+        if self.file:
+            self._read()
+        return ClientConfTree(self.content)
+
+    @staticmethod
+    def _config_dict(config):
+        ret = {}
         for client in config:
-            client_key = client.pop(0)
-            client_config = {}
-            for attribute in client:
-                client_config.update(ClientConfParser._parse_entry(attribute))
-            ret[client_key] = client_config
+            ret[client[0]] = ClientConfParser._client_config(client)
         return ret
 
-    def dump(self):
-        conf = self.get() or {}
-        for client in conf:
-            print("%s: %s" % (client[0], client[1]))
+    def dump(self):
+        conf = self.get() or {}
+        for client in conf:
+            print("%s: %s" % (client[0], client[1]))
+
+    def format(self, dict_config):
+        '''
+        :return: The formatted data as it would be written to a file
+        '''
+        output = io.StringIO()
+        self.format_to(dict_config, output)
+        return output.getvalue()
+
+    def _iter_format(self, dict_config):
+        yield six.text_type(self.file_header)
+        for client, attributes in dict_config.items():
+            for fragment in ClientConfParser._iter_format_client(client,
+                                                                 attributes):
+                yield fragment
+            yield u"\n\n"
+
+    def save(self, dict_config=None, outfile=None, expected_version=None,
+             patch=False):
+        """
+        Write dict_config to outfile, see BaseParser.save.
+
+        :param patch: Only change the values and lines of the existing
+            outfile which changed, remove the blocks of the clients missing
+            in dict_config and append new clients. Comments and formatting
+            of everything else are kept, see ClientConfTree.
+        """
+        BaseParser.save(self, dict_config, outfile, expected_version,
+                        patch=patch)
+
+    def _write_config(self, dict_config, outfile, patch=False):
+        if not patch:
+            return BaseParser._write_config(self, dict_config, outfile)
+        if os.path.exists(outfile):
+            f = codecs.open(outfile, "r", "utf-8")
+            content = f.read()
+            f.close()
+        else:
+            content = u""
+        with self._timer("format_time"):
+            output = self._patch(content, dict_config)
+        self._written(outfile, self._write_atomic(outfile, output,
+                                                  self.stats))
+
+    def _patch(self, content, dict_config):
+        """
+        :return: content with the client blocks changed to dict_config
+        """
+        from pyparsing import ParseException
+        output = []
+        pos = 0
+        seen = set()
+        spans = list(_block_spans(content))
+        blocks = self._iter_parsed_blocks(
+            (content[start:end] for start, end in spans), self._parsed_blocks)
+        try:
+            for (block, client), (start, end) in zip(blocks, spans):
+                output.append(content[pos:start])
+                pos = end
+                client_key = client[0]
+                seen.add(client_key)
+                if client_key not in dict_config:
+                    # drop the line break of the removed block as well
+                    if content.startswith(u"\n", end):
+                        pos += 1
+                elif (dict_config[client_key]
+                      == ClientConfParser._client_config(client)):
+                    output.append(block)
+                else:
+                    output.append(ClientConfParser._edit_client(
+                        block, dict_config[client_key]))
+        except ParseException:
+            # there is no client block in content
+            pass
+        output.append(content[pos:])
+        ClientConfParser._append_clients(
+            output, [(c, dict_config[c]) for c in dict_config
+                     if c not in seen])
+        return u"".join(output)
+
+    @staticmethod
+    def _append_clients(output, clients):
+        """
+        Append the blocks of the list of (client_key, attributes) to the
+        list of text fragments output, separated by empty lines.
+        """
+        tail = u"".join(output[-2:])
+        if clients and tail and not tail.endswith(u"\n"):
+            output.append(u"\n")
+        separator = u"\n" if tail else u""
+        for client_key, attributes in clients:
+            output.append(separator)
+            separator = u"\n"
+            output.append(ClientConfParser._format_client(client_key,
+                                                          attributes))
+            output.append(u"\n")
+
+    def add_clients(self, clients):
+        """
+        Add new clients. Like the other bulk changes the clients are changed
+        in memory only, until commit() writes all changes at once. The
+        file is parsed once by the first change.
+
+        :param clients: An iterable of (client_key, attributes) or a
+            dictionary
+        :raises ValueError: if a client already exists. Then none of the
+            clients is added.
+        """
+        config, _changes = self._bulk_model()
+        clients = self._bulk_items(clients)
+        seen = set()
+        for client_key, _attributes in clients:
+            if client_key in config or client_key in seen:
+                raise ValueError("The client {0!s} already exists".format(
+                    client_key))
+            seen.add(client_key)
+        for client_key, attributes in clients:
+            self._bulk_change(client_key, attributes)
+
+    def update_clients(self, clients):
+        """
+        Change attributes of existing clients. Attributes which are not
+        given are kept.
+
+        :param clients: An iterable of (client_key, attributes) or a
+            dictionary
+        :raises KeyError: if a client does not exist. Then none of the
+            clients is changed.
+        """
+        config, _changes = self._bulk_model()
+        clients = self._bulk_items(clients)
+        for client_key, _attributes in clients:
+            if client_key not in config:
+                raise KeyError(client_key)
+        for client_key, attributes in clients:
+            updated = dict(config[client_key])
+            updated.update(attributes)
+            self._bulk_change(client_key, updated)
+
+    def upsert(self, clients):
+        """
+        Add new clients and replace the attributes of existing clients.
+
+        :param clients: An iterable of (client_key, attributes) or a
+            dictionary
+        """
+        self._bulk_model()
+        for client_key, attributes in self._bulk_items(clients):
+            self._bulk_change(client_key, attributes)
+
+    def remove_clients(self, client_keys):
+        """
+        Remove clients.
+
+        :param client_keys: An iterable of client keys
+        :raises KeyError: if a client does not exist. Then none of the
+            clients is removed.
+        """
+        config, _changes = self._bulk_model()
+        client_keys = list(client_keys)
+        seen = set()
+        for client_key in client_keys:
+            if client_key not in config or client_key in seen:
+                raise KeyError(client_key)
+            seen.add(client_key)
+        for client_key in client_keys:
+            self._bulk_change(client_key, None)
+
+    def commit(self, outfile=None):
+        """
+        Write the changes of add_clients, update_clients, upsert and
+        remove_clients with a single write. Only the blocks of the changed
+        clients are formatted, all other text of the file is kept.
+
+        :param outfile: The file to write, the file of the parser by default
+        :raises ConflictError: if the file of the parser changed since the
+            first change
+        :raises ValueError: if there is neither outfile nor a file of the
+            parser
+        :return: the ChangeEvent of the clients which were added, removed
+            or modified
+        """
+        outfile = outfile or self.file
+        if not outfile:
+            raise ValueError("commit() needs an outfile for a parser of "
+                             "content")
+        self._bulk_model()
+        config, changes, original, offsets, content, version = self._model
+        summary = ChangeEvent([k for k in changes if k not in original],
+                              [k for k in changes if k not in config],
+                              [k for k in changes
+                               if k in original and k in config],
+                              config)
+        if changes:
+            with _FileLock(outfile):
+                if self.file and os.path.abspath(outfile) == \
+                        os.path.abspath(self.file):
+                    self._check_version(outfile, version)
+                with self._timer("format_time"):
+                    output = self._apply_changes(content, offsets, changes)
+                self._written(outfile, self._write_atomic(outfile, output,
+                                                          self.stats))
+        self._model = None
+        return summary
+
+    def rollback(self):
+        """
+        Forget the changes which are not committed yet.
+        """
+        self._model = None
+
+    @staticmethod
+    def _bulk_items(clients):
+        """
+        :return: the list of (client_key, attributes) of clients, with
+            attributes copied into new dictionaries
+        """
+        if isinstance(clients, dict):
+            clients = clients.items()
+        return [(client_key, dict(attributes))
+                for client_key, attributes in clients]
+
+    def _bulk_change(self, client_key, attributes):
+        """
+        Set the attributes of a client or remove it with None. A client
+        which is changed back to its original attributes is unchanged.
+        """
+        config, changes, original = self._model[:3]
+        if attributes is None:
+            del config[client_key]
+        else:
+            config[client_key] = attributes
+        if original.get(client_key) == attributes:
+            changes.pop(client_key, None)
+        else:
+            changes[client_key] = attributes
+
+    def _bulk_model(self):
+        """
+        :return: (config, changes) of the bulk changes. config is the
+            ordered dictionary of all clients with the changes applied,
+            changes maps each changed client key to its new attributes or
+            None for removed clients.
+        """
+        from pyparsing import ParseException
+        if self._model is None:
+            if not self.file:
+                content = self.content
+            elif os.path.exists(self.file):
+                self._read()
+                content = self.content
+            else:
+                content = u""
+                self.version = None
+            original = OrderedDict()
+            offsets = []
+            spans = list(_block_spans(content))
+            blocks = self._iter_parsed_blocks(
+                (content[start:end] for start, end in spans))
+            try:
+                for (_block, client), (start, end) in zip(blocks, spans):
+                    original[client[0]] = ClientConfParser._client_config(
+                        client)
+                    offsets.append((client[0], start, end))
+            except ParseException:
+                # there is no client block in content
+                pass
+            self._model = (OrderedDict(original), OrderedDict(), original,
+                           offsets, content, self.version)
+        return self._model[0], self._model[1]
+
+    @staticmethod
+    def _apply_changes(content, offsets, changes):
+        """
+        :return: content with the blocks of the changed clients replaced,
+            removed or appended
+        """
+        output = []
+        pos = 0
+        written = set()
+        for client_key, start, end in offsets:
+            output.append(content[pos:start])
+            pos = end
+            if client_key not in changes:
+                output.append(content[start:end])
+            elif changes[client_key] is None or client_key in written:
+                # drop the line break of the removed block as well
+                if content.startswith(u"\n", end):
+                    pos += 1
+            else:
+                output.append(ClientConfParser._edit_client(
+                    content[start:end], changes[client_key]))
+                written.add(client_key)
+        output.append(content[pos:])
+        ClientConfParser._append_clients(
+            output, [(k, v) for k, v in changes.items()
+                     if v is not None and k not in written])
+        return u"".join(output)
+
+    @staticmethod
+    def _edit_client(block, attributes):
+        """
+        :return: the text of the client block changed to attributes with
+            as few edits as possible
+        """
+        try:
+            node = _ClientConfTreeReader(block).client_node(0)
+        except _NoMatch:  # pragma: no cover
+            # parsed by another backend
+            return ClientConfParser._format_client(
+                ClientConfParser._block_key(block), attributes)
+        output = []
+        ClientConfParser._edit_node(block, node, attributes, output)
+        return u"".join(output)
+
+    @staticmethod
+    def _block_key(block):
+        return _CLIENT_KEY.match(block, _SKIP.match(
+            block, len("client")).end()).group()
+
+    @staticmethod
+    def _edit_node(content, node, attributes, output):
+        """
+        Append the text of the client or section node changed to attributes
+        to the list output. Changed values are replaced, removed attributes
+        are cut out with their line and new attributes are inserted in
+        front of the closing brace with the indentation of their siblings.
+        """
+        old = node.attributes()
+        output.append(content[node.start:node.value_start])
+        pos = node.value_start
+        last = dict((child.key, i) for i, child in enumerate(node.children))
+        indent = None
+        for i, child in enumerate(node.children):
+            line_start = content.rfind(u"\n", 0, child.start) + 1
+            if not content[line_start:child.start].strip():
+                indent = content[line_start:child.start]
+            if child.key not in attributes:
+                start, end = ClientConfParser._line_span(content, child, pos)
+                output.append(content[pos:start])
+                pos = end
+                continue
+            output.append(content[pos:child.start])
+            pos = child.end
+            value = attributes[child.key]
+            if last[child.key] != i or old[child.key] == value:
+                output.append(content[child.start:child.end])
+            elif child.children is None and isinstance(value,
+                                                       six.string_types):
+                output.append(content[child.start:child.value_start])
+                output.append(value)
+            elif (child.children is not None and child.name is None
+                  and isinstance(value, dict)
+                  and all(isinstance(v, six.string_types)
+                          for v in value.values())):
+                ClientConfParser._edit_node(content, child, value, output)
+            elif (child.children is not None and child.name is not None
+                  and isinstance(value, dict) and list(value) == [child.name]
+                  and isinstance(value[child.name], dict)):
+                ClientConfParser._edit_node(content, child,
+                                            value[child.name], output)
+            else:
+                unit = u"\t" if u"\t" in (indent or u"") else u"    "
+                output.append(ClientConfParser._format_attribute(
+                    child.key, value, u"", unit).rstrip(u"\n").replace(
+                        u"\n", u"\n" + (indent or u"")))
+        new = [(k, v) for k, v in attributes.items() if k not in old]
+        if new:
+            line_start = content.rfind(u"\n", 0, node.value_end) + 1
+            if line_start > pos and \
+                    not content[line_start:node.value_end].strip():
+                # in front of the line of the closing brace
+                insert = line_start
+                prefix = u""
+            else:
+                insert = node.value_end
+                prefix = u"\n"
+            output.append(content[pos:insert])
+            pos = insert
+            outer = content[line_start:node.value_end] if insert == \
+                line_start else u""
+            unit = u"\t" if u"\t" in (indent or outer) else u"    "
+            if indent is None:
+                indent = outer + unit
+            output.append(prefix)
+            for k, v in new:
+                output.append(ClientConfParser._format_attribute(
+                    k, v, indent, unit))
+            if prefix:
+                output.append(outer)
+        output.append(content[pos:node.end])
+
+    @staticmethod
+    def _line_span(content, node, pos):
+        """
+        :return: the span of the line of node including its line break if
+            nothing but whitespace and a comment shares the line, otherwise
+            the span of node
+        """
+        line_start = content.rfind(u"\n", 0, node.start) + 1
+        line_end = content.find(u"\n", node.end)
+        if line_end < 0:
+            line_end = len(content)
+        if line_start >= pos and not content[line_start:node.start].strip() \
+                and _COMMENT.sub(u"", content[node.end:line_end]).strip() \
+                == u"":
+            return line_start, min(line_end + 1, len(content))
+        return node.start, node.end
+
+    @staticmethod
+    def _format_attribute(key, value, indent, unit):
+        """
+        :return: the lines of the attribute key with the indentation indent
+            and unit for each level below
+        """
+        lines = []
+        for line in ClientConfParser._format_entry({key: value}).splitlines():
+            stripped = line.lstrip(u" ")
+            level = (len(line) - len(stripped)) // 4 - 1
+            lines.append(indent + unit * level + stripped + u"\n")
+        return u"".join(lines)
+
+    @staticmethod
+    def _format_client(client, attributes):
+        return u"".join(ClientConfParser._iter_format_client(client,
+                                                             attributes))
+
+    @staticmethod
+    def _iter_format_client(client, attributes):
+        yield u"client %s {\n" % client
+        for fragment in ClientConfParser._iter_format_entry(attributes):
+            yield fragment
+        yield u"}"
+
+    @staticmethod
+    def _client_config(client):
+        client_config = {}
+        for attribute in client[1:]:
+            client_config.update(ClientConfParser._parse_entry(attribute))
+        return client_config
+
+    @staticmethod
+    def _parse_entry(e):
+        if isinstance(e, six.text_type):
+            return e
+        if isinstance(e, six.string_types):  # pragma: no cover
+            return e.decode()
+        if len(e) == 0:
+            return {}
+        return {k: ClientConfParser._parse_entry(v) for k, v in e}
+
+    @staticmethod
+    def _format_entry(e, s=False, lvl=4):
+        return u"".join(ClientConfParser._iter_format_entry(e, s=s, lvl=lvl))
+
+    @staticmethod
+    def _iter_format_entry(e, s=False, lvl=4):
+        if len(e) == 0 and s:
+            yield u' {\n'
+        for k, v in e.items():
+            if isinstance(v, dict):
+                if s:
+                    yield u' {0!s} {{\n'.format(k)
+                    for fragment in ClientConfParser._iter_format_entry(
+                            v, s=False, lvl=lvl):
+                        yield fragment
+                else:
+                    yield u' ' * lvl + u'{0!s}'.format(k)
+                    for fragment in ClientConfParser._iter_format_entry(
+                            v, s=True, lvl=lvl + 4):
+                        yield fragment
+                    yield u' ' * lvl + u'}\n'
+            elif isinstance(v, six.string_types):
+                if s:
+                    yield u' {\n'
+                    s = False
+                yield u' ' * lvl + u'{0!s} = {1!s}\n'.format(k, v)
+            else:  # pragma: no cover
+                print('Error formatting freeradius client entry: '
+                      'Unknown type: ' + str(type(v)) + ' ' + str(e))
+
+
+class ClientIndex(object):
+    """
+    Find the client of an IP address by longest prefix match.
+
+    The networks of the clients are taken from ipaddr, ipv4addr or ipv6addr
+    together with netmask, or from the client key in the 1.x style like
+    "192.168.0.0/24". Clients given by a host name are not indexed. The
+    networks are stored in a binary trie per address family, so a lookup
+    takes at most 32 or 128 steps regardless of the number of clients.
+    """
+
+    address_attributes = ("ipaddr", "ipv4addr", "ipv6addr")
+
+    def __init__(self, parser, auto_refresh=True):
+        """
+        :param parser: The ClientConfParser to index
+        :param auto_refresh: Check for changes of the config on every lookup
+        """
+        self.parser = parser
+        self.auto_refresh = auto_refresh
+        # a node is [child for bit 0, child for bit 1, client keys]. Clients
+        # with the same network share a node, the last one in the file wins
+        # like in get_dict().
+        self._tries = {4: [None, None, []], 6: [None, None, []]}
+        self._clients = {}
+        self._positions = {}
+        self._networks = {}
+        self._signature = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Update the index if the config changed. Only the networks of clients
+        which were added, removed or modified are touched.
+        """
+        signature = self.parser.signature()
+        if signature == self._signature:
+            return
+        clients = self.parser.get_dict()
+        for client_key, attributes in self._clients.items():
+            if clients.get(client_key) != attributes:
+                self._remove(client_key)
+        self._positions = dict((client_key, i)
+                               for i, client_key in enumerate(clients))
+        for client_key, attributes in clients.items():
+            if client_key not in self._networks:
+                self._add(client_key, attributes)
+        self._clients = clients
+        self._signature = signature
+
+    def lookup(self, address):
+        """
+        :param address: An IPv4 or IPv6 address
+        :return: (client_key, attributes) of the client with the longest
+            network containing address or None
+        """
+        if self.auto_refresh:
+            self.refresh()
+        address = ipaddress.ip_address(six.text_type(address))
+        bits = int(address)
+        node = self._tries[address.version]
+        client_key = node[2][-1] if node[2] else None
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(bits >> i) & 1]
+            if node is None:
+                break
+            if node[2]:
+                client_key = node[2][-1]
+        if client_key is None:
+            return None
+        return client_key, self._clients[client_key]
+
+    @classmethod
+    def networks(cls, client_key, attributes):
+        """
+        :return: the list of networks of a client
+        """
+        addresses = [(a, attributes[a]) for a in cls.address_attributes
+                     if a in attributes]
+        if not addresses:
+            addresses = [("ipaddr", client_key)]
+        networks = []
+        for attribute, address in addresses:
+            if address == "*":
+                address = "::/0" if attribute == "ipv6addr" else "0.0.0.0/0"
+            elif "/" not in address and "netmask" in attributes:
+                address = u"{0!s}/{1!s}".format(address,
+                                                attributes["netmask"])
+            try:
+                networks.append(ipaddress.ip_network(six.text_type(address),
+                                                     strict=False))
+            except ValueError:
+                # a host name
+                pass
+        return networks
+
+    def _add(self, client_key, attributes):
+        networks = self.networks(client_key, attributes)
+        for network in networks:
+            node = self._tries[network.version]
+            bits = int(network.network_address)
+            for i in range(network.max_prefixlen - 1,
+                           network.max_prefixlen - network.prefixlen - 1, -1):
+                bit = (bits >> i) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, []]
+                node = node[bit]
+            # keep the order of the file
+            position = self._positions.get(client_key, len(self._positions))
+            keys = node[2]
+            i = len(keys)
+            while i and self._positions.get(keys[i - 1], 0) > position:
+                i -= 1
+            keys.insert(i, client_key)
+        self._networks[client_key] = networks
+
+    def _remove(self, client_key):
+        for network in self._networks.pop(client_key, []):
+            path = [self._tries[network.version]]
+            bits = int(network.network_address)
+            for i in range(network.max_prefixlen - 1,
+                           network.max_prefixlen - network.prefixlen - 1, -1):
+                node = path[-1][(bits >> i) & 1]
+                if node is None:
+                    break
+                path.append(node)
+            if len(path) <= network.prefixlen:
+                # the node of the network is already gone
+                continue
+            if client_key in path[-1][2]:
+                path[-1][2].remove(client_key)
+            # prune the nodes which are no longer needed
+            for i in range(network.prefixlen, 0, -1):
+                if path[i] != [None, None, []]:
+                    break
+                bit = (bits >> (network.max_prefixlen - i)) & 1
+                path[i - 1][bit] = None
+
+
+class MappedClientConf(object):
+    """
+    Read-only access to the clients of a large clients.conf without reading
+    it into memory.
+
+    The file is memory-mapped and the boundaries of the client blocks are
+    found by scanning its bytes. Only the client keys are decoded up front.
+    The block of a client is decoded and parsed when the client is looked
+    up. Blocks which do not start with "client" and a client key are
+    skipped, a broken client block raises a ParseException when it is
+    looked up. $INCLUDE directives are not resolved.
+    """
+
+    def __init__(self, infile="/etc/freeradius/clients.conf"):
+        """
+        :param infile: The clients.conf to map
+        """
+        self.file = infile
+        # client key -> (start, end) of its block
+        self._blocks = OrderedDict()
+        f = open(infile, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size:
+                self._data = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            else:
+                # an empty file can not be mapped
+                self._data = b""
+        finally:
+            f.close()
+        self._scan()
+
+    def _scan(self):
+        data = self._data
+        depth = 0
+        start = _SKIP_BYTES.match(data).end()
+        for m in _BRACE_OR_COMMENT_BYTES.finditer(data, start):
+            if m.group() == b"{":
+                depth += 1
+            elif m.group() == b"}":
+                depth -= 1
+                if depth <= 0:
+                    client = _CLIENT_START_BYTES.match(data, start)
+                    if client is not None:
+                        # the client key is ASCII
+                        self._blocks[client.group(1).decode("ascii")] = (
+                            start, m.end())
+                    depth = 0
+                    start = _SKIP_BYTES.match(data, m.end()).end()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, client_key):
+        return client_key in self._blocks
+
+    def __iter__(self):
+        return iter(self._blocks)
+
+    def keys(self):
+        """
+        :return: the client keys in the order of the file
+        """
+        return list(self._blocks)
+
+    def __getitem__(self, client_key):
+        start, end = self._blocks[client_key]
+        content = self._data[start:end].decode("utf-8")
+        try:
+            client, _pos = _ClientConfReader(content).client_block(0)
+        except _NoMatch as e:
+            # keep the line of the error in the file
+            lines = self._data.count(b"\n", 0, start) if isinstance(
+                self._data, bytes) else self._data[:start].count(b"\n")
+            raise _parse_exception(u"\n" * lines + content, lines + e.loc,
+                                   e.msg)
+        return ClientConfParser._client_config(client)
+
+    def get(self, client_key, default=None):
+        """
+        :return: the attributes of the client like in get_dict() or default
+        """
+        if client_key not in self._blocks:
+            return default
+        return self[client_key]
+
+    def items(self):
+        """
+        Yield (client_key, attributes) for each client, decoding one block
+        at a time.
+        """
+        for client_key in self._blocks:
+            yield client_key, self[client_key]
 
-    def format(self, dict_config):
-        '''
-        :return: The formatted data as it would be written to a file
-        '''
-        output = u""
-        output += self.file_header
-        for client, attributes in dict_config.items():
-            output += u"client %s {\n" % client
-            output += ClientConfParser._format_entry(attributes)
-            output += u"}\n\n"
-        return output
 
-    @staticmethod
-    def _parse_entry(e):
-        if isinstance(e, six.text_type):
-            return e
-        if isinstance(e, six.string_types):  # pragma: no cover
-            return e.decode()
-        if len(e) == 0:
-            return {}
-        return {k: ClientConfParser._parse_entry(v) for k, v in e}
+# One attribute of a users file entry, like Auth-Type := perl
+AttributeItem = namedtuple("AttributeItem", ["attribute", "operator", "value"])
+# One entry of a users file with tuples of AttributeItem
+UserEntry = namedtuple("UserEntry", ["username", "check_items", "reply_items"])
 
-    @staticmethod
-    def _format_entry(e, s=False, lvl=4):
-        ret = ''
-        if len(e) == 0 and s:
-            ret += u' {\n'
-        for k, v in e.items():
-            if isinstance(v, dict):
-                if s:
-                    ret += u' {0!s} {{\n'.format(k) \
-                           + ClientConfParser._format_entry(v, s=False,
-                                                            lvl=lvl)
-                else:
-                    ret += u' ' * lvl + u'{0!s}'.format(k) \
-                           + ClientConfParser._format_entry(v, s=True,
-                                                            lvl=lvl + 4) \
-                           + u' ' * lvl + u'}\n'
-            elif isinstance(v, six.string_types):
-                if s:
-                    ret += u' {\n'
-                    s = False
-                ret += u' ' * lvl + u'{0!s} = {1!s}\n'.format(k, v)
-            else:  # pragma: no cover
-                print('Error formatting freeradius client entry: '
-                      'Unknown type: ' + str(type(v)) + ' ' + str(e))
-        return ret
 
+def _users_grammar():
+    """
+    :return: the elements of the grammars of UserConfParser by name
+    """
+    from pyparsing import (White, Word, alphanums, CharsNotIn, Forward,
+                           Group, OneOrMore, ZeroOrMore,
+                           pythonStyleComment, Regex)
 
-class UserConfParser(BaseParser):
-    
     key = Word(alphanums + "-")
     username = Word(alphanums + "@_.-/")
     client_key = Word(alphanums + "-_/.:")
     space = White().suppress()
-    comma = ","
     value = CharsNotIn("{}\n#, ")
-    comment = "#"
     # operator = ":="
-    operator = Regex(r":=|==|=|\+=|!=|>|>=|<|<=|=~|!~|=\*|!\*")
+    operator = Regex(r":=|==|=~|=\*|=|\+=|!=|!~|!\*|>=|>|<=|<")
     assignment = Group(space
                        + key
                        + space.suppress()
@@ -177,7 +2373,7 @@ class UserConfParser(BaseParser):
                        + space.suppress()
                        + value
                        + ZeroOrMore(space).suppress()
-                       + ZeroOrMore(comma).suppress())
+                       + ZeroOrMore(",").suppress())
     user_block = Forward()
     # USERNAME key operator value
     # <tab> key operator value
@@ -188,23 +2384,111 @@ class UserConfParser(BaseParser):
                         + space
                         + value
                         + Group(ZeroOrMore(assignment)))
-    
+
     user_file = OneOrMore(user_block).ignore(pythonStyleComment)
+
+    # The same grammar with combined regular expressions, see
+    # UserConfParser.fast_operator
+    fast_operator = UserConfParser.fast_operator
+    fast_user_line = Regex(
+        r'(?P<username>[A-Za-z0-9@_./-]+)[ \t\r\n]+(?P<key>[A-Za-z0-9-]+)'
+        r'[ \t\r\n]*' + fast_operator + r'[ \t\r\n]+(?P<value>[^{}\n#, ]+)'
+    ).setParseAction(lambda t: [t["username"], t["key"], t["operator"],
+                                t["value"]])
+    fast_assignment = Group(Regex(
+        r'[ \t\r\n]+(?P<key>[A-Za-z0-9-]+)[ \t\r\n]+' + fast_operator
+        + r'[ \t\r\n]+(?P<value>[^{}\n#, ]+)[ \t\r\n]*(?:[ \t\r\n]*,)*'
+    ).leaveWhitespace().setParseAction(lambda t: [t["key"], t["operator"],
+                                                  t["value"]]))
+    fast_user_file = OneOrMore(Group(fast_user_line
+                                     + Group(ZeroOrMore(fast_assignment))))
+
+    return {
+        "key": key,
+        "username": username,
+        "client_key": client_key,
+        "space": space,
+        "value": value,
+        "operator": operator,
+        "assignment": assignment,
+        "user_block": user_block,
+        "user_file": user_file,
+        "fast_user_line": fast_user_line,
+        "fast_assignment": fast_assignment,
+        "fast_user_file": fast_user_file,
+    }
+
+
+class UserConfParser(BaseParser):
+    
+    key = _Grammar(_users_grammar, "key")
+    username = _Grammar(_users_grammar, "username")
+    client_key = _Grammar(_users_grammar, "client_key")
+    space = _Grammar(_users_grammar, "space")
+    comma = ","
+    value = _Grammar(_users_grammar, "value")
+    comment = "#"
+    operator = _Grammar(_users_grammar, "operator")
+    assignment = _Grammar(_users_grammar, "assignment")
+    user_block = _Grammar(_users_grammar, "user_block")
+    user_file = _Grammar(_users_grammar, "user_file")
+    # The same grammar with combined regular expressions for the content
+    # without comments, see _prepare_fast. The lookahead makes the operator
+    # match like the Regex above, which does not try the later alternatives
+    # once one matched.
+    fast_operator = (r'(?=(?P<operator>:=|==|=~|=\*|=|\+=|!=|!~|!\*|>=|>|'
+                     r'<=|<))(?P=operator)')
+    fast_user_line = _Grammar(_users_grammar, "fast_user_line")
+    fast_assignment = _Grammar(_users_grammar, "fast_assignment")
+    fast_user_file = _Grammar(_users_grammar, "fast_user_file")
     
     file_header = """# File parsed and saved by privacyidea.\n\n"""
     
     def __init__(self,
                  infile="/etc/freeradius/users",
-                 content=None):
+                 content=None,
+                 cache=None,
+                 resolve_includes=False,
+                 fast=False,
+                 snapshot=False,
+                 stats=None,
+                 resilient=False):
+        """
+        :param infile: The users file to read. It is read on first access
+            to content, e.g. by get(), so a missing or unreadable infile
+            raises an IOError there and not here.
+        :param content: The contents of a users file, used instead of infile
+        :param cache: A ParseCache for the parsed infile, like
+            default_cache. get() then returns the cached config, which is
+            shared with the other parsers of the cache and must not be
+            modified. By default every get() reads and parses infile.
+        :param resolve_includes: Read the files of $INCLUDE directives as
+            part of infile. With a cache only the files which changed are
+            parsed again, without one every get() reads and parses all of
+            them.
+        :param fast: Use the fast grammar. It returns the same config.
+        :param snapshot: Keep the result of get_entries() in a snapshot next
+            to infile, which is loaded instead of parsing infile again as
+            long as the contents of infile are unchanged. It is not used
+            with resolve_includes.
+        :param stats: A ParseStats recording where the time goes
+        :param resilient: Skip the entries which can not be parsed instead
+            of stopping at the first one. The ParseErrors of the last get()
+            are kept in errors.
+        """
+        self.cache = cache
+        self.resolve_includes = resolve_includes
+        self.fast = fast
+        self.snapshot = snapshot
+        self.stats = stats
+        self.resilient = resilient
+        self.errors = []
         self.file = None
         if content:
             self.content = content
         else:
             self.file = infile
-            f = codecs.open(self.file, "r", "utf-8")
-            self.content = f.read()
-            f.close()
-            
+
     def get(self):
         """
         return the grouped config
@@ -216,32 +2500,1255 @@ class UserConfParser(BaseParser):
         ['DEFAULT', 'Hint', '==', '"SLIP"', [['Framed-Protocol', '=', 'SLIP']]]
         ]
         """
-        config = self.user_file.parseString(self.content)
-        return config
+        if self.file:
+            return self._get_cached()
+        return self._parse_timed(self.content)
+
+    def _parse(self, content):
+        if self.resilient:
+            config, self.errors = self._parse_resilient(content)
+            return config
+        if self.fast:
+            return self.fast_user_file.parseString(_prepare_fast(content))
+        return self.user_file.parseString(content)
+
+    def _cache_key(self, filename):
+        return (os.path.abspath(filename), type(self).__name__, self.fast,
+                self.resilient)
+
+    def _validate(self, content):
+        self.user_file.parseString(content, parseAll=True)
+
+    def _parse_resilient(self, content):
+        """
+        An entry which can not be parsed is skipped up to the next line
+        which does not start with whitespace or a comment. Every entry is
+        parsed once.
+        """
+        from pyparsing import ParseException
+        config = []
+        errors = []
+        line = 1
+        for text in _entry_texts(io.StringIO(content)):
+            if _SKIP.match(text).end() < len(text):
+                try:
+                    if self.fast:
+                        config.extend(self.fast_user_file.parseString(
+                            _prepare_fast(text), parseAll=True))
+                    else:
+                        config.extend(self.user_file.parseString(
+                            text, parseAll=True))
+                except ParseException:
+                    try:
+                        # the fast grammar does not know the positions in
+                        # text, as it parses text without the comments
+                        config.extend(self.user_file.parseString(
+                            text, parseAll=True))
+                    except ParseException as e:
+                        errors.append(ParseError(line + e.lineno - 1, e.col,
+                                                 e.msg))
+            line += text.count(u"\n")
+        return config, errors
+
+    def _iter_entry_texts(self):
+        """
+        Yield the text of each entry, reading the file line by line. An
+        entry starts with a line which does not start with whitespace or a
+        comment.
+        """
+        if self.file:
+            lines = codecs.open(self.file, "r", "utf-8")
+        else:
+            lines = io.StringIO(self.content)
+        try:
+            for text in _entry_texts(lines):
+                yield text
+        finally:
+            lines.close()
+
+    def iter_entries(self):
+        """
+        Yield the entries of the users file as UserEntry records, one entry
+        at a time, so that only the current entry is held in memory. Like
+        get() iterating stops at the first entry which can not be parsed
+        and raises a ParseException if there is no entry at all.
+        """
+        from pyparsing import ParseException
+        names = {}
+        first = True
+        for text in self._iter_entry_texts():
+            if _SKIP.match(text).end() == len(text):
+                # only comments
+                continue
+            try:
+                users = self._parse_timed(text)
+            except ParseException:
+                if first:
+                    raise
+                return
+            first = False
+            for user in users:
+                yield UserConfParser._entry(user, names)
+        if first:
+            raise ParseException(u"", 0, "Expected username")
+
+    def get_entries(self):
+        """
+        return the entries of the users file in their order as UserEntry
+        records, which do not keep the parse results alive.
+        """
+        if self.snapshot and self.file and not self.resolve_includes:
+            return [UserEntry(username, tuple(AttributeItem(*item)
+                                              for item in check_items),
+                              tuple(AttributeItem(*item)
+                                    for item in reply_items))
+                    for username, check_items, reply_items
+                    in self._get_snapshot(UserConfParser._entry_tuples)]
+        config = self.get()
+        with self._timer("dict_time"):
+            return UserConfParser._entries(config)
+
+    @staticmethod
+    def _entries(config):
+        # share the strings of attribute names and operators, they repeat
+        # all over a users file
+        names = {}
+        return [UserConfParser._entry(user, names) for user in config]
+
+    @staticmethod
+    def _entry_tuples(config):
+        """
+        :return: the entries as plain tuples, which can be marshalled. The
+            shared strings stay shared.
+        """
+        return [(entry.username, tuple(map(tuple, entry.check_items)),
+                 tuple(map(tuple, entry.reply_items)))
+                for entry in UserConfParser._entries(config)]
 
     def get_dict(self):
-        pass
+        """
+        return the users file as an ordered dictionary, which maps each
+        username to the list of its entries. DEFAULT entries are found under
+        "DEFAULT".
+        """
+        ret = OrderedDict()
+        for entry in self.get_entries():
+            ret.setdefault(entry.username, []).append(entry)
+        return ret
 
     def dump(self):
-        pass
+        for entry in self.get_entries():
+            print("%s: %s %s" % (entry.username,
+                                 [list(item) for item in entry.check_items],
+                                 [list(item) for item in entry.reply_items]))
+
+    @staticmethod
+    def _entry(user, names):
+        check_item = AttributeItem(names.setdefault(user[1], user[1]),
+                                   names.setdefault(user[2], user[2]),
+                                   user[3])
+        return UserEntry(user[0], (check_item,), tuple(
+            AttributeItem(names.setdefault(attribute, attribute),
+                          names.setdefault(operator, operator), value)
+            for attribute, operator, value in user[4]))
 
     def format(self, config):
         '''
+        :param config: The result of get() or get_entries(). The result of
+            get_dict() is written user by user.
         :return: The formatted data as it would be written to a file
         '''
-        output = ""
-        output += self.file_header
+        output = io.StringIO()
+        self.format_to(config, output)
+        return output.getvalue()
+
+    def _iter_format(self, config):
+        yield six.text_type(self.file_header)
+        if isinstance(config, dict):
+            config = [entry for entries in config.values()
+                      for entry in entries]
         for user in config:
-            output += "%s %s %s %s\n" % (user[0], user[1], user[2], user[3])
-            if len(user[4]):
+            if isinstance(user, UserEntry):
+                yield u"%s %s\n" % (user.username, u", ".join(
+                    u"%s %s %s" % item for item in user.check_items))
+                reply_items = user.reply_items
+            else:
+                yield u"%s %s %s %s\n" % (user[0], user[1], user[2],
+                                          user[3])
+                reply_items = user[4]
+            if len(reply_items):
                 i = 0
-                for reply_item in user[4]:
+                for reply_item in reply_items:
                     i += 1
-                    output += "\t%s %s %s" % (reply_item[0],
-                                              reply_item[1],
-                                              reply_item[2])
-                    if i < len(user[4]):
-                        output += ","
-                    output += "\n"
-            output += "\n"
-        return output
+                    yield u"\t%s %s %s" % (reply_item[0],
+                                           reply_item[1],
+                                           reply_item[2])
+                    if i < len(reply_items):
+                        yield u","
+                    yield u"\n"
+            yield u"\n"
+
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == value[-1] == u'"':
+        return value[1:-1]
+    return value
+
+
+def _number(value):
+    """
+    :return: value as int for the comparison operators, if it is one.
+        Values which are not both numbers are compared as strings.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def _compile_check(item):
+    """
+    :return: a function which takes the tuple of the values of the
+        attribute of the check item in a request, or None if the request
+        does not have it, and returns whether the check item matches. None
+        for the check items which set a control item and always match.
+    """
+    operator = item.operator
+    value = _unquote(item.value)
+    if operator in (u":=", u"=", u"+="):
+        return None
+    if operator == u"==":
+        return lambda values: values is not None and value in values
+    if operator == u"!=":
+        return lambda values: values is not None and value not in values
+    if operator == u"=*":
+        return lambda values: values is not None
+    if operator == u"!*":
+        return lambda values: values is None
+    if operator in (u"=~", u"!~"):
+        try:
+            search = re.compile(value).search
+        except re.error as e:
+            log.warning(u"Invalid regular expression {0!s} of {1!s}: "
+                        u"{2!s}".format(value, item.attribute, e))
+            return lambda values: False
+        if operator == u"=~":
+            return lambda values: (values is not None
+                                   and any(search(v) for v in values))
+        return lambda values: (values is not None
+                               and not any(search(v) for v in values))
+    compare = UserMatcher.comparisons[operator]
+    number = _number(value)
+
+    def check(v):
+        other = _number(v)
+        if isinstance(other, int) and isinstance(number, int):
+            return compare(other, number)
+        # not both numbers, compare the strings
+        return compare(v, value)
+    return lambda values: values is not None and any(
+        check(v) for v in values)
+
+
+class UserMatcher(object):
+    """
+    Find the entries of a users file which match a request, like the files
+    module of FreeRADIUS does.
+
+    The entries are tried in the order of the file. An entry matches if its
+    username is the User-Name of the request or DEFAULT and all its check
+    items match. The first matching entry ends the search unless its reply
+    items contain Fall-Through = Yes.
+
+    The entries are compiled once: the entries of usernames are indexed by
+    username, DEFAULT entries with an == check item are indexed by the
+    attribute and the value of their first one, and regular expressions
+    are compiled. So a request only tries the entries of its User-Name,
+    the DEFAULT entries whose first == check item has a value of the
+    request and the other DEFAULT entries.
+    """
+
+    comparisons = {
+        u">": lambda a, b: a > b,
+        u">=": lambda a, b: a >= b,
+        u"<": lambda a, b: a < b,
+        u"<=": lambda a, b: a <= b,
+    }
+
+    def __init__(self, parser, auto_refresh=True):
+        """
+        :param parser: The UserConfParser of the users file
+        :param auto_refresh: Check for changes of the users file on every
+            match
+        """
+        self.parser = parser
+        self.auto_refresh = auto_refresh
+        # (entry, [(attribute, check)], fall through) by position
+        self._entries = []
+        self._users = {}
+        # attribute -> value -> positions of DEFAULT entries
+        self._defaults = {}
+        # positions of DEFAULT entries without a == check item
+        self._other_defaults = []
+        self._signature = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Compile the entries again if the users file changed.
+        """
+        signature = self.parser.signature()
+        if signature == self._signature:
+            return
+        self._entries = []
+        self._users = {}
+        self._defaults = {}
+        self._other_defaults = []
+        # the same check items repeat in DEFAULT entries
+        compiled = {}
+        for position, entry in enumerate(self.parser.get_entries()):
+            indexed = None
+            if entry.username != u"DEFAULT":
+                self._users.setdefault(entry.username, []).append(position)
+            else:
+                for item in entry.check_items:
+                    if item.operator == u"==":
+                        self._defaults.setdefault(item.attribute, {}) \
+                            .setdefault(_unquote(item.value), []) \
+                            .append(position)
+                        indexed = item
+                        break
+                else:
+                    self._other_defaults.append(position)
+            checks = []
+            for item in entry.check_items:
+                # the index already checked it
+                if item is not indexed:
+                    if item not in compiled:
+                        compiled[item] = _compile_check(item)
+                    if compiled[item] is not None:
+                        checks.append((item.attribute, compiled[item]))
+            fall_through = any(
+                item.attribute == u"Fall-Through"
+                and _unquote(item.value).lower() == u"yes"
+                for item in entry.reply_items)
+            self._entries.append((entry, checks, fall_through))
+        self._signature = signature
+
+    def match(self, request):
+        """
+        :param request: A dictionary of the attributes of a request. A
+            value is a string or a list of the strings of an attribute which
+            occurs several times.
+        :return: the list of the matching UserEntry records in their order
+        """
+        if self.auto_refresh:
+            self.refresh()
+        return self._match(self._values(request))
+
+    def match_all(self, requests):
+        """
+        :param requests: An iterable of requests like for match()
+        :return: the list of the results of match() for each request
+        """
+        if self.auto_refresh:
+            self.refresh()
+        return [self._match(self._values(request)) for request in requests]
+
+    @staticmethod
+    def _values(request):
+        return dict((attribute, (value,) if isinstance(
+                     value, six.string_types) else tuple(value))
+                    for attribute, value in request.items())
+
+    def _match(self, values):
+        username = values.get(u"User-Name", (None,))[0]
+        positions = list(self._users.get(username, ()))
+        positions.extend(self._other_defaults)
+        for attribute, index in self._defaults.items():
+            for value in values.get(attribute, ()):
+                positions.extend(index.get(value, ()))
+        matches = []
+        for position in sorted(set(positions)):
+            entry, checks, fall_through = self._entries[position]
+            if all(check(values.get(attribute))
+                   for attribute, check in checks):
+                matches.append(entry)
+                if not fall_through:
+                    break
+        return matches
+
+
+# The merged config of several files. sources maps each client key to the
+# file it was read from, or each username to the files of its entries.
+ParsedFiles = namedtuple("ParsedFiles", ["config", "sources"])
+
+
+def _expand_paths(paths):
+    """
+    Replace directories in paths by the files they contain, in alphabetical
+    order. Hidden files and editor backups ending with "~" are skipped.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path))
+                         if not name.startswith(".")
+                         and not name.endswith("~")
+                         and os.path.isfile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    return files
+
+
+def _parse_file(parser_class, path, kwargs):
+    return parser_class(infile=path, **kwargs).get_dict()
+
+
+def _get_dict(parser):
+    return parser.get_dict()
+
+
+def _save(parser, dict_config, outfile, kwargs):
+    parser.save(dict_config, outfile, **kwargs)
+
+
+def parse_files(paths, parser_class=ClientConfParser, max_workers=None,
+                **kwargs):
+    """
+    Parse many clients.conf or users files in a pool of processes, so that
+    all CPU cores are used.
+
+    :param paths: A list of files and directories. All files of a directory
+        are parsed.
+    :param parser_class: ClientConfParser or UserConfParser
+    :param max_workers: The number of processes, defaults to the number of
+        CPUs
+    :param kwargs: Passed on to the parser, like backend="native"
+    :return: ParsedFiles with the merged config. For clients which are
+        defined in several files the last file wins. The entries of a user
+        are concatenated in the order of the files.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    files = _expand_paths(paths)
+    # a cache would only fill the memory of the worker processes
+    kwargs.setdefault("cache", None)
+    config = OrderedDict()
+    sources = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_parse_file, [parser_class] * len(files),
+                               files, [kwargs] * len(files))
+        for path, file_config in zip(files, results):
+            for key, value in file_config.items():
+                if issubclass(parser_class, UserConfParser):
+                    config.setdefault(key, []).extend(value)
+                    sources.setdefault(key, []).extend([path] * len(value))
+                else:
+                    config[key] = value
+                    sources[key] = path
+    return ParsedFiles(config, sources)
+
+
+# One difference found by diff(). action is "add", "remove" or "modify",
+# path the client key or (username, number of the entry) followed by the
+# names of the attributes and sections down to the difference.
+DiffRecord = namedtuple("DiffRecord", ["action", "path", "old", "new"])
+
+
+def _diff_content(parser):
+    if parser.file:
+        parser._read()
+    return parser.content
+
+
+def _diff_dicts(path, old, new, records):
+    """
+    Append the DiffRecords between the dictionaries old and new to records,
+    nested dictionaries are compared key by key.
+    """
+    for key, value in old.items():
+        if key not in new:
+            records.append(DiffRecord("remove", path + (key,), value, None))
+    for key, value in new.items():
+        if key not in old:
+            records.append(DiffRecord("add", path + (key,), None, value))
+        elif old[key] != value:
+            if isinstance(old[key], dict) and isinstance(value, dict):
+                _diff_dicts(path + (key,), old[key], value, records)
+            else:
+                records.append(DiffRecord("modify", path + (key,), old[key],
+                                          value))
+
+
+def _client_blocks(content):
+    """
+    :return: the ordered dictionary of the text of each client block by its
+        client key. Blocks without a client key are skipped.
+    """
+    blocks = OrderedDict()
+    for start, end in _split_blocks(content):
+        m = _CLIENT_START.match(content, start)
+        if m is not None:
+            blocks[m.group(1)] = content[start:end]
+    return blocks
+
+
+def _client_attributes(block):
+    try:
+        client, _pos = _ClientConfReader(block).client_block(0)
+    except _NoMatch as e:
+        raise _parse_exception(block, e.loc, e.msg)
+    return ClientConfParser._client_config(client)
+
+
+def _diff_clients(old, new):
+    old_blocks = _client_blocks(old)
+    new_blocks = _client_blocks(new)
+    records = []
+    for client_key, block in old_blocks.items():
+        if client_key not in new_blocks:
+            records.append(DiffRecord("remove", (client_key,),
+                                      _client_attributes(block), None))
+    for client_key, block in new_blocks.items():
+        old_block = old_blocks.get(client_key)
+        if old_block == block:
+            continue
+        if old_block is None:
+            records.append(DiffRecord("add", (client_key,), None,
+                                      _client_attributes(block)))
+        else:
+            _diff_dicts((client_key,), _client_attributes(old_block),
+                        _client_attributes(block), records)
+    return records
+
+
+def _user_entries(content):
+    """
+    :return: the list of (username, number, text) of the entries of a users
+        file, where number counts the entries of the username. Trailing
+        whitespace like the empty lines between entries is removed.
+    """
+    entries = []
+    numbers = {}
+    for text in _entry_texts(io.StringIO(content)):
+        text = text.rstrip()
+        if _SKIP.match(text).end() < len(text):
+            username = text.split(None, 1)[0]
+            numbers[username] = numbers.get(username, -1) + 1
+            entries.append((username, numbers[username], text))
+    return entries
+
+
+def _changed_entries(entries, other):
+    """
+    :return: the entries whose text is not found in the entries other,
+        grouped by username
+    """
+    counts = {}
+    for _username, _number, text in other:
+        counts[text] = counts.get(text, 0) + 1
+    changed = OrderedDict()
+    for username, number, text in entries:
+        if counts.get(text):
+            counts[text] -= 1
+        else:
+            changed.setdefault(username, []).append((number, text))
+    return changed
+
+
+def _attribute_items(items):
+    grouped = OrderedDict()
+    for item in items:
+        grouped.setdefault(item.attribute, []).append(item)
+    return dict((attribute, tuple(i)) for attribute, i in grouped.items())
+
+
+def _diff_users(parser, old, new):
+    old_entries = _user_entries(old)
+    new_entries = _user_entries(new)
+    old_changed = _changed_entries(old_entries, new_entries)
+    new_changed = _changed_entries(new_entries, old_entries)
+    names = {}
+
+    def entry(text):
+        return UserConfParser._entry(
+            parser.user_file.parseString(text, parseAll=True)[0], names)
+
+    records = []
+    for username, entries in old_changed.items():
+        for number, text in entries[len(new_changed.get(username, ())):]:
+            records.append(DiffRecord("remove", (username, number),
+                                      entry(text), None))
+    for username, entries in new_changed.items():
+        removed = old_changed.get(username, ())
+        for i, (number, text) in enumerate(entries):
+            if i >= len(removed):
+                records.append(DiffRecord("add", (username, number), None,
+                                          entry(text)))
+                continue
+            old_entry = entry(removed[i][1])
+            new_entry = entry(text)
+            for items in ("check_items", "reply_items"):
+                _diff_dicts((username, number, items),
+                            _attribute_items(getattr(old_entry, items)),
+                            _attribute_items(getattr(new_entry, items)),
+                            records)
+    return records
+
+
+def diff(old, new):
+    """
+    Compare two versions of a clients.conf or of a users file.
+
+    Client blocks and users entries with the same text in both versions
+    are skipped without parsing them, only the others are parsed and
+    compared attribute by attribute, down to the attributes of sections
+    like limit. Users entries are compared with the entry of the same
+    username at the same position among the changed entries, moved entries
+    are not reported. $INCLUDE directives are not resolved.
+
+    :param old: The parser of the old version
+    :param new: The parser of the new version, of the same class
+    :return: the list of DiffRecords. The old and new values of clients
+        and of their attributes are like in get_dict(). The old and new
+        values of users entries are UserEntry records, of their attributes
+        the tuples of the AttributeItems of each attribute.
+    """
+    old_content = _diff_content(old)
+    new_content = _diff_content(new)
+    if old_content == new_content:
+        return []
+    if isinstance(new, UserConfParser):
+        return _diff_users(new, old_content, new_content)
+    return _diff_clients(old_content, new_content)
+
+
+# The keys of the clients or users which changed between two get_dict()
+# and the new get_dict(), also the result of ClientConfParser.commit()
+ChangeEvent = namedtuple("ChangeEvent", ["added", "removed", "modified",
+                                         "config"])
+
+
+class _Inotify(object):
+    """
+    The part of the inotify API of Linux needed by ConfigWatcher, through
+    ctypes. Raises OSError or AttributeError where inotify is not available.
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_CLOEXEC = 0o2000000
+    mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE)
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self.watches = {}
+
+    def watch(self, directory):
+        path = directory
+        if isinstance(path, six.text_type):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self.fd, path, self.mask)
+        if wd < 0:
+            error = self._ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self.watches[wd] = directory
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+
+        :return: the paths of the files of the events, an empty list if
+            there was no event
+        """
+        import select
+        import struct
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        paths = []
+        pos = 0
+        while pos < len(data):
+            wd, _mask, _cookie, length = struct.unpack_from("iIII", data, pos)
+            name = data[pos + 16:pos + 16 + length].rstrip(b"\0")
+            pos += 16 + length
+            if wd in self.watches and name:
+                if six.PY3:
+                    name = name.decode(sys.getfilesystemencoding(),
+                                       "surrogateescape")
+                paths.append(os.path.join(self.watches[wd], name))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ConfigWatcher(object):
+    """
+    Watch the file of a parser and publish a ChangeEvent to the subscribers
+    whenever the clients or users in it change.
+
+    On Linux the directories of the files are watched with inotify, on other
+    systems the files are checked every interval seconds. Writes are
+    collected until there was no write for debounce seconds, so that a
+    burst of writes results in a single reload. With resolve_includes the
+    included files and directories are watched as well.
+    """
+
+    def __init__(self, parser, interval=1.0, debounce=0.2, use_inotify=True):
+        """
+        :param parser: The ClientConfParser or UserConfParser of the file
+        :param interval: The seconds between two checks without inotify
+        :param debounce: The seconds without a write before reloading
+        :param use_inotify: Use inotify where it is available
+        """
+        self.parser = parser
+        self.interval = interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self._subscribers = []
+        paths = self.paths()
+        self._signature = self._paths_signature()
+        self.config = parser.get_dict()
+        if self.paths() != paths:
+            # the includes are only known once the file is parsed
+            self._signature = self._paths_signature()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._inotify = None
+        self._watched = set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def subscribe(self, callback):
+        """
+        Call callback(event) with the ChangeEvent of every change. The
+        callbacks of a started watcher are called in its thread.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def paths(self):
+        """
+        :return: the watched paths, the file of the parser and with
+            resolve_includes the files and directories it includes
+        """
+        paths = [os.path.abspath(self.parser.file)]
+        for filename, included in (self.parser.includes or {}).items():
+            paths.append(filename)
+            paths.extend(included)
+        return list(OrderedDict.fromkeys(paths))
+
+    def _paths_signature(self):
+        signature = []
+        for path in self.paths():
+            try:
+                signature.append(_file_signature(path))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def check(self):
+        """
+        Reload the config if the watched files changed and publish the
+        changes. A config which can not be parsed, like a half written
+        file, is skipped until the next change.
+
+        :return: the published ChangeEvent or None
+        """
+        from pyparsing import ParseException
+        signature = self._paths_signature()
+        if signature == self._signature:
+            return None
+        self._signature = signature
+        try:
+            config = self.parser.get_dict()
+        except (ParseException, IncludeError, IOError, OSError):
+            return None
+        event = self.diff(self.config, config)
+        self.config = config
+        if not (event.added or event.removed or event.modified):
+            return None
+        for callback in list(self._subscribers):
+            callback(event)
+        return event
+
+    @staticmethod
+    def diff(old, new):
+        """
+        :return: the ChangeEvent between the get_dict() old and new
+        """
+        return ChangeEvent([key for key in new if key not in old],
+                           [key for key in old if key not in new],
+                           [key for key in new
+                            if key in old and new[key] != old[key]],
+                           new)
+
+    def start(self):
+        """
+        Watch the files in a daemon thread. The changes since the watcher
+        was created are published right away.
+        """
+        if self._thread is not None:
+            return
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify()
+                self._watch()
+            except (OSError, AttributeError):
+                self._inotify = None
+        self.check()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name="ConfigWatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching. Waits for the thread, at most interval seconds.
+        """
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._watched = set()
+
+    def _watch(self):
+        """
+        Add inotify watches for the directories of all watched paths
+        """
+        for path in self.paths():
+            directory = path if os.path.isdir(path) else os.path.dirname(path)
+            if directory not in self._watched and os.path.isdir(directory):
+                self._inotify.watch(directory)
+                self._watched.add(directory)
+
+    def _wait(self):
+        """
+        Wait until the watched files changed and no write followed for
+        debounce seconds.
+
+        :return: False if the watcher was stopped
+        """
+        if self._inotify is not None:
+            # the includes may have changed
+            self._watch()
+            paths = set(self.paths())
+            while not self._stopped.is_set():
+                changed = self._inotify.read(self.interval)
+                if any(p in paths or os.path.dirname(p) in paths
+                       for p in changed):
+                    while self._inotify.read(self.debounce):
+                        pass
+                    return True
+            return False
+        while not self._stopped.wait(self.interval):
+            signature = self._paths_signature()
+            if signature == self._signature:
+                continue
+            while not self._stopped.wait(self.debounce):
+                previous, signature = signature, self._paths_signature()
+                if signature == previous:
+                    return True
+        return False
+
+    def _run(self):
+        while self._wait():
+            try:
+                self.check()
+            except Exception:
+                log.exception("Failed to publish the changes of {0!s}".format(
+                    self.parser.file))
+
+
+_PARSERS = OrderedDict([("clients", ClientConfParser),
+                        ("users", UserConfParser)])
+
+
+def _parser_options(args):
+    """
+    :return: the keyword arguments of the parser selected on the command line
+    """
+    options = {"fast": args.fast}
+    if _PARSERS[args.type] is ClientConfParser:
+        options["backend"] = args.backend
+    return options
+
+
+def _iter_json(fp, chunk_size=65536):
+    """
+    Read the top-level JSON object or array in fp one member at a time.
+
+    :return: (True, iterator of (key, value)) for an object or
+        (False, iterator of values) for an array
+    """
+    import json
+    decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+    state = {"buffer": u"", "eof": False}
+
+    def more():
+        chunk = fp.read(chunk_size)
+        state["eof"] = not chunk
+        state["buffer"] += chunk
+        return chunk
+
+    def skip(pos):
+        # skip whitespace, reading on if the buffer ends
+        while True:
+            pos = _JSON_SPACE.match(state["buffer"], pos).end()
+            if pos < len(state["buffer"]) or not more():
+                return pos
+
+    def expect(pos, chars):
+        pos = skip(pos)
+        if pos >= len(state["buffer"]) or state["buffer"][pos] not in chars:
+            raise ValueError("Expected one of {0!s} at character {1:d} of "
+                             "the chunk".format(chars, pos))
+        return state["buffer"][pos], pos + 1
+
+    def value(pos):
+        pos = skip(pos)
+        while True:
+            try:
+                member, end = decoder.raw_decode(state["buffer"], pos)
+            except ValueError:
+                # the value is not complete yet
+                if state["eof"] or not more():
+                    raise
+                continue
+            # a number may go on in the next chunk
+            if end < len(state["buffer"]) or state["eof"] or not more():
+                return member, end
+
+    def members(is_object, end):
+        pos = skip(0)
+        if state["buffer"][pos:pos + 1] == end:
+            return
+        while True:
+            if is_object:
+                key, pos = value(pos)
+                _char, pos = expect(pos, u":")
+                member, pos = value(pos)
+                yield key, member
+            else:
+                member, pos = value(pos)
+                yield member
+            char, pos = expect(pos, u"," + end)
+            # drop what was read
+            state["buffer"] = state["buffer"][pos:]
+            pos = 0
+            if char == end:
+                return
+
+    char, pos = expect(0, u"{[")
+    state["buffer"] = state["buffer"][pos:]
+    is_object = char == u"{"
+    return is_object, members(is_object, u"}" if is_object else u"]")
+
+
+_JSON_SPACE = re.compile(r"[ \t\r\n]*")
+
+
+class _ItemStream(object):
+    """
+    A dict_config, whose items can be read once
+    """
+
+    def __init__(self, items):
+        self._items = items
+
+    def items(self):
+        return self._items
+
+
+def _entry_to_json(entry):
+    return OrderedDict([("username", entry.username),
+                        ("check_items", [list(i) for i in entry.check_items]),
+                        ("reply_items", [list(i) for i in entry.reply_items])])
+
+
+def _entry_from_json(entry):
+    return UserEntry(entry["username"],
+                     tuple(AttributeItem(*i) for i in entry["check_items"]),
+                     tuple(AttributeItem(*i) for i in entry["reply_items"]))
+
+
+def _open_output(filename):
+    if filename in (None, "-"):
+        return sys.stdout, False
+    return io.open(filename, "w", encoding="utf-8"), True
+
+
+def _validate_file(parser_class, path, kwargs):
+    """
+    :return: (path, list of ParseErrors) of all errors of the file
+    """
+    try:
+        return path, parser_class(infile=path, **kwargs).find_errors()
+    except (IOError, OSError, UnicodeDecodeError) as e:
+        return path, [ParseError(0, 0, six.text_type(e))]
+
+
+def _validate_command(args):
+    parser_class = _PARSERS[args.type]
+    files = _expand_paths(args.paths)
+    kwargs = {"cache": None}
+    if args.jobs == 1:
+        results = (_validate_file(parser_class, path, kwargs)
+                   for path in files)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        # a chunk of files per task keeps the overhead low for many files
+        results = executor.map(_validate_file, [parser_class] * len(files),
+                               files, [kwargs] * len(files), chunksize=16)
+    invalid = 0
+    try:
+        for path, errors in results:
+            invalid += bool(errors)
+            for error in errors:
+                print(u"{0!s}:{1:d}:{2:d}: {3!s}".format(path, *error))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    sys.stderr.write("{0:d} files, {1:d} invalid\n".format(len(files),
+                                                          invalid))
+    return 1 if invalid else 0
+
+
+def _to_json_command(args):
+    import json
+    parser = _PARSERS[args.type](infile=args.file, cache=None,
+                                 **_parser_options(args))
+    output, close = _open_output(args.output)
+    try:
+        if isinstance(parser, ClientConfParser):
+            output.write(u"{")
+            separator = u"\n"
+            for client_key, attributes in parser.iter_clients():
+                output.write(u"{0!s}{1!s}: {2!s}".format(
+                    separator, json.dumps(client_key), json.dumps(
+                        attributes, sort_keys=True)))
+                separator = u",\n"
+            output.write(u"\n}\n")
+        else:
+            output.write(u"[")
+            separator = u"\n"
+            for entry in parser.iter_entries():
+                output.write(separator + json.dumps(_entry_to_json(entry)))
+                separator = u",\n"
+            output.write(u"\n]\n")
+    finally:
+        if close:
+            output.close()
+    return 0
+
+
+def _from_json_command(args):
+    parser = _PARSERS[args.type](infile=args.output, cache=None)
+    if args.file in (None, "-"):
+        fp = io.open(sys.stdin.fileno(), "r", encoding="utf-8",
+                     closefd=False)
+    else:
+        fp = io.open(args.file, "r", encoding="utf-8")
+    try:
+        is_object, members = _iter_json(fp)
+        if isinstance(parser, ClientConfParser):
+            if not is_object:
+                raise ValueError("Expected a JSON object of clients")
+            config = _ItemStream(members)
+        else:
+            if is_object:
+                raise ValueError("Expected a JSON array of users entries")
+            config = (_entry_from_json(entry) for entry in members)
+        parser.save(config, args.output)
+    finally:
+        fp.close()
+    return 0
+
+
+def _lookup_command(args):
+    addresses = args.addresses or [line.strip() for line in sys.stdin
+                                   if line.strip()]
+    addresses = [ipaddress.ip_address(six.text_type(address))
+                 for address in addresses]
+    # A binary trie of the addresses, a node is [child for bit 0, child for
+    # bit 1, client key]. The client key of a node is the last client with
+    # the network of the node, so every network costs a single walk.
+    tries = {4: [None, None, None], 6: [None, None, None]}
+    for address in addresses:
+        node = tries[address.version]
+        bits = int(address)
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            bit = (bits >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+    for path in _expand_paths(args.config):
+        parser = ClientConfParser(infile=path, cache=None,
+                                  **_parser_options(args))
+        for client_key, attributes in parser.iter_clients():
+            for network in ClientIndex.networks(client_key, attributes):
+                node = tries[network.version]
+                bits = int(network.network_address)
+                for i in range(network.max_prefixlen - 1,
+                               network.max_prefixlen - network.prefixlen - 1,
+                               -1):
+                    node = node[(bits >> i) & 1]
+                    if node is None:
+                        # no address in the network
+                        break
+                else:
+                    node[2] = client_key
+    found = 0
+    for address in addresses:
+        # the longest network with a client on the path of the address
+        node = tries[address.version]
+        match = node[2]
+        bits = int(address)
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(bits >> i) & 1]
+            if node[2] is not None:
+                match = node[2]
+        print(u"{0!s} {1!s}".format(address, match or u"-"))
+        found += match is not None
+    return 0 if found == len(addresses) else 1
+
+
+def _stats_command(args):
+    stats = ParseStats()
+    parser = _PARSERS[args.type](infile=args.file, cache=None, stats=stats,
+                                 **_parser_options(args))
+
+    def run():
+        config = parser.get_dict()
+        if args.save:
+            parser.save(config, args.save)
+    profile = None
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.runcall(run)
+    else:
+        run()
+    for name, value in stats.as_dict().items():
+        if name.endswith("_time"):
+            print("{0:<14s} {1:12.6f} s".format(name, value))
+        else:
+            print("{0:<14s} {1:12d}".format(name, value))
+    if profile is not None:
+        import pstats
+        print("")
+        pstats.Stats(profile, stream=sys.stdout).sort_stats(
+            args.sort).print_stats(args.lines)
+    return 0
+
+
+def main(argv=None):
+    """
+    The command line interface, see --help
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="freeradiusparser",
+        description="Work with the clients.conf and users files of "
+                    "FreeRADIUS")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_parser(name, help, func, type=True):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.set_defaults(func=func, type="clients", backend="native",
+                               fast=False)
+        if type:
+            subparser.add_argument("--type", choices=list(_PARSERS),
+                                   default="clients",
+                                   help="The type of the files")
+        return subparser
+
+    def add_grammar_arguments(subparser, backend="native"):
+        subparser.add_argument("--backend", choices=ClientConfParser.backends,
+                               default=backend,
+                               help="The backend of the clients parser")
+        subparser.add_argument("--fast", action="store_true",
+                               help="Use the fast grammar")
+
+    validate = add_parser(
+        "validate", "Check that files parse completely, in parallel. All "
+                    "errors are printed as path:line:column: message",
+        _validate_command)
+    validate.add_argument("paths", nargs="+", metavar="path",
+                          help="A file or a directory of files")
+    validate.add_argument("--jobs", type=int,
+                          help="The number of processes, defaults to the "
+                               "number of CPUs")
+    to_json = add_parser(
+        "to-json", "Convert a file to JSON, a JSON object of the clients "
+                   "or a JSON array of the users entries",
+        _to_json_command)
+    to_json.add_argument("file")
+    to_json.add_argument("-o", "--output", help="The JSON file, default "
+                                                "stdout")
+    add_grammar_arguments(to_json)
+    from_json = add_parser(
+        "from-json", "Write a file from the JSON written by to-json",
+        _from_json_command)
+    from_json.add_argument("file", nargs="?",
+                           help="The JSON file, default stdin")
+    from_json.add_argument("-o", "--output", required=True,
+                           help="The file to write")
+    lookup = add_parser(
+        "lookup", "Find the client of IP addresses by longest prefix "
+                  "match, without holding the config in memory",
+        _lookup_command, type=False)
+    lookup.add_argument("addresses", nargs="*", metavar="address",
+                        help="An IPv4 or IPv6 address, default one per "
+                             "line from stdin")
+    lookup.add_argument("-c", "--config", action="append", required=True,
+                        help="A clients.conf or a directory of them, can "
+                             "be given several times")
+    add_grammar_arguments(lookup)
+    stats = add_parser("stats", "Parse a file and show where the time goes",
+                       _stats_command)
+    stats.add_argument("file")
+    add_grammar_arguments(stats, backend="pyparsing")
+    stats.add_argument("--save", metavar="OUTFILE",
+                       help="Save the config to OUTFILE as well")
+    stats.add_argument("--profile", action="store_true",
+                       help="Show the profile of cProfile")
+    stats.add_argument("--sort", default="cumulative",
+                       help="The sort order of the profile")
+    stats.add_argument("--lines", type=int, default=25,
+                       help="The number of functions in the profile")
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
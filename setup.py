@@ -11,6 +11,13 @@ setup(name='freeradiusparser',
       py_modules=['freeradiusparser'],
       install_requires=[
             'pyparsing>=2.0',
-            'six'
+            'six',
+            'ipaddress; python_version < "3.3"',
+            'futures; python_version < "3.2"'
       ],
+      entry_points={
+            'console_scripts': [
+                  'freeradiusparser = freeradiusparser:main'
+            ]
+      },
       )
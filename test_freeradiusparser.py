@@ -18,12 +18,34 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import io
 import os
+import subprocess
+import sys
+import threading
+import time
+import shutil
+import tempfile
 import pytest
+import hashlib
 import json
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    # Python 2
+    asyncio = None
 from six.moves.urllib.request import urlopen
-from .freeradiusparser import ClientConfParser, UserConfParser, BaseParser
+from pyparsing import ParseException
+from .freeradiusparser import (ClientConfParser, UserConfParser, BaseParser,
+                               ParseCache, ClientIndex, UserMatcher,
+                               MappedClientConf, ClientConfTree,
+                               UserEntry,
+                               AttributeItem, parse_files, IncludeError,
+                               ConfigWatcher, ChangeEvent, ConflictError,
+                               ParseStats, ParseError, DiffRecord, diff,
+                               main, _compile_check)
 
 SIMPLE_CLIENTS_CONF_TEST_FILE = 'testdata/clients.conf'
 FILEOUTPUT_SIMPLE_CLIENTS_CONF = u"""# File parsed and saved by privacyidea.
@@ -292,8 +314,1445 @@ class TestFreeRADIUSParser(unittest.TestCase):
         f.close()
         os.unlink(tmpfile)
         self.assertEqual(output, FILEOUTPUT_SIMPLE_CLIENTS_CONF)
+
+    def test_format_to(self):
+        cp = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE)
+        cfg = json.loads(json.dumps(cp.get_dict(), sort_keys=True),
+                         object_pairs_hook=OrderedDict)
+        output = io.StringIO()
+        cp.format_to(cfg, output)
+        assert output.getvalue() == FILEOUTPUT_CLIENTS_CONF_TEST
         
 
+CLIENTS_CONF_ODD_SYNTAX = [
+    u"client a {}",
+    u"clientb { x=1 }",
+    u"client a{x=1#comment\n}",
+    u"client a { limit { } } client b { x = 1 } trailing garbage",
+    u"client a { x = 1 }\n client b { y }",
+    u"client a { x =\n 1 }\nclient b { x = 2 } # end",
+    u"client a { limit foo{lifetime=0 idle=1} x = ::1/128 }",
+    u"client 10.0.0.0/8 { secret = \"quoted\" ipaddr = * }",
+    u"client a { x = 1 }\nclient b { x = 1 y = }\nclient c {}",
+]
+
+
+class TestClientConfBackends(unittest.TestCase):
+    """
+    The native backend has to return exactly what the pyparsing grammar
+    returns.
+    """
+
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def _assert_equal_backends(self, **kwargs):
+        reference = ClientConfParser(**kwargs)
+        native = ClientConfParser(backend="native", **kwargs)
+        self.assertEqual(native.get(), reference.get().asList())
+        self.assertEqual(native.get_dict(), reference.get_dict())
+
+    def test_testdata(self):
+        for filename in [SIMPLE_CLIENTS_CONF_TEST_FILE,
+                         CLIENTS_CONF_TEST_FILE,
+                         CLIENTS_CONF_RAD30_FILE]:
+            self._assert_equal_backends(infile=filename)
+
+    def test_odd_syntax(self):
+        for content in CLIENTS_CONF_ODD_SYNTAX:
+            self._assert_equal_backends(content=content)
+
+    def test_no_client(self):
+        for content in [u"# only a comment", u"client a { x = }"]:
+            self.assertRaises(ParseException,
+                              ClientConfParser(content=content).get)
+            self.assertRaises(ParseException,
+                              ClientConfParser(content=content,
+                                               backend="native").get)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, ClientConfParser,
+                          infile=SIMPLE_CLIENTS_CONF_TEST_FILE,
+                          backend="yacc")
+
+    def test_native_dump(self):
+        cp = ClientConfParser(infile=SIMPLE_CLIENTS_CONF_TEST_FILE,
+                              backend="native")
+        cp.dump()
+        captured = self.capsys.readouterr()
+        assert "private-network-1: [[" in captured.out
+        assert "testing123-1']," in captured.out
+
+
+class TestIterClients(unittest.TestCase):
+
+    def test_same_as_get_dict(self):
+        for backend in ClientConfParser.backends:
+            for filename in [SIMPLE_CLIENTS_CONF_TEST_FILE,
+                             CLIENTS_CONF_TEST_FILE,
+                             CLIENTS_CONF_RAD30_FILE]:
+                cp = ClientConfParser(infile=filename, backend=backend)
+                for chunk_size in [7, 100, 65536]:
+                    self.assertEqual(dict(cp.iter_clients(chunk_size)),
+                                     cp.get_dict())
+            for content in CLIENTS_CONF_ODD_SYNTAX:
+                cp = ClientConfParser(content=content, backend=backend)
+                self.assertEqual(dict(cp.iter_clients()), cp.get_dict())
+
+    def test_order(self):
+        cp = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE)
+        self.assertEqual([k for k, _v in cp.iter_clients(chunk_size=10)],
+                         ["127.0.0.1", "127.0.0.2", "127.0.0.3",
+                          "127.0.0.4", "foo"])
+
+    def test_file_is_not_read_at_once(self):
+        cp = ClientConfParser(infile=CLIENTS_CONF_RAD30_FILE)
+        clients = cp.iter_clients(chunk_size=64)
+        self.assertEqual(next(clients)[0], "localhost")
+        self.assertEqual(cp._content, None)
+        self.assertEqual(next(clients)[0], "localhost_ipv6")
+
+    def test_no_client(self):
+        for content in [u"# only a comment", u"client a { x = }"]:
+            for backend in ClientConfParser.backends:
+                cp = ClientConfParser(content=content, backend=backend)
+                self.assertRaises(ParseException, list, cp.iter_clients())
+
+
+CLIENTS_CONF_NETWORKS = u"""
+client 10.0.0.0/8 {
+    secret = eight
+}
+client sixteen {
+    ipaddr = 10.3.0.0
+    netmask = 16
+}
+client host {
+    ipv4addr = 10.3.4.5
+}
+client v6 {
+    ipv6addr = 2001:db8::/32
+}
+client any6 {
+    ipv6addr = *
+}
+client dns {
+    ipaddr = radius.example.org
+}
+"""
+
+
+class TestClientIndex(unittest.TestCase):
+
+    def test_longest_prefix_match(self):
+        index = ClientIndex(ClientConfParser(content=CLIENTS_CONF_NETWORKS))
+        self.assertEqual(index.lookup("10.3.4.5")[0], "host")
+        self.assertEqual(index.lookup("10.3.4.6")[0], "sixteen")
+        self.assertEqual(index.lookup("10.4.0.1"),
+                         ("10.0.0.0/8", {"secret": "eight"}))
+        self.assertEqual(index.lookup("2001:db8::1")[0], "v6")
+        self.assertEqual(index.lookup("::1")[0], "any6")
+        self.assertEqual(index.lookup("192.168.0.1"), None)
+
+    def test_testdata(self):
+        index = ClientIndex(ClientConfParser(
+            infile=SIMPLE_CLIENTS_CONF_TEST_FILE))
+        self.assertEqual(index.lookup("127.0.0.1")[0], "localhost")
+        self.assertEqual(index.lookup("192.168.0.17")[0], "private-network-1")
+        self.assertEqual(index.lookup("192.168.1.17"), None)
+        index = ClientIndex(ClientConfParser(infile=CLIENTS_CONF_TEST_FILE))
+        self.assertEqual(index.lookup("127.0.0.3")[0], "127.0.0.3")
+
+    def test_refresh(self):
+        tmpdir = tempfile.mkdtemp()
+        clients_conf = os.path.join(tmpdir, "clients.conf")
+        try:
+            with open(clients_conf, "w") as f:
+                f.write(CLIENTS_CONF_NETWORKS)
+            index = ClientIndex(ClientConfParser(infile=clients_conf))
+            added = []
+            add = index._add
+
+            def counting_add(client_key, attributes):
+                added.append(client_key)
+                add(client_key, attributes)
+            index._add = counting_add
+            with open(clients_conf, "w") as f:
+                f.write(CLIENTS_CONF_NETWORKS.replace("10.3.4.5", "10.3.4.7")
+                        + u"client new {\n    ipaddr = 10.3.4.0/24\n}\n")
+            self.assertEqual(index.lookup("10.3.4.5")[0], "new")
+            self.assertEqual(index.lookup("10.3.4.7")[0], "host")
+            self.assertEqual(sorted(added), ["host", "new"])
+            # pruned trie
+            index.auto_refresh = False
+            index._remove("host")
+            index._remove("new")
+            self.assertEqual(index.lookup("10.3.4.7")[0], "sixteen")
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_same_network(self):
+        tmpdir = tempfile.mkdtemp()
+        clients_conf = os.path.join(tmpdir, "clients.conf")
+        a = u"client a {\n    ipaddr = 10.0.0.0/24\n}\n"
+        b = u"client b {\n    ipaddr = 10.0.0.0/24\n}\n"
+        try:
+            with open(clients_conf, "w") as f:
+                f.write(a + b)
+            index = ClientIndex(ClientConfParser(infile=clients_conf))
+            # the last client wins like in get_dict()
+            self.assertEqual(index.lookup("10.0.0.5")[0], "b")
+            with open(clients_conf, "w") as f:
+                f.write(a + u"client c {\n    ipaddr = 10.0.1.1\n}\n")
+            self.assertEqual(index.lookup("10.0.0.5")[0], "a")
+            with open(clients_conf, "w") as f:
+                f.write(u"client c {\n    ipaddr = 10.0.1.1\n}\n" + b)
+            self.assertEqual(index.lookup("10.0.0.5")[0], "b")
+            self.assertEqual(index.lookup("10.0.1.1")[0], "c")
+            with open(clients_conf, "w") as f:
+                f.write(u"client c {\n    ipaddr = 10.0.1.1\n}\n")
+            self.assertEqual(index.lookup("10.0.0.5"), None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestUserMatcher(unittest.TestCase):
+    USERS = u"""DEFAULT Huntgroup-Name == "modems"
+\tFall-Through = Yes
+
+bob Cleartext-Password := "hello"
+\tReply-Message = "Hello-bob"
+
+DEFAULT Huntgroup-Name == "vpn"
+\tReply-Message = "vpn"
+
+alice Calling-Station-Id =~ "^00-11"
+\tFall-Through = Yes
+
+alice Calling-Station-Id !~ "^00-11"
+\tReply-Message = "not-allowed"
+
+DEFAULT NAS-Port >= 10
+\tReply-Message = "port"
+
+DEFAULT Service-Type !* ANY
+\tReply-Message = "fallback"
+
+DEFAULT Auth-Type := Reject
+"""
+
+    def _replies(self, matcher, request):
+        return [(entry.username, entry.reply_items[0].value)
+                for entry in matcher.match(request)]
+
+    def test_match(self):
+        matcher = UserMatcher(UserConfParser(content=self.USERS))
+        self.assertEqual(self._replies(matcher, {"User-Name": "bob"}),
+                         [("bob", '"Hello-bob"')])
+        # Fall-Through of the DEFAULT entry before bob
+        self.assertEqual(
+            self._replies(matcher, {"User-Name": "bob",
+                                    "Huntgroup-Name": "modems"}),
+            [("DEFAULT", "Yes"), ("bob", '"Hello-bob"')])
+        self.assertEqual(
+            self._replies(matcher, {"User-Name": "carol",
+                                    "Huntgroup-Name": "vpn"}),
+            [("DEFAULT", '"vpn"')])
+        self.assertEqual(
+            self._replies(matcher, {"User-Name": "carol", "NAS-Port": "12"}),
+            [("DEFAULT", '"port"')])
+        self.assertEqual(
+            self._replies(matcher, {"User-Name": "alice",
+                                    "Calling-Station-Id": "00-11-22"}),
+            [("alice", "Yes"), ("DEFAULT", '"fallback"')])
+        self.assertEqual(
+            self._replies(matcher, {"User-Name": "alice",
+                                    "Calling-Station-Id": ["00-22",
+                                                           "00-33"]}),
+            [("alice", '"not-allowed"')])
+        # 9 < 10 as numbers, but not as strings
+        entries = matcher.match({"User-Name": "carol", "NAS-Port": "9",
+                                 "Service-Type": "Login-User"})
+        self.assertEqual(entries, [UserEntry(
+            "DEFAULT", (AttributeItem("Auth-Type", ":=", "Reject"),), ())])
+        self.assertEqual(matcher.match_all([{"User-Name": "bob"}, {}]),
+                         [matcher.match({"User-Name": "bob"}),
+                          matcher.match({})])
+
+    def test_compare_strings(self):
+        matcher = UserMatcher(UserConfParser(
+            content=u"DEFAULT Session-Timeout > 100\n\tReply-Message = a\n"
+                    u"DEFAULT Called-Station-Id > abc\n\tReply-Message = b\n"))
+        self.assertEqual(
+            self._replies(matcher, {"Session-Timeout": "abc"}),
+            [("DEFAULT", "a")])
+        self.assertEqual(
+            self._replies(matcher, {"Session-Timeout": "20",
+                                    "Called-Station-Id": "123"}),
+            [])
+        self.assertEqual(
+            self._replies(matcher, {"Called-Station-Id": "abd"}),
+            [("DEFAULT", "b")])
+
+    def test_linear_walk(self):
+        # the indexes give the same result as trying every entry
+        up = UserConfParser(content=self.USERS)
+        matcher = UserMatcher(up)
+
+        def linear(request):
+            values = dict((k, (v,)) for k, v in request.items())
+            matches = []
+            for entry in up.get_entries():
+                if entry.username not in ("DEFAULT", request["User-Name"]):
+                    continue
+                checks = [_compile_check(item)
+                          for item in entry.check_items]
+                if all(check is None or check(values.get(item.attribute))
+                       for check, item in zip(checks, entry.check_items)):
+                    matches.append(entry)
+                    if entry.reply_items[:1] != (
+                            AttributeItem("Fall-Through", "=", "Yes"),):
+                        break
+            return matches
+
+        for username in ["bob", "alice", "carol"]:
+            for huntgroup in [None, "modems", "vpn"]:
+                for port in [None, "9", "10"]:
+                    request = {"User-Name": username,
+                               "Calling-Station-Id": "00-11-33"}
+                    if huntgroup:
+                        request["Huntgroup-Name"] = huntgroup
+                    if port:
+                        request["NAS-Port"] = port
+                    self.assertEqual(matcher.match(request),
+                                     linear(request))
+
+    def test_refresh(self):
+        tmpdir = tempfile.mkdtemp()
+        users = os.path.join(tmpdir, "users")
+        try:
+            with open(users, "w") as f:
+                f.write(self.USERS)
+            matcher = UserMatcher(UserConfParser(infile=users))
+            self.assertEqual(len(matcher.match({"User-Name": "dave"})), 1)
+            with open(users, "w") as f:
+                f.write(u"dave Cleartext-Password := x\n" + self.USERS)
+            self.assertEqual(matcher.match({"User-Name": "dave"})[0]
+                             .username, "dave")
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestMappedClientConf(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_testdata(self):
+        for filename in [SIMPLE_CLIENTS_CONF_TEST_FILE, CLIENTS_CONF_TEST_FILE,
+                         CLIENTS_CONF_RAD30_FILE]:
+            expected = ClientConfParser(infile=filename).get_dict()
+            with MappedClientConf(filename) as clients:
+                self.assertEqual(len(clients), len(expected))
+                self.assertEqual(dict(clients.items()), expected)
+                self.assertEqual(sorted(clients), sorted(expected))
+        with MappedClientConf(SIMPLE_CLIENTS_CONF_TEST_FILE) as clients:
+            self.assertEqual(clients.keys(), ["localhost",
+                                              "private-network-1"])
+            self.assertEqual(clients["localhost"]["secret"], "testing123")
+            self.assertTrue("localhost" in clients)
+            self.assertEqual(clients.get("missing"), None)
+            self.assertRaises(KeyError, clients.__getitem__, "missing")
+
+    def test_lazy_blocks(self):
+        filename = os.path.join(self.tmpdir, "clients.conf")
+        with io.open(filename, "w", encoding="utf-8") as f:
+            f.write(u"# {comment}\n"
+                    u"client a {\n    secret = s  # \u00e4\n"
+                    u"    shortname = a\n}\n"
+                    u"client b {\n    secret\n}\n"
+                    u"foo {\n}\n"
+                    u"client c {\n    limit {\n        lifetime = 0\n"
+                    u"    }\n}\n")
+        with MappedClientConf(filename) as clients:
+            self.assertEqual(clients.keys(), ["a", "b", "c"])
+            self.assertEqual(clients["a"], {"secret": "s", "shortname": "a"})
+            self.assertEqual(clients["c"], {"limit": {"lifetime": "0"}})
+            # the broken block only fails when it is looked up
+            with self.assertRaises(ParseException) as cm:
+                clients["b"]
+            self.assertEqual((cm.exception.lineno, cm.exception.col), (7, 5))
+        open(filename, "w").close()
+        with MappedClientConf(filename) as clients:
+            self.assertEqual(clients.keys(), [])
+
+
+class TestIncrementalParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, content):
+        with open(self.clients_conf, "w") as f:
+            f.write(content)
+
+    def test_same_as_get(self):
+        for backend in ClientConfParser.backends:
+            for filename in [SIMPLE_CLIENTS_CONF_TEST_FILE,
+                             CLIENTS_CONF_TEST_FILE,
+                             CLIENTS_CONF_RAD30_FILE]:
+                cp = ClientConfParser(infile=filename, backend=backend,
+                                      incremental=True)
+                self.assertEqual(
+                    cp.get_dict(),
+                    ClientConfParser(infile=filename).get_dict())
+            for content in CLIENTS_CONF_ODD_SYNTAX:
+                cp = ClientConfParser(content=content, backend=backend,
+                                      incremental=True)
+                self.assertEqual(
+                    cp.get_dict(),
+                    ClientConfParser(content=content).get_dict())
+            cp = ClientConfParser(content=u"# nothing", backend=backend,
+                                  incremental=True)
+            self.assertRaises(ParseException, cp.get)
+
+    def test_only_changed_blocks_are_parsed(self):
+        clients = [u"client c{0!s} {{\n    secret = s{0!s}\n}}\n".format(i)
+                   for i in range(100)]
+        self._write(u"".join(clients))
+        for backend in ClientConfParser.backends:
+            cp = ClientConfParser(infile=self.clients_conf, backend=backend,
+                                  incremental=True, cache=None)
+            self.assertEqual(len(cp.get_dict()), 100)
+            parsed = []
+            parse_block = cp._parse_block
+
+            def counting_parse_block(content):
+                parsed.append(content)
+                return parse_block(content)
+            cp._parse_block = counting_parse_block
+            changed = clients[:]
+            changed[42] = u"client c42 {\n    secret = changed\n}\n"
+            del changed[7]
+            self._write(u"# new comment\n" + u"".join(changed))
+            config = cp.get_dict()
+            self.assertEqual(parsed, [changed[41].strip()])
+            self.assertEqual(config["c42"], {"secret": "changed"})
+            self.assertEqual(len(config), 99)
+            content = cp.content
+            for client_key, start, end in cp.block_offsets:
+                self.assertTrue(content[start:end].startswith(
+                    u"client " + client_key))
+            self._write(u"".join(clients))
+
+    def test_block_offsets(self):
+        cp = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE, incremental=True)
+        cp.get()
+        self.assertEqual([o[0] for o in cp.block_offsets],
+                         ["127.0.0.1", "127.0.0.2", "127.0.0.3",
+                          "127.0.0.4", "foo"])
+        client_key, start, end = cp.block_offsets[-1]
+        self.assertEqual(cp.content[start:end].splitlines()[-1], u"}")
+
+
+class TestPatchSave(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        shutil.copy(CLIENTS_CONF_TEST_FILE, self.clients_conf)
+        os.chmod(self.clients_conf, 0o640)
+        with open(CLIENTS_CONF_TEST_FILE) as f:
+            self.original = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.clients_conf) as f:
+            return f.read()
+
+    def test_unchanged(self):
+        for backend in ClientConfParser.backends:
+            cp = ClientConfParser(infile=self.clients_conf, backend=backend)
+            cp.save(cp.get_dict(), patch=True)
+            self.assertEqual(self._read(), self.original)
+
+    def test_add_modify_remove(self):
+        for backend in ClientConfParser.backends:
+            shutil.copy(CLIENTS_CONF_TEST_FILE, self.clients_conf)
+            os.chmod(self.clients_conf, 0o640)
+            cp = ClientConfParser(infile=self.clients_conf, backend=backend,
+                                  incremental=True)
+            config = cp.get_dict()
+            config["127.0.0.2"]["secret"] = "changed"
+            del config["127.0.0.3"]
+            config["new"] = {"ipaddr": "10.0.0.1", "secret": "new"}
+            cp.save(config, patch=True)
+            output = self._read()
+            self.assertEqual(cp.get_dict(), config)
+            self.assertEqual(os.stat(self.clients_conf).st_mode & 0o777,
+                             0o640)
+            # untouched blocks and comments are kept
+            self.assertTrue(output.startswith(
+                self.original[:self.original.index("client 127.0.0.2")]))
+            self.assertIn(self.original[self.original.index(
+                "# client with empty named section"):], output)
+            self.assertNotIn("127.0.0.3", output)
+            self.assertIn("# client with a named section\n\n", output)
+            self.assertIn("    secret = changed\n", output)
+            self.assertTrue(output.endswith(
+                "}\n\nclient new {\n    ipaddr = 10.0.0.1\n"
+                "    secret = new\n}\n") or output.endswith(
+                "}\n\nclient new {\n    secret = new\n"
+                "    ipaddr = 10.0.0.1\n}\n"))
+
+    def test_new_file(self):
+        outfile = os.path.join(self.tmpdir, "new.conf")
+        cp = ClientConfParser(infile=self.clients_conf)
+        cp.save({"a": {"secret": "b"}}, outfile, patch=True)
+        with open(outfile) as f:
+            self.assertEqual(f.read(), "client a {\n    secret = b\n}\n")
+        # no temporary file is left, only the lock file
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         [".new.conf.lock", "clients.conf", "new.conf"])
+
+
+class TestBulkChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        shutil.copy(CLIENTS_CONF_TEST_FILE, self.clients_conf)
+        with open(CLIENTS_CONF_TEST_FILE) as f:
+            self.original = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self):
+        with open(self.clients_conf) as f:
+            return f.read()
+
+    def test_commit(self):
+        cp = ClientConfParser(infile=self.clients_conf)
+        expected = cp.get_dict()
+        cp.add_clients([("new", {"ipaddr": "10.0.0.1", "secret": "new"})])
+        cp.update_clients({"127.0.0.2": {"secret": "changed"}})
+        cp.remove_clients(["127.0.0.3"])
+        cp.upsert([("127.0.0.1", expected["127.0.0.1"]),
+                   ("other", {"secret": "other"})])
+        # removed and added again in the same batch
+        cp.remove_clients(["other"])
+        self.assertRaises(ValueError, cp.add_clients,
+                          [("new", {"secret": "x"})])
+        self.assertRaises(KeyError, cp.update_clients, [("missing", {})])
+        self.assertRaises(KeyError, cp.remove_clients, ["missing"])
+        self.assertEqual(self._read(), self.original)
+        summary = cp.commit()
+        self.assertEqual(summary.added, ["new"])
+        self.assertEqual(summary.removed, ["127.0.0.3"])
+        self.assertEqual(summary.modified, ["127.0.0.2"])
+        expected["127.0.0.2"]["secret"] = "changed"
+        del expected["127.0.0.3"]
+        expected["new"] = {"ipaddr": "10.0.0.1", "secret": "new"}
+        self.assertEqual(dict(summary.config), expected)
+        self.assertEqual(cp.get_dict(), expected)
+        output = self._read()
+        # untouched blocks and comments are kept, also of the unchanged
+        # client 127.0.0.1
+        self.assertTrue(output.startswith(
+            self.original[:self.original.index("client 127.0.0.2")]))
+        self.assertIn(self.original[self.original.index(
+            "# client with empty named section"):], output)
+        self.assertIn("# client with a named section\n\n", output)
+        self.assertNotIn("127.0.0.3", output)
+        self.assertIn("client new {\n", output)
+        # nothing left to commit
+        mtime = os.stat(self.clients_conf).st_mtime
+        self.assertEqual(cp.commit()[:3], ([], [], []))
+        self.assertEqual(os.stat(self.clients_conf).st_mtime, mtime)
+
+    def test_failed_batch(self):
+        cp = ClientConfParser(infile=self.clients_conf)
+        self.assertRaises(ValueError, cp.add_clients,
+                          [("b", {"secret": "b"}), ("foo", {})])
+        self.assertRaises(ValueError, cp.add_clients,
+                          iter([("b", {"secret": "b"}), ("b", {})]))
+        self.assertRaises(KeyError, cp.update_clients,
+                          [("foo", {"secret": "x"}), ("missing", {})])
+        self.assertRaises(KeyError, cp.remove_clients,
+                          ["foo", "missing"])
+        self.assertRaises(KeyError, cp.remove_clients, ["foo", "foo"])
+        self.assertEqual(cp.commit()[:3], ([], [], []))
+        self.assertEqual(self._read(), self.original)
+        cp = ClientConfParser(content=self.original)
+        cp.remove_clients(["foo"])
+        self.assertRaises(ValueError, cp.commit)
+
+    def test_conflict(self):
+        cp = ClientConfParser(infile=self.clients_conf)
+        cp.remove_clients(["127.0.0.3"])
+        with open(self.clients_conf, "a") as f:
+            f.write(u"\nclient other {\n    secret = s\n}\n")
+        self.assertRaises(ConflictError, cp.commit)
+        self.assertIn("client other", self._read())
+        cp.rollback()
+        cp.remove_clients(["127.0.0.3"])
+        cp.commit()
+        self.assertNotIn("127.0.0.3", self._read())
+        self.assertIn("client other", self._read())
+
+    def test_new_file(self):
+        outfile = os.path.join(self.tmpdir, "new.conf")
+        cp = ClientConfParser(infile=outfile)
+        cp.add_clients([("client{0:d}".format(i), {"secret": "s"})
+                        for i in range(3)])
+        self.assertEqual(cp.commit().added, ["client0", "client1", "client2"])
+        self.assertEqual(list(cp.get_dict()), ["client0", "client1",
+                                               "client2"])
+        cp = ClientConfParser(content=u"client a {\n    secret = s\n}\n")
+        cp.upsert({"b": {"secret": "t"}})
+        cp.commit(outfile)
+        with open(outfile) as f:
+            self.assertEqual(f.read(), u"client a {\n    secret = s\n}\n"
+                                       u"\nclient b {\n    secret = t\n}\n")
+
+
+CLIENTS_CONF_TRIVIA = u"""# clients
+client a {
+\tipaddr\t= 10.0.0.1\t# the NAS
+\tsecret\t= s1
+\t# limits
+\tlimit {
+\t\tmax_connections = 16
+\t\tlifetime = 0
+\t}
+}
+
+client b {    secret = s2 }
+"""
+
+
+class TestClientConfTree(unittest.TestCase):
+
+    def test_lossless(self):
+        for filename in [SIMPLE_CLIENTS_CONF_TEST_FILE, CLIENTS_CONF_TEST_FILE,
+                         CLIENTS_CONF_RAD30_FILE]:
+            cp = ClientConfParser(infile=filename)
+            tree = cp.get_tree()
+            self.assertEqual(tree.get_dict(), cp.get_dict())
+            self.assertEqual(tree.text(), cp.content)
+            self.assertEqual(tree.text(cp.get_dict()), cp.content)
+        tree = ClientConfTree(CLIENTS_CONF_TRIVIA)
+        node = tree.clients[0]
+        self.assertEqual([child.key for child in node.children],
+                         ["ipaddr", "secret", "limit"])
+        limit = node.children[2]
+        self.assertEqual(CLIENTS_CONF_TRIVIA[limit.lead:limit.start],
+                         u"\n\t# limits\n\t")
+        self.assertEqual(CLIENTS_CONF_TRIVIA[limit.start:limit.end],
+                         u"limit {\n\t\tmax_connections = 16\n"
+                         u"\t\tlifetime = 0\n\t}")
+        self.assertRaises(ParseException, ClientConfTree, u"foo {\n}\n")
+
+    def test_minimal_edits(self):
+        tree = ClientConfTree(CLIENTS_CONF_TRIVIA)
+        config = tree.get_dict()
+        config["a"]["ipaddr"] = "10.0.0.2"
+        del config["a"]["secret"]
+        config["a"]["shortname"] = "a"
+        config["a"]["limit"]["lifetime"] = "30"
+        config["a"]["limit"]["idle_timeout"] = "10"
+        config["b"]["nas_type"] = "other"
+        text = tree.text(config)
+        self.assertEqual(text, u"""# clients
+client a {
+\tipaddr\t= 10.0.0.2\t# the NAS
+\t# limits
+\tlimit {
+\t\tmax_connections = 16
+\t\tlifetime = 30
+\t\tidle_timeout = 10
+\t}
+\tshortname = a
+}
+
+client b {    secret = s2 
+    nas_type = other
+}
+""")
+        self.assertEqual(ClientConfTree(text).get_dict(), config)
+        # a section replaced by a value and the other way round
+        config = tree.get_dict()
+        config["a"]["limit"] = "none"
+        config["a"]["secret"] = {"tls": {"file": "x"}}
+        text = tree.text(config)
+        self.assertIn(u"\tsecret tls {\n\t\tfile = x\n\t}\n", text)
+        self.assertIn(u"\t# limits\n\tlimit = none\n}", text)
+        self.assertEqual(ClientConfTree(text).get_dict(), config)
+
+    def test_patch_save(self):
+        tmpdir = tempfile.mkdtemp()
+        clients_conf = os.path.join(tmpdir, "clients.conf")
+        try:
+            with open(clients_conf, "w") as f:
+                f.write(CLIENTS_CONF_TRIVIA)
+            cp = ClientConfParser(infile=clients_conf)
+            config = cp.get_dict()
+            config["a"]["secret"] = "changed"
+            cp.save(config, patch=True)
+            with open(clients_conf) as f:
+                self.assertEqual(f.read(), CLIENTS_CONF_TRIVIA.replace(
+                    u"\tsecret\t= s1", u"\tsecret\t= changed"))
+            cp.update_clients({"b": {"secret": "s3"}})
+            cp.commit()
+            with open(clients_conf) as f:
+                self.assertIn(u"client b {    secret = s3 }\n", f.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestDiff(unittest.TestCase):
+
+    def test_clients(self):
+        old = ClientConfParser(content=CLIENTS_CONF_TRIVIA + u"""
+client c {
+    secret = s3
+}
+""")
+        self.assertEqual(diff(old, ClientConfParser(
+            content=CLIENTS_CONF_TRIVIA + u"client c { secret = s3 }\n")),
+            [])
+        new = ClientConfParser(content=u"""
+client b {
+    secret = s2
+    limit {
+        lifetime = 0
+    }
+}
+client a {
+\tipaddr\t= 10.0.0.2
+\tsecret\t= s1
+\tlimit {
+\t\tmax_connections = 8
+\t\tlifetime = 0
+\t\tidle_timeout = 30
+\t}
+}
+client d {
+    secret = s4
+}
+""")
+        self.assertEqual(diff(old, new), [
+            DiffRecord("remove", ("c",), {"secret": "s3"}, None),
+            DiffRecord("add", ("b", "limit"), None, {"lifetime": "0"}),
+            DiffRecord("modify", ("a", "ipaddr"), "10.0.0.1", "10.0.0.2"),
+            DiffRecord("modify", ("a", "limit", "max_connections"), "16",
+                       "8"),
+            DiffRecord("add", ("a", "limit", "idle_timeout"), None, "30"),
+            DiffRecord("add", ("d",), None, {"secret": "s4"})])
+
+    def test_clients_file(self):
+        tmpdir = tempfile.mkdtemp()
+        clients_conf = os.path.join(tmpdir, "clients.conf")
+        try:
+            shutil.copy(CLIENTS_CONF_TEST_FILE, clients_conf)
+            old = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE)
+            new = ClientConfParser(infile=clients_conf)
+            self.assertEqual(diff(old, new), [])
+            new.update_clients({"127.0.0.2": {"secret": "changed"}})
+            new.remove_clients(["foo"])
+            new.commit()
+            self.assertEqual([(r.action, r.path) for r in diff(old, new)],
+                             [("remove", ("foo",)),
+                              ("modify", ("127.0.0.2", "secret"))])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_users(self):
+        old = UserConfParser(content=u"""# users
+DEFAULT Auth-Type := perl
+
+bob Cleartext-Password := a
+\tReply-Message = hello,
+\tFramed-MTU = 1500
+
+alice Cleartext-Password := b
+
+bob Cleartext-Password := c
+""")
+        new = UserConfParser(content=u"""# users, changed
+DEFAULT Auth-Type := perl
+bob Cleartext-Password := a
+\tReply-Message = hi,
+\tClass = x
+
+alice Cleartext-Password := b
+alice Auth-Type := Reject
+
+DEFAULT Auth-Type := perl
+""")
+        self.assertEqual(diff(old, new), [
+            DiffRecord("remove", ("bob", 1),
+                       UserEntry("bob", (AttributeItem(
+                           "Cleartext-Password", ":=", "c"),), ()), None),
+            DiffRecord("remove", ("bob", 0, "reply_items", "Framed-MTU"),
+                       (AttributeItem("Framed-MTU", "=", "1500"),), None),
+            DiffRecord("modify", ("bob", 0, "reply_items", "Reply-Message"),
+                       (AttributeItem("Reply-Message", "=", "hello"),),
+                       (AttributeItem("Reply-Message", "=", "hi"),)),
+            DiffRecord("add", ("bob", 0, "reply_items", "Class"), None,
+                       (AttributeItem("Class", "=", "x"),)),
+            DiffRecord("add", ("alice", 1), None, UserEntry(
+                "alice", (AttributeItem("Auth-Type", ":=", "Reject"),), ())),
+            DiffRecord("add", ("DEFAULT", 1), None, UserEntry(
+                "DEFAULT", (AttributeItem("Auth-Type", ":=", "perl"),), ()))])
+        self.assertEqual(diff(new, new), [])
+
+
+USER_CONF_ODD_SYNTAX = [
+    u"DEFAULT\tAuth-Type := perl # comment\n",
+    u"# comment\nbob  Cleartext-Password:=  x\n\tReply-Message = a ,\n"
+    u"# comment\n\tFramed-MTU = 1500,, \n\n\tFramed-IP = 1.2.3.4\t\r\n",
+    u"bob Attr := x\n\tA =~ b\n",
+    u"bob Attr != 1\n\tA\t+=\tb,\n\tC !* ANY\nalice A := c\n",
+    u"bob Attr := 1\n\tA = b\n\tbroken\n",
+]
+
+
+class TestFastGrammar(unittest.TestCase):
+    """
+    The fast grammars have to return exactly what the reference grammars
+    return.
+    """
+
+    def _assert_equal_users(self, **kwargs):
+        reference = UserConfParser(**kwargs).get()
+        self.assertEqual(UserConfParser(fast=True, **kwargs).get().asList(),
+                         reference.asList())
+
+    def test_users(self):
+        for filename in [SIMPLE_USER_CONF_FILE, USER_CONF_RAD30_FILE]:
+            self._assert_equal_users(infile=filename)
+        for content in [USER_CONF_A, USER_CONF_B, USER_CONF_C, USER_CONF_D,
+                        USER_CONF_E] + USER_CONF_ODD_SYNTAX:
+            self._assert_equal_users(content=content)
+        for content in [u"bob Attr =~ x", u"bob Attr >= 1\n\tA <= 2",
+                        u"bob Attr =* x\n\tA !* x"]:
+            self._assert_equal_users(content=content)
+        self.assertEqual(UserConfParser(content=u"bob A >= 1\n\tB =~ x")
+                         .get_entries()[0],
+                         UserEntry("bob", (AttributeItem("A", ">=", "1"),),
+                                   (AttributeItem("B", "=~", "x"),)))
+        for content in [u"# nothing", u"bob Attr =! x", u"bob Attr >> 1"]:
+            self.assertRaises(ParseException,
+                              UserConfParser(content=content, fast=True).get)
+
+    def test_clients(self):
+        for filename in [SIMPLE_CLIENTS_CONF_TEST_FILE,
+                         CLIENTS_CONF_TEST_FILE,
+                         CLIENTS_CONF_RAD30_FILE]:
+            cp = ClientConfParser(infile=filename, fast=True)
+            self.assertEqual(cp.get().asList(),
+                             ClientConfParser(infile=filename).get().asList())
+        for content in CLIENTS_CONF_ODD_SYNTAX:
+            cp = ClientConfParser(content=content, fast=True)
+            self.assertEqual(cp.get().asList(),
+                             ClientConfParser(content=content).get().asList())
+            cp = ClientConfParser(content=content, fast=True,
+                                  incremental=True)
+            self.assertEqual(cp.get_dict(),
+                             ClientConfParser(content=content).get_dict())
+
+
+class TestLazyGrammar(unittest.TestCase):
+
+    script = u"""
+import sys
+from freeradiusparser import ClientConfParser, UserConfParser
+print("pyparsing" in sys.modules)
+ClientConfParser().save({"x": {"secret": "s"}}, "clients.out")
+UserConfParser().save([["bob", "A", ":=", "1", []]], "users.out")
+print("pyparsing" in sys.modules)
+ClientConfParser(content="client x { secret = s }").get()
+print("pyparsing" in sys.modules)
+"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pyparsing_is_imported_by_get(self):
+        module = sys.modules[ClientConfParser.__module__]
+        path = os.path.dirname(os.path.abspath(module.__file__))
+        env = dict(os.environ, PYTHONPATH=path)
+        output = subprocess.check_output([sys.executable, "-c", self.script],
+                                         cwd=self.tmpdir, env=env)
+        self.assertEqual(output.split(), [b"False", b"False", b"True"])
+
+    def test_grammar_is_shared(self):
+        self.assertIs(ClientConfParser.client_file,
+                      ClientConfParser(content=u"").client_file)
+        self.assertIs(UserConfParser.user_block, UserConfParser.user_block)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        self.users = os.path.join(self.tmpdir, "users")
+        shutil.copy(CLIENTS_CONF_TEST_FILE, self.clients_conf)
+        shutil.copy(USER_CONF_RAD30_FILE, self.users)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def _failing_parse(content):
+        raise AssertionError("parsed although the snapshot is current")
+
+    def test_clients(self):
+        expected = ClientConfParser(infile=self.clients_conf).get_dict()
+        cp = ClientConfParser(infile=self.clients_conf, snapshot=True,
+                              cache=None)
+        self.assertEqual(cp.get_dict(), expected)
+        self.assertEqual(cp.snapshot_file(),
+                         os.path.join(self.tmpdir, ".clients.conf.snapshot"))
+        self.assertTrue(os.path.exists(cp.snapshot_file()))
+        for cache in [None, ParseCache()]:
+            cp = ClientConfParser(infile=self.clients_conf, snapshot=True,
+                                  cache=cache)
+            cp._parse = self._failing_parse
+            config = cp.get_dict()
+            self.assertEqual(config, expected)
+            # every call returns a copy
+            config.clear()
+            self.assertEqual(cp.get_dict(), expected)
+
+    def test_changed_file(self):
+        cp = ClientConfParser(infile=self.clients_conf, snapshot=True,
+                              cache=None)
+        cp.get_dict()
+        with open(self.clients_conf, "a") as f:
+            f.write(u"client new {\n    secret = s\n}\n")
+        self.assertEqual(cp.get_dict()["new"], {"secret": "s"})
+        cp._parse = self._failing_parse
+        self.assertEqual(cp.get_dict()["new"], {"secret": "s"})
+
+    def test_invalid_snapshot(self):
+        cp = ClientConfParser(infile=self.clients_conf, snapshot=True)
+        for snapshot in [b"", b"garbage", b"freeradiusparser snapshot 0"]:
+            with open(cp.snapshot_file(), "wb") as f:
+                f.write(snapshot)
+            self.assertEqual(
+                ClientConfParser(infile=self.clients_conf, snapshot=True,
+                                 cache=None).get_dict(),
+                ClientConfParser(infile=self.clients_conf).get_dict())
+
+    def test_damaged_snapshot(self):
+        expected = ClientConfParser(infile=self.clients_conf).get_dict()
+        ClientConfParser(infile=self.clients_conf, snapshot=True).get_dict()
+        snapshot_file = os.path.join(self.tmpdir, ".clients.conf.snapshot")
+        with open(snapshot_file, "rb") as f:
+            snapshot = f.read()
+        with open(snapshot_file, "wb") as f:
+            f.write(snapshot[:-10])
+        cp = ClientConfParser(infile=self.clients_conf, snapshot=True)
+        self.assertEqual(cp.get_dict(), expected)
+        # the snapshot was taken again
+        cp._parse = self._failing_parse
+        self.assertEqual(cp.get_dict(), expected)
+
+    def test_users(self):
+        expected = UserConfParser(infile=self.users).get_entries()
+        up = UserConfParser(infile=self.users, snapshot=True, cache=None)
+        self.assertEqual(up.get_entries(), expected)
+        up._parse = self._failing_parse
+        entries = up.get_entries()
+        self.assertEqual(entries, expected)
+        self.assertTrue(isinstance(entries[0], UserEntry))
+        self.assertTrue(isinstance(entries[0].reply_items[0], AttributeItem))
+        self.assertTrue(entries[0].reply_items[0].operator
+                        is entries[1].reply_items[0].operator)
+        self.assertEqual(up.get_dict(),
+                         UserConfParser(infile=self.users).get_dict())
+
+
+@unittest.skipIf(asyncio is None, "asyncio needs Python 3")
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _await(self, func):
+        """
+        Call func in the running event loop and wait for the future it
+        returns.
+        """
+        result = self.loop.create_future()
+
+        def done(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+        self.loop.call_soon(lambda: func().add_done_callback(done))
+        return self.loop.run_until_complete(result)
+
+    def test_concurrent_calls_share_a_parse(self):
+        cp = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE, cache=None)
+        parsed = []
+        parse = cp._parse
+
+        def counting_parse(content):
+            parsed.append(content)
+            return parse(content)
+        cp._parse = counting_parse
+
+        def aget_dicts():
+            return asyncio.gather(*[cp.aget_dict() for _i in range(3)])
+        results = self._await(aget_dicts)
+        self.assertEqual(len(parsed), 1)
+        expected = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE).get_dict()
+        for config in results:
+            self.assertEqual(config, expected)
+        self.assertFalse(results[0] is results[1])
+        # later calls parse again
+        self._await(aget_dicts)
+        self.assertEqual(len(parsed), 2)
+
+    def test_options_are_not_shared(self):
+        clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        with open(clients_conf, "w") as f:
+            f.write(u"client a {\n    secret = s\n}\nclient b {\n}\n"
+                    u"client {\n}\n")
+        resilient = ClientConfParser(infile=clients_conf, resilient=True)
+        strict = ClientConfParser(infile=clients_conf, backend="native")
+
+        def aget_dicts():
+            return asyncio.gather(resilient.aget_dict(), strict.aget_dict(),
+                                  return_exceptions=True)
+        results = self._await(aget_dicts)
+        self.assertEqual(sorted(results[0]), ["a", "b"])
+        self.assertEqual(sorted(results[1]), ["a", "b"])
+        self.assertEqual(len(resilient.errors), 1)
+        with open(clients_conf, "w") as f:
+            f.write(u"client {\n}\nclient a {\n    secret = s\n}\n")
+        results = self._await(aget_dicts)
+        self.assertEqual(sorted(results[0]), ["a"])
+        self.assertTrue(isinstance(results[1], ParseException))
+
+    def test_process_pool(self):
+        executor = ProcessPoolExecutor(1)
+        try:
+            for parser in [ClientConfParser(infile=CLIENTS_CONF_TEST_FILE),
+                           UserConfParser(infile=USER_CONF_RAD30_FILE)]:
+                parser.get()
+                config = self._await(
+                    lambda: parser.aget_dict(executor=executor))
+                self.assertEqual(config, parser.get_dict())
+        finally:
+            executor.shutdown()
+
+    def test_parse_error(self):
+        cp = ClientConfParser(content=u"# nothing")
+        self.assertRaises(ParseException, self._await, cp.aget_dict)
+
+    def test_asave(self):
+        outfile = os.path.join(self.tmpdir, "clients.conf")
+        cp = ClientConfParser(infile=outfile)
+        self._await(lambda: cp.asave({"c1": {"secret": "s1"}}, outfile))
+        self.assertEqual(cp.get_dict(), {"c1": {"secret": "s1"}})
+        self._await(lambda: cp.asave({"c1": {"secret": "s1"},
+                                      "c2": {"secret": "s2"}}, patch=True))
+        self.assertEqual(cp.get_dict(), {"c1": {"secret": "s1"},
+                                         "c2": {"secret": "s2"}})
+
+
+class TestLockedSave(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        shutil.copy(CLIENTS_CONF_TEST_FILE, self.clients_conf)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _version(self):
+        with open(self.clients_conf, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    @unittest.skipUnless(hasattr(os, "geteuid") and os.geteuid() == 0,
+                         "only root may change the owner of a file")
+    def test_owner_is_kept(self):
+        os.chown(self.clients_conf, 1234, 5678)
+        cp = ClientConfParser(infile=self.clients_conf)
+        config = cp.get_dict()
+        config["new"] = {"secret": "s"}
+        cp.save(config)
+        st = os.stat(self.clients_conf)
+        self.assertEqual((st.st_uid, st.st_gid), (1234, 5678))
+
+    @unittest.skipIf(hasattr(os, "geteuid") and os.geteuid() == 0,
+                     "root may write to any directory")
+    def test_directory_not_writable(self):
+        os.chmod(self.tmpdir, 0o555)
+        try:
+            cp = ClientConfParser(infile=self.clients_conf)
+            config = cp.get_dict()
+            config["new"] = {"secret": "s"}
+            cp.save(config)
+            with cp.transaction() as config:
+                del config["foo"]
+        finally:
+            os.chmod(self.tmpdir, 0o755)
+        self.assertEqual(sorted(ClientConfParser(infile=self.clients_conf)
+                                .get_dict()),
+                         ["127.0.0.1", "127.0.0.2", "127.0.0.3", "127.0.0.4",
+                          "new"])
+        self.assertEqual(os.listdir(self.tmpdir), ["clients.conf"])
+
+    def test_new_file_mode(self):
+        outfile = os.path.join(self.tmpdir, "new.conf")
+        umask = os.umask(0o022)
+        try:
+            ClientConfParser(infile=self.clients_conf).save(
+                {"new": {"secret": "s"}}, outfile)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(outfile).st_mode & 0o777, 0o644)
+
+    def test_transaction_parses_once(self):
+        stats = ParseStats()
+        cp = ClientConfParser(infile=self.clients_conf, stats=stats)
+        with cp.transaction() as config:
+            config["new"] = {"secret": "s"}
+        self.assertEqual(stats.blocks, 5)
+
+    def test_version(self):
+        for cache in [None, ParseCache()]:
+            cp = ClientConfParser(infile=self.clients_conf, cache=cache)
+            self.assertEqual(cp.version, None)
+            cp.get()
+            self.assertEqual(cp.version, self._version())
+            cp.get()
+            self.assertEqual(cp.version, self._version())
+        cp = ClientConfParser(infile=self.clients_conf, snapshot=True)
+        cp.get_dict()
+        self.assertEqual(cp.version, self._version())
+
+    def test_expected_version(self):
+        cp = ClientConfParser(infile=self.clients_conf)
+        other = ClientConfParser(infile=self.clients_conf)
+        config = cp.get_dict()
+        other.get_dict()
+        config["new"] = {"secret": "s"}
+        cp.save(config, expected_version=cp.version)
+        self.assertEqual(cp.version, self._version())
+        # the parser can save again without reading the file
+        cp.save(config, expected_version=cp.version, patch=True)
+        saved = self._version()
+        self.assertRaises(ConflictError, other.save, {"x": {"secret": "s"}},
+                          expected_version=other.version)
+        self.assertEqual(self._version(), saved)
+        self.assertRaises(ConflictError, cp.save, config,
+                          os.path.join(self.tmpdir, "missing"),
+                          expected_version=cp.version)
+        # expected_version is the third argument of every parser
+        self.assertRaises(ConflictError, other.save, {"x": {"secret": "s"}},
+                          None, other.version)
+        users = os.path.join(self.tmpdir, "users")
+        shutil.copy(SIMPLE_USER_CONF_FILE, users)
+        self.assertRaises(ConflictError, UserConfParser(infile=users).save,
+                          [["bob", "A", ":=", "1", []]], None, "0")
+
+    def test_transaction(self):
+        cp = ClientConfParser(infile=self.clients_conf)
+        writes = []
+        write_config = cp._write_config
+
+        def counting_write_config(*args, **kwargs):
+            writes.append(args)
+            write_config(*args, **kwargs)
+        cp._write_config = counting_write_config
+        with cp.transaction(patch=True) as config:
+            for i in range(10):
+                config["new{0:d}".format(i)] = {"secret": str(i)}
+            del config["foo"]
+        self.assertEqual(len(writes), 1)
+        config = ClientConfParser(infile=self.clients_conf).get_dict()
+        self.assertEqual(len(config), 14)
+        self.assertFalse("foo" in config)
+        # unchanged
+        with cp.transaction():
+            pass
+        self.assertEqual(len(writes), 1)
+        with self.assertRaises(ValueError):
+            with cp.transaction() as config:
+                config["x"] = {"secret": "x"}
+                raise ValueError()
+        self.assertEqual(len(writes), 1)
+
+    def test_users_transaction(self):
+        users = os.path.join(self.tmpdir, "users")
+        up = UserConfParser(infile=users)
+        with up.transaction() as config:
+            config["bob"] = [UserEntry("bob", (AttributeItem(
+                "Cleartext-Password", ":=", '"x"'),), ())]
+        self.assertEqual(UserConfParser(infile=users).get_dict(), config)
+
+    def test_concurrent_transactions(self):
+        def add_clients(n):
+            for i in range(10):
+                cp = ClientConfParser(infile=self.clients_conf)
+                with cp.transaction(patch=True) as config:
+                    config["t{0:d}-{1:d}".format(n, i)] = {"secret": "s"}
+        threads = [threading.Thread(target=add_clients, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        config = ClientConfParser(infile=self.clients_conf).get_dict()
+        self.assertEqual(len(config), 45)
+
+
+class TestParseStats(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_clients(self):
+        recorded = []
+        stats = ParseStats(callback=lambda name, value: recorded.append(name))
+        cp = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE, cache=None,
+                              stats=stats)
+        config = cp.get_dict()
+        self.assertEqual(stats.bytes_read,
+                         os.path.getsize(CLIENTS_CONF_TEST_FILE))
+        self.assertEqual(stats.blocks, 5)
+        self.assertTrue(stats.parse_time > 0)
+        self.assertTrue(stats.dict_time > 0)
+        self.assertEqual(stats.write_time, 0)
+        outfile = os.path.join(self.tmpdir, "clients.conf")
+        cp.save(config, outfile)
+        self.assertEqual(stats.bytes_written, os.path.getsize(outfile))
+        self.assertTrue(stats.format_time > 0)
+        self.assertTrue(stats.write_time > 0)
+        self.assertEqual(recorded, ["read_time", "bytes_read", "parse_time",
+                                    "blocks", "dict_time", "format_time",
+                                    "write_time", "bytes_written"])
+        self.assertEqual(list(stats.as_dict()), list(ParseStats.counters))
+        stats.reset()
+        self.assertEqual(set(stats.as_dict().values()), set([0]))
+
+    def test_users(self):
+        stats = ParseStats()
+        up = UserConfParser(infile=USER_CONF_RAD30_FILE, stats=stats,
+                            cache=None)
+        self.assertEqual(stats.blocks, 0)
+        self.assertEqual(len(up.get_entries()), stats.blocks)
+        up = UserConfParser(content=u"bob Cleartext-Password := x",
+                            stats=stats)
+        up.get()
+        self.assertEqual(stats.bytes_read,
+                         os.path.getsize(USER_CONF_RAD30_FILE))
+
+    def test_cli(self):
+        outfile = os.path.join(self.tmpdir, "clients.conf")
+        self.assertEqual(main(["stats", CLIENTS_CONF_TEST_FILE,
+                               "--backend", "native", "--save", outfile]), 0)
+        output = self.capsys.readouterr().out
+        lines = dict(line.split(None, 1) for line in output.splitlines())
+        self.assertEqual(lines["blocks"].strip(), "5")
+        self.assertEqual(int(lines["bytes_written"]),
+                         os.path.getsize(outfile))
+        main(["stats", USER_CONF_RAD30_FILE, "--type", "users", "--profile",
+              "--lines", "3"])
+        output = self.capsys.readouterr().out
+        self.assertTrue("function calls" in output)
+        self.assertTrue("get_entries" in output)
+
+
+class TestResilientParse(unittest.TestCase):
+    CLIENTS = (u"client a {\n    secret = s\n}\n"
+               u"client b {\n    secret\n}\n"
+               u"client c {\n    secret = t\n}\n"
+               u"client {\n}\n"
+               u"client d {\n    secret = u\n}\n")
+    USERS = (u"bob Cleartext-Password := a\n"
+             u"\tReply-Message = x,\n"
+             u"!bad\n"
+             u"# comment\n"
+             u"alice Cleartext-Password := b\n"
+             u"\tReply-Message\n"
+             u"carol Cleartext-Password := c\n")
+
+    def test_clients(self):
+        cp = ClientConfParser(content=self.CLIENTS, resilient=True)
+        self.assertEqual(list(cp.get_dict()), ["a", "c", "d"])
+        self.assertEqual(cp.errors,
+                         [ParseError(5, 5, "Expected '}'"),
+                          ParseError(10, 8, "Expected client key")])
+        self.assertEqual(cp.find_errors(), cp.errors)
+        self.assertEqual(ClientConfParser(content=self.CLIENTS).errors, [])
+        # no client keyword to go on with
+        cp = ClientConfParser(content=u"client a {\n}\nfoo\n",
+                              resilient=True)
+        self.assertEqual(list(cp.get_dict()), ["a"])
+        self.assertEqual(cp.errors, [ParseError(3, 1, "Expected 'client'")])
+        for filename in [CLIENTS_CONF_TEST_FILE, CLIENTS_CONF_RAD30_FILE]:
+            cp = ClientConfParser(infile=filename, resilient=True)
+            self.assertEqual(cp.get_dict(),
+                             ClientConfParser(infile=filename).get_dict())
+            self.assertEqual(cp.errors, [])
+
+    def test_users(self):
+        for fast in [False, True]:
+            up = UserConfParser(content=self.USERS, resilient=True,
+                                fast=fast)
+            self.assertEqual([entry[0] for entry in up.get_entries()],
+                             ["bob", "carol"])
+            self.assertEqual([(e.line, e.column) for e in up.errors],
+                             [(3, 1), (6, 9)])
+            self.assertEqual(up.find_errors(), up.errors)
+        up = UserConfParser(infile=USER_CONF_RAD30_FILE, resilient=True)
+        self.assertEqual(up.get_entries(),
+                         UserConfParser(infile=USER_CONF_RAD30_FILE)
+                         .get_entries())
+        self.assertEqual(up.errors, [])
+
+    def test_cache(self):
+        cache = ParseCache()
+        cp = ClientConfParser(content=self.CLIENTS, resilient=True,
+                              cache=cache)
+        cp.get()
+        cp = ClientConfParser(content=self.CLIENTS, resilient=True,
+                              cache=cache)
+        self.assertEqual(len(cp.get()), 3)
+        self.assertEqual(len(cp.errors), 2)
+        cp = ClientConfParser(content=self.CLIENTS, cache=cache)
+        self.assertEqual(len(cp.get()), 1)
+        self.assertEqual(cp.errors, [])
+
+
+class TestParseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        shutil.copy(SIMPLE_CLIENTS_CONF_TEST_FILE, self.clients_conf)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _count_reads(self, parser):
+        reads = []
+        read = parser._read
+
+        def counting_read():
+            reads.append(1)
+            read()
+        parser._read = counting_read
+        return reads
+
+    def test_no_cache_by_default(self):
+        # the result of get() can be modified like before
+        for client in ClientConfParser(infile=self.clients_conf).get():
+            client.pop(0)
+        self.assertEqual(list(ClientConfParser(infile=self.clients_conf)
+                              .get_dict()),
+                         ["localhost", "private-network-1"])
+        for user in UserConfParser(infile=USER_CONF_RAD30_FILE).get():
+            user.pop(0)
+        self.assertEqual(UserConfParser(infile=USER_CONF_RAD30_FILE)
+                         .get_entries()[0].username, "DEFAULT")
+
+    def test_unchanged_file_is_not_parsed_again(self):
+        cp = ClientConfParser(infile=self.clients_conf, cache=ParseCache())
+        reads = self._count_reads(cp)
+        config = cp.get()
+        self.assertIs(cp.get(), config)
+        self.assertEqual(len(reads), 1)
+        # get_dict must not modify the shared result
+        self.assertEqual(cp.get_dict(), cp.get_dict())
+        self.assertEqual(len(reads), 1)
+
+    def test_changed_file_is_parsed_again(self):
+        cp = ClientConfParser(infile=self.clients_conf, cache=ParseCache())
+        self.assertEqual(len(cp.get_dict()), 2)
+        with open(self.clients_conf, "a") as f:
+            f.write("client new {\n    secret = new\n}\n")
+        self.assertEqual(cp.get_dict()["new"], {"secret": "new"})
+
+    def test_content_hash(self):
+        cache = ParseCache(use_hash=True)
+        cp = ClientConfParser(infile=self.clients_conf, cache=cache)
+        self.assertEqual(cp.get_dict()["localhost"]["secret"], "testing123")
+        # same size and mtime, only the hash notices the change
+        st = os.stat(self.clients_conf)
+        with open(self.clients_conf) as f:
+            content = f.read()
+        with open(self.clients_conf, "w") as f:
+            f.write(content.replace("testing123\n", "testing456\n"))
+        os.utime(self.clients_conf, (st.st_atime, st.st_mtime))
+        self.assertEqual(cp.get_dict()["localhost"]["secret"], "testing456")
+
+    def test_invalidate(self):
+        cache = ParseCache()
+        cp = ClientConfParser(infile=self.clients_conf, cache=cache)
+        reads = self._count_reads(cp)
+        cp.get()
+        cp.invalidate()
+        self.assertEqual(len(cache), 0)
+        cp.get()
+        self.assertEqual(len(reads), 2)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_lru(self):
+        cache = ParseCache(maxsize=2)
+        users = os.path.join(self.tmpdir, "users")
+        shutil.copy(SIMPLE_USER_CONF_FILE, users)
+        ClientConfParser(infile=self.clients_conf, cache=cache).get()
+        ClientConfParser(infile=self.clients_conf, cache=cache,
+                         backend="native").get()
+        UserConfParser(infile=users, cache=cache).get()
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get((os.path.abspath(self.clients_conf),
+                                    "ClientConfParser", "pyparsing"),
+                                   cache.signature(self.clients_conf)),
+                         None)
+
+    def test_no_cache(self):
+        cp = ClientConfParser(infile=self.clients_conf, cache=None)
+        self.assertIsNot(cp.get(), cp.get())
+
+
 class TestFreeRADIUSUsers(unittest.TestCase):
 
     @pytest.fixture(autouse=True)
@@ -310,9 +1769,11 @@ class TestFreeRADIUSUsers(unittest.TestCase):
         self.assertEqual(config[0][1], "Auth-Type")
         self.assertEqual(config[0][2], ":=")
         self.assertEqual(config[0][3], "perl")
-        # get_dict isn't implemented
         r1 = UP.get_dict()
-        assert r1 is None
+        self.assertEqual(list(r1), ["DEFAULT"])
+        self.assertEqual(r1["DEFAULT"], [
+            UserEntry("DEFAULT", (AttributeItem("Auth-Type", ":=", "perl"),),
+                      ())])
 
     def test_users_password(self):
         UP = UserConfParser(content=USER_CONF_B)
@@ -382,6 +1843,12 @@ class TestFreeRADIUSUsers(unittest.TestCase):
         os.unlink(tmpfile)
         self.assertEqual(output, FILEOUTPUT_USER_ORIG)
 
+    def test_format_to(self):
+        UP = UserConfParser(infile=USER_CONF_RAD30_FILE)
+        output = io.StringIO()
+        UP.format_to(UP.get(), output)
+        self.assertEqual(output.getvalue(), FILEOUTPUT_USER_ORIG)
+
     def test_read_user_from_file(self):
         UP = UserConfParser(infile=SIMPLE_USER_CONF_FILE)
         config = UP.get()
@@ -390,10 +1857,32 @@ class TestFreeRADIUSUsers(unittest.TestCase):
         self.assertEqual(user1[0], "administrator")
         self.assertEqual(user2[0], "DEFAULT")
 
-        # Just dump it, dump() currently does nothing
         UP.dump()
         captured = self.capsys.readouterr()
-        assert captured.out == ''
+        assert captured.out == (
+            "administrator: [['Cleartext-Password', ':=', '\"secret\"']] []\n"
+            "DEFAULT: [['Auth-Type', ':=', 'perl']] []\n")
+
+    def test_entries(self):
+        UP = UserConfParser(infile=USER_CONF_RAD30_FILE)
+        entries = UP.get_entries()
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries[1].username, "DEFAULT")
+        self.assertEqual(entries[1].check_items,
+                         (AttributeItem("Hint", "==", '"CSLIP"'),))
+        self.assertEqual(entries[1].reply_items[1].attribute,
+                         "Framed-Compression")
+        self.assertEqual(entries[1].reply_items[1].value,
+                         "Van-Jacobson-TCP-IP")
+        # attribute names are shared between the entries
+        self.assertIs(entries[1].reply_items[0].attribute,
+                      entries[2].reply_items[0].attribute)
+        config = UP.get_dict()
+        self.assertEqual(list(config), ["DEFAULT"])
+        self.assertEqual(config["DEFAULT"], entries)
+        # entries and the dictionary can be written again
+        self.assertEqual(UP.format(entries), FILEOUTPUT_USER_ORIG)
+        self.assertEqual(UP.format(config), FILEOUTPUT_USER_ORIG)
 
     def test_current_user_config_from_github(self):
         try:
@@ -406,3 +1895,335 @@ class TestFreeRADIUSUsers(unittest.TestCase):
         up = UserConfParser(content=content)
         output = up.format(up.get())
         assert output == FILEOUTPUT_USER_ORIG
+
+
+class TestParseFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_d = os.path.join(self.tmpdir, "clients.d")
+        os.mkdir(self.clients_d)
+        shutil.copy(CLIENTS_CONF_RAD30_FILE,
+                    os.path.join(self.clients_d, "10-rad30"))
+        shutil.copy(CLIENTS_CONF_TEST_FILE,
+                    os.path.join(self.clients_d, "20-test"))
+        # ignored like FreeRADIUS does
+        shutil.copy(CLIENTS_CONF_TEST_FILE,
+                    os.path.join(self.clients_d, ".hidden"))
+        shutil.copy(CLIENTS_CONF_TEST_FILE,
+                    os.path.join(self.clients_d, "20-test~"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_clients(self):
+        result = parse_files([SIMPLE_CLIENTS_CONF_TEST_FILE, self.clients_d],
+                             max_workers=2, backend="native")
+        self.assertEqual(
+            list(result.config),
+            ["localhost", "private-network-1", "localhost_ipv6",
+             "127.0.0.1", "127.0.0.2", "127.0.0.3", "127.0.0.4", "foo"])
+        # the last file wins
+        self.assertEqual(result.config["localhost"]["secret"], "testing123")
+        self.assertIn("limit", result.config["localhost"])
+        self.assertEqual(result.sources["localhost"],
+                         os.path.join(self.clients_d, "10-rad30"))
+        self.assertEqual(result.sources["foo"],
+                         os.path.join(self.clients_d, "20-test"))
+        self.assertEqual(result.sources["private-network-1"],
+                         SIMPLE_CLIENTS_CONF_TEST_FILE)
+
+    def test_users(self):
+        result = parse_files([SIMPLE_USER_CONF_FILE, USER_CONF_RAD30_FILE],
+                             parser_class=UserConfParser)
+        self.assertEqual(list(result.config), ["administrator", "DEFAULT"])
+        self.assertEqual(len(result.config["DEFAULT"]), 4)
+        self.assertEqual(result.sources["DEFAULT"],
+                         [SIMPLE_USER_CONF_FILE] + [USER_CONF_RAD30_FILE] * 3)
+
+    def test_error(self):
+        self.assertRaises(ParseException, parse_files,
+                          [SIMPLE_CLIENTS_CONF_TEST_FILE,
+                           SIMPLE_USER_CONF_FILE])
+
+
+class TestIncludes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "clients.d"))
+        self._write("clients.conf",
+                    u"client a {\n    secret = a\n}\n"
+                    u"$INCLUDE clients.d/\n"
+                    u"# comment\n"
+                    u"$-INCLUDE missing.conf\n"
+                    u"client z {\n    secret = z\n}\n")
+        self._write("clients.d/b", u"client b {\n    secret = b\n}\n")
+        self._write("clients.d/c", u"$INCLUDE ../c.conf\n")
+        self._write("c.conf", u"client c {\n    secret = c\n}\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, filename, content):
+        with open(os.path.join(self.tmpdir, filename), "w") as f:
+            f.write(content)
+
+    def _parser(self, **kwargs):
+        return ClientConfParser(infile=os.path.join(self.tmpdir,
+                                                    "clients.conf"),
+                                resolve_includes=True, cache=ParseCache(),
+                                **kwargs)
+
+    def test_clients(self):
+        for backend in ClientConfParser.backends:
+            cp = self._parser(backend=backend)
+            self.assertEqual([c[0] for c in cp.get()], ["a", "b", "c", "z"])
+            self.assertEqual(cp.get_dict()["c"], {"secret": "c"})
+            clients_conf = os.path.join(self.tmpdir, "clients.conf")
+            self.assertEqual(cp.includes[clients_conf],
+                             [os.path.join(self.tmpdir, "clients.d/"),
+                              os.path.join(self.tmpdir, "missing.conf")])
+
+    def test_only_changed_files_are_parsed(self):
+        cp = self._parser()
+        cp.get()
+        parsed = []
+        parse = cp._parse
+
+        def counting_parse(content):
+            parsed.append(content)
+            return parse(content)
+        cp._parse = counting_parse
+        self._write("c.conf", u"client c {\n    secret = changed\n}\n")
+        self.assertEqual(cp.get_dict()["c"], {"secret": "changed"})
+        self.assertEqual(parsed, [u"client c {\n    secret = changed\n}\n"])
+
+    def test_cycle(self):
+        self._write("c.conf", u"$INCLUDE clients.conf\n")
+        self.assertRaises(IncludeError, self._parser().get)
+
+    def test_depth(self):
+        self._write("c.conf", u"client c {\n    secret = c\n}\n")
+        cp = self._parser()
+        cp.max_include_depth = 1
+        self.assertRaises(IncludeError, cp.get)
+
+    def test_include_in_block(self):
+        self._write("c.conf", u"client c {\n    # {\n    secret = c\n"
+                              u"$INCLUDE secret.conf\n}\n")
+        self.assertRaises(IncludeError, self._parser().get)
+        # includes between the blocks are still resolved
+        self._write("c.conf", u"client c {\n    secret = c\n}\n"
+                              u"$INCLUDE c2.conf\n"
+                              u"client d {\n    secret = d\n}\n")
+        self._write("c2.conf", u"client c2 {\n    secret = c2\n}\n")
+        self.assertEqual(list(self._parser().get_dict()),
+                         ["a", "b", "c", "c2", "d", "z"])
+
+    def test_missing(self):
+        self._write("c.conf", u"$INCLUDE missing.conf\n")
+        self.assertRaises(EnvironmentError, self._parser().get)
+
+    def test_users(self):
+        self._write("users", u"$INCLUDE users.other\n"
+                             u"DEFAULT Auth-Type := perl\n")
+        self._write("users.other", u'bob Cleartext-Password := "x"\n')
+        up = UserConfParser(infile=os.path.join(self.tmpdir, "users"),
+                            resolve_includes=True)
+        self.assertEqual(list(up.get_dict()), ["bob", "DEFAULT"])
+
+
+class TestConfigWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        self._write({"a": "1", "b": "2", "c": "3"})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, secrets):
+        # replace the file like an editor does
+        tmpfile = self.clients_conf + ".tmp"
+        with open(tmpfile, "w") as f:
+            for client, secret in sorted(secrets.items()):
+                f.write(u"client {0!s} {{\n    secret = {1!s}\n}}\n".format(
+                    client, secret))
+        os.rename(tmpfile, self.clients_conf)
+
+    def test_check(self):
+        watcher = ConfigWatcher(ClientConfParser(infile=self.clients_conf))
+        events = []
+        watcher.subscribe(events.append)
+        self.assertEqual(watcher.check(), None)
+        self._write({"a": "1", "b": "changed", "d": "4"})
+        event = watcher.check()
+        self.assertEqual(event, ChangeEvent(["d"], ["c"], ["b"],
+                                            watcher.config))
+        self.assertEqual(events, [event])
+        self.assertEqual(watcher.check(), None)
+        # same clients, the comment does not change anything
+        with open(self.clients_conf, "a") as f:
+            f.write(u"# comment\n")
+        self.assertEqual(watcher.check(), None)
+        # a broken file is skipped
+        with open(self.clients_conf, "w") as f:
+            f.write(u"client")
+        self.assertEqual(watcher.check(), None)
+        self.assertEqual(sorted(watcher.config), ["a", "b", "d"])
+
+    def test_users(self):
+        users = os.path.join(self.tmpdir, "users")
+        with open(users, "w") as f:
+            f.write(u"bob Cleartext-Password := a\n")
+        watcher = ConfigWatcher(UserConfParser(infile=users))
+        with open(users, "a") as f:
+            f.write(u"alice Cleartext-Password := b\n")
+        event = watcher.check()
+        self.assertEqual((event.added, event.removed, event.modified),
+                         (["alice"], [], []))
+
+    def test_includes(self):
+        main_conf = os.path.join(self.tmpdir, "main.conf")
+        with open(main_conf, "w") as f:
+            f.write(u"$INCLUDE clients.conf\n")
+        parser = ClientConfParser(infile=main_conf, resolve_includes=True)
+        watcher = ConfigWatcher(parser)
+        self.assertEqual(watcher.paths(), [main_conf, self.clients_conf])
+        parser.get_dict = None
+        # nothing changed since the first get_dict()
+        self.assertEqual(watcher.check(), None)
+
+    def _assert_published(self, use_inotify):
+        parser = ClientConfParser(infile=self.clients_conf)
+        watcher = ConfigWatcher(parser, interval=0.05, debounce=0.2,
+                                use_inotify=use_inotify)
+        events = []
+        published = threading.Event()
+
+        def callback(event):
+            events.append(event)
+            published.set()
+        watcher.subscribe(callback)
+        with watcher:
+            # a burst of writes is published once
+            for i in range(5):
+                self._write({"a": "1", "b": "2", "c": str(i)})
+                time.sleep(0.01)
+            self.assertTrue(published.wait(5))
+            time.sleep(0.3)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].modified, ["c"])
+        self.assertEqual(events[0].config["c"], {"secret": "4"})
+
+    def test_inotify(self):
+        self._assert_published(use_inotify=True)
+
+    def test_polling(self):
+        self._assert_published(use_inotify=False)
+
+
+class TestCommandLine(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_validate_method(self):
+        for filename in [CLIENTS_CONF_TEST_FILE, CLIENTS_CONF_RAD30_FILE]:
+            ClientConfParser(infile=filename).validate()
+        UserConfParser(infile=USER_CONF_RAD30_FILE).validate()
+        # get() stops at the broken block, validate() does not
+        cp = ClientConfParser(content=u"client a {\n    secret = s\n}\n"
+                                      u"client b {\n    secret\n}\n")
+        self.assertEqual(list(cp.get_dict()), ["a"])
+        with self.assertRaises(ParseException) as cm:
+            cp.validate()
+        self.assertEqual((cm.exception.lineno, cm.exception.col), (5, 5))
+        up = UserConfParser(content=u"$INCLUDE other\nbob A := b\n"
+                                    u"\tX = y,\n!bad\n")
+        with self.assertRaises(ParseException) as cm:
+            up.validate()
+        self.assertEqual((cm.exception.lineno, cm.exception.col), (4, 1))
+
+    def test_iter_entries(self):
+        for content in [USER_CONF_A, USER_CONF_B, USER_CONF_C, USER_CONF_D,
+                        USER_CONF_E] + USER_CONF_ODD_SYNTAX:
+            up = UserConfParser(content=content)
+            self.assertEqual(list(up.iter_entries()), up.get_entries())
+        up = UserConfParser(infile=USER_CONF_RAD30_FILE, fast=True)
+        self.assertEqual(list(up.iter_entries()), up.get_entries())
+        up = UserConfParser(content=u"# nothing")
+        self.assertRaises(ParseException, list, up.iter_entries())
+
+    def test_validate(self):
+        broken = os.path.join(self.tmpdir, "broken.conf")
+        with open(broken, "w") as f:
+            f.write(u"client a {\n    secret = s\n}\nclient {\n}\n"
+                    u"client b {\n    secret\n}\n")
+        for jobs in ["1", "2"]:
+            self.assertEqual(main(["validate", "--jobs", jobs,
+                                   CLIENTS_CONF_TEST_FILE, self.tmpdir]), 1)
+            captured = self.capsys.readouterr()
+            self.assertEqual(captured.out,
+                             broken + ":4:8: Expected client key\n" +
+                             broken + ":7:5: Expected '}'\n")
+            self.assertEqual(captured.err, "2 files, 1 invalid\n")
+        self.assertEqual(main(["validate", "--type", "users",
+                               USER_CONF_RAD30_FILE]), 0)
+
+    def test_clients_json(self):
+        json_file = os.path.join(self.tmpdir, "clients.json")
+        outfile = os.path.join(self.tmpdir, "clients.conf")
+        self.assertEqual(main(["to-json", CLIENTS_CONF_TEST_FILE,
+                               "-o", json_file]), 0)
+        expected = ClientConfParser(infile=CLIENTS_CONF_TEST_FILE).get_dict()
+        with open(json_file) as f:
+            self.assertEqual(json.load(f), expected)
+        self.assertEqual(main(["from-json", json_file, "-o", outfile]), 0)
+        self.assertEqual(ClientConfParser(infile=outfile).get_dict(),
+                         expected)
+        with open(json_file, "w") as f:
+            f.write(u"[]")
+        self.assertRaises(ValueError, main,
+                          ["from-json", json_file, "-o", outfile])
+
+    def test_users_json(self):
+        json_file = os.path.join(self.tmpdir, "users.json")
+        outfile = os.path.join(self.tmpdir, "users")
+        main(["to-json", "--type", "users", USER_CONF_RAD30_FILE,
+              "-o", json_file])
+        main(["from-json", "--type", "users", json_file, "-o", outfile])
+        self.assertEqual(UserConfParser(infile=outfile).get_entries(),
+                         UserConfParser(
+                             infile=USER_CONF_RAD30_FILE).get_entries())
+        main(["to-json", "--type", "users", USER_CONF_RAD30_FILE])
+        self.assertEqual(json.loads(self.capsys.readouterr().out)[0],
+                         {"username": "DEFAULT",
+                          "check_items": [["Framed-Protocol", "==", "PPP"]],
+                          "reply_items": [
+                              ["Framed-Protocol", "=", "PPP"],
+                              ["Framed-Compression", "=",
+                               "Van-Jacobson-TCP-IP"]]})
+
+    def test_lookup(self):
+        clients_conf = os.path.join(self.tmpdir, "clients.conf")
+        with open(clients_conf, "w") as f:
+            f.write(CLIENTS_CONF_NETWORKS)
+        addresses = ["10.1.2.3", "10.1.9.9", "192.168.0.1", "2001:db8::1"]
+        index = ClientIndex(ClientConfParser(infile=clients_conf))
+        expected = []
+        for address in addresses:
+            match = index.lookup(address)
+            expected.append(u"{0!s} {1!s}".format(
+                address, match[0] if match else u"-"))
+        self.assertEqual(main(["lookup", "-c", self.tmpdir] + addresses),
+                         0 if all(index.lookup(a) for a in addresses) else 1)
+        self.assertEqual(self.capsys.readouterr().out.splitlines(), expected)